@@ -7,6 +7,11 @@ if __name__ == '__main__':
     argParser = argparse.ArgumentParser()
     argParser.add_argument("--img2img", help="img2img mode", action="store_true")
     argParser.add_argument("--source", help="img2img source file", default="#")
+    argParser.add_argument("--url", help="backend URL, overriding the configuration", default=None)
+    argParser.add_argument("--stroke-log", help="record the drawing session in this stroke log file", default=None)
+    argParser.add_argument("--replay", help="replay a stroke log file", default=None)
+    argParser.add_argument("--replay-renders", help="request the renderings of the replayed log", action="store_true")
+    argParser.add_argument("--replay-speed", help="replay speed factor, 0 to replay without waiting", type=float, default=1.0)
 
     args = argParser.parse_args()
 
@@ -15,5 +20,5 @@ if __name__ == '__main__':
     if img2img:
         img2img = source
 
-    view = PygameView(img2img)
+    view = PygameView(img2img, url=args.url, stroke_log=args.stroke_log, replay=args.replay, replay_renders=args.replay_renders, replay_speed=args.replay_speed)
     view.main()
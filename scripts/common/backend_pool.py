@@ -0,0 +1,199 @@
+import threading
+import time
+
+
+class Backend:
+    """
+        A SD webui backend, with its load and health status.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        self.progress = 0.0
+        self.eta = 0.0
+        self.remote_busy = False
+        self.healthy = True  # circuit closed
+        self.failures = 0
+        self.last_check = 0.0
+        self.opened_at = 0.0
+        self.probing = False  # circuit half-open, a probe request is in flight
+
+    @property
+    def load(self):
+        """
+            Backend load: requests in flight from this client, or 1 if the backend reports work from another client.
+        """
+
+        return max(self.in_flight, 1 if self.remote_busy else 0)
+
+    def update_progress(self, progress_json):
+        """
+            Update the backend load from a ``sdapi/v1/progress`` response.
+        :param dict progress_json: The progress JSON response.
+        """
+
+        self.progress = progress_json.get('progress', 0.0) or 0.0
+        self.eta = progress_json.get('eta_relative', 0.0) or 0.0
+        job_state = progress_json.get('state', {}) or {}
+        self.remote_busy = self.progress > 0.0 or job_state.get('job_count', 0) > 0
+
+    def __repr__(self):
+        return f"Backend({self.url}, load={self.load}, healthy={self.healthy})"
+
+
+class BackendPool:
+    """
+        Pool of SD webui backends. Dispatch requests to the least loaded healthy backend, eject backends after
+        consecutive failures, and re-admit them once a health check succeeds.
+
+        Each backend has a circuit breaker: once ejected (open circuit), its requests are short-circuited until the
+        reset timeout is elapsed, then a single probe request is let through (half-open circuit). The circuit is closed
+        again when a probe or a health check succeeds.
+    """
+
+    def __init__(self, urls, max_failures=3, health_interval=5.0, reset_timeout=10.0):
+        """
+        :param list[str] urls: Backends URLs.
+        :param int max_failures: Consecutive failures before ejecting a backend.
+        :param float health_interval: Health checks interval in seconds.
+        :param float reset_timeout: Delay in seconds before letting a probe request through an open circuit.
+        """
+
+        self.backends = [Backend(url) for url in urls]
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    @property
+    def primary(self):
+        """
+            First healthy backend, used for configuration and metadata requests.
+        """
+
+        with self.lock:
+            for backend in self.backends:
+                if backend.healthy:
+                    return backend
+            return self.backends[0]
+
+    def healthy_backends(self):
+        """
+            Healthy backends, or all backends if none is healthy.
+        """
+
+        healthy = [backend for backend in self.backends if backend.healthy]
+        return healthy or list(self.backends)
+
+    def acquire(self, exclude=()):
+        """
+            Reserve the least loaded healthy backend.
+        :param list[Backend]|tuple[Backend] exclude: Backends to ignore.
+        :return: The reserved backend, or ``None`` if every backend is excluded.
+        """
+
+        with self.lock:
+            candidates = [backend for backend in self.healthy_backends() if backend not in exclude]
+            if not candidates:
+                candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                return None
+
+            # stable sort: the configuration order breaks ties
+            backend = min(candidates, key=lambda b: (b.load, b.eta))
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend):
+        """
+            Release a reserved backend.
+        :param Backend backend: The backend.
+        """
+
+        with self.lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+
+    def allow_request(self, backend):
+        """
+            Circuit breaker check before a request.
+        :param Backend backend: The backend.
+        :return: ``True`` if the request can be made, ``False`` if it must be short-circuited.
+        """
+
+        with self.lock:
+            if backend.healthy:
+                return True
+
+            if not backend.probing and time.time() - backend.opened_at >= self.reset_timeout:
+                backend.probing = True
+                return True
+
+            return False
+
+    def mark_success(self, backend):
+        """
+            Reset the backend failures count.
+        :param Backend backend: The backend.
+        """
+
+        with self.lock:
+            backend.failures = 0
+            backend.probing = False
+            if not backend.healthy:
+                print(f"Backend {backend.url} is back online")
+            backend.healthy = True
+
+    def mark_failure(self, backend):
+        """
+            Count a backend failure, eject the backend after too many consecutive failures.
+        :param Backend backend: The backend.
+        :return: ``True`` if the backend circuit was just opened.
+        """
+
+        with self.lock:
+            backend.failures += 1
+            if not backend.healthy:
+                # failed probe: keep the circuit open for another reset timeout
+                backend.probing = False
+                backend.opened_at = time.time()
+                return False
+
+            if backend.failures >= self.max_failures:
+                backend.healthy = False
+                backend.opened_at = time.time()
+                print(f"Backend {backend.url} unavailable after {backend.failures} failures")
+                return True
+
+            return False
+
+    def start_health_checks(self, check):
+        """
+            Start the health checks thread.
+        :param callable check: Called with each backend, returns the progress JSON response, or ``None`` on failure.
+        """
+
+        if self.health_thread is not None:
+            return
+
+        self.health_thread = threading.Thread(target=self.health_checks, args=[check], name="BackendHealth", daemon=True)
+        self.health_thread.start()
+
+    def health_checks(self, check):
+        """
+            Health checks loop. Refresh each backend load, eject or re-admit backends.
+        :param callable check: Called with each backend, returns the progress JSON response, or ``None`` on failure.
+        """
+
+        while True:
+            for backend in self.backends:
+                progress_json = check(backend)
+                backend.last_check = time.time()
+                if progress_json is None:
+                    self.mark_failure(backend)
+                else:
+                    backend.update_progress(progress_json)
+                    self.mark_success(backend)
+
+            time.sleep(self.health_interval)
@@ -1,8 +1,14 @@
 import functools
+import random
+import time
 import requests
 from requests.models import Response
-from requests.adapters import HTTPAdapter, Retry
+from requests.adapters import HTTPAdapter
+import urllib3
 import json
+from .backend_pool import BackendPool
+from .json_stream import ImagesStream
+from .render_cache import RenderCache
 from .utils import get_img2img_json, controlnet_to_sdapi
 
 
@@ -11,63 +17,347 @@ class Api:
         Connector to SDAPI and ControlNet API
     """
 
+    # Rendering endpoints, dispatched to the least loaded backend
+    DISPATCHED_ENDPOINTS = ('sdapi/v1/txt2img', 'sdapi/v1/img2img', 'controlnet/detect')
+    # Rendering endpoints whose backend is the target of the active endpoints
+    RENDER_ENDPOINTS = ('sdapi/v1/txt2img', 'sdapi/v1/img2img')
+    # Endpoints targeting the backend of the last dispatched rendering
+    ACTIVE_ENDPOINTS = ('sdapi/v1/progress', 'sdapi/v1/interrupt', 'sdapi/v1/skip')
+
+    STREAM_CHUNK_SIZE = 2**16
+
+    # (connect, read) timeouts in seconds
+    CONNECT_TIMEOUT = 3.05
+    DEFAULT_TIMEOUT = 60
+    ENDPOINT_TIMEOUTS = {
+        'sdapi/v1/progress': 5,
+        'sdapi/v1/interrupt': 10,
+        'sdapi/v1/skip': 10,
+        'sdapi/v1/options': 30,
+        'sdapi/v1/txt2img': 600,
+        'sdapi/v1/img2img': 600,
+        'controlnet/detect': 120,
+    }
+
+    # Fake responses reasons, the request did not reach the backend or did not complete
+    CONNECTION_ERROR = 'Connection error'
+    CONNECTION_LOST = 'Connection lost'
+    CIRCUIT_OPEN = 'Backend unavailable'
+    TIMEOUT = 'Timeout'
+
     def __init__(self, state, retries=5):
         self.state = state
-        self.url = state.server['url']
         self.retries = retries
+
+        config = state.configuration["config"]
+        urls = state.server.get('urls', [state.server['url']])
+
+        self.timeouts = dict(Api.ENDPOINT_TIMEOUTS)
+        self.timeouts.update(config.get('request_timeouts', {}))
+        self.backoff_factor = float(config.get('request_backoff', 0.5))
+        self.backoff_max = float(config.get('request_backoff_max', 8))
+
+        # connection errors are retried by `backend_request`, with backoff and within the request deadline
         self.session = requests.Session()
-        retries = Retry(total=retries)
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
+        for prefix in ('http://', 'https://'):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=len(urls), pool_maxsize=10, max_retries=0))
+
+        self.pool = BackendPool(
+            urls,
+            max_failures=config.get('backend_max_failures', 3),
+            health_interval=config.get('backend_health_interval', 5.0),
+            reset_timeout=config.get('backend_reset_timeout', 10.0)
+        )
+        self.active_backend = self.pool.primary
+        if len(self.pool.backends) > 1:
+            self.pool.start_health_checks(self.check_backend)
+
+        self.cache = RenderCache(
+            memory_size=config.get('render_cache_memory_mb', 64) * 2**20,
+            disk_size=config.get('render_cache_disk_mb', 512) * 2**20,
+            enabled=config.get('render_cache', 'true') == 'true'
+        )
+
+        self.register_metrics(state.metrics)
+
+    def register_metrics(self, metrics):
+        """
+            Register the API metrics.
+        :param MetricsRegistry metrics: The metrics registry.
+        """
+
+        self.requests_metric = metrics.counter('api_requests_total', "Backend API requests, by HTTP status.", ('endpoint', 'status'))
+        self.duration_metric = metrics.histogram('api_request_duration_seconds', "Backend API requests duration, until the response headers.", ('endpoint',))
+        self.sent_metric = metrics.counter('api_sent_bytes_total', "Request bytes sent to the backends.", ('endpoint',))
+        self.received_metric = metrics.counter('api_received_bytes_total', "Response bytes received from the backends.", ('endpoint',))
+        self.renders_metric = metrics.counter('renders_total', "Rendering requests, by HTTP status.", ('endpoint', 'status'))
+        self.cache_hits_metric = metrics.counter('render_cache_hits_total', "Renderings served from the render cache.", ('endpoint',))
+
+        healthy = metrics.gauge('backend_healthy', "Backend available, its circuit breaker is closed.", ('url',))
+        in_flight = metrics.gauge('backend_in_flight', "Requests in flight to the backend.", ('url',))
+        for backend in self.pool.backends:
+            healthy.set_function(lambda b=backend: int(b.healthy), url=backend.url)
+            in_flight.set_function(lambda b=backend: b.in_flight, url=backend.url)
+
+    @property
+    def url(self):
+        """
+            URL of the primary backend.
+        """
+
+        return self.pool.primary.url
 
     @staticmethod
     def patch_api_1_9_x(kwargs):
         """ Split the old `sampler_name` into `sampler_name` and `scheduler`. Cf. https://github.com/AUTOMATIC1111/stable-diffusion-webui/issues/15603
-        :return: The updated args
+            The given args are not modified, and an already split payload is not split again.
+        :return: The updated args, a copy if patched
         """
-        json_data = kwargs.get('json', {})
-        if json_data.get('sampler_name', None) is not None and json_data.get('sampler', None) is None:
-            sampler_name: str = json_data['sampler_name']
+        json_data = kwargs.get('json', None) or {}
+        sampler_name = json_data.get('sampler_name', None)
+        if sampler_name is not None and json_data.get('sampler', None) is None and 'scheduler' not in json_data and ' ' in sampler_name:
+            json_data = dict(json_data)
             json_data['sampler_name'], json_data['scheduler'] = sampler_name[:sampler_name.rindex(' ')], sampler_name[sampler_name.rindex(' ')+1:]
-            kwargs['json'] = json_data
+            return {**kwargs, 'json': json_data}
 
         return kwargs
 
-    def request(self, endpoint, *args, method="get", **kwargs):
+    def request(self, endpoint, *args, method="get", backend=None, **kwargs):
         """
-            Makes a request with retries and ConnectionError handling
+            Makes a request with retries and ConnectionError handling.
+
+            Rendering endpoints are dispatched to the least loaded healthy backend, and retried on the next one on
+            connection error.
         :param str endpoint: url endpoint
+        :param Backend|None backend: Target backend, selected from the endpoint if not set.
         :return: Response
         """
 
-        url = f'{self.url}/{endpoint}'
+        if backend is not None:
+            return self.backend_request(backend, endpoint, *args, method=method, **kwargs)
+
+        if endpoint in Api.ACTIVE_ENDPOINTS:
+            return self.backend_request(self.active_backend, endpoint, *args, method=method, **kwargs)
+
+        if endpoint not in Api.DISPATCHED_ENDPOINTS:
+            return self.backend_request(self.pool.primary, endpoint, *args, method=method, **kwargs)
+
+        # payload prepared once, each backend gets its own copy
+        payload = kwargs.pop('json', None)
+        response = None
+        tried = []
+        while True:
+            backend = self.pool.acquire(exclude=tried)
+            if backend is None:
+                return response
+
+            tried.append(backend)
+            if endpoint in Api.RENDER_ENDPOINTS:
+                # the detections run concurrently, on any backend
+                self.active_backend = backend
+            try:
+                if payload is not None:
+                    kwargs['json'] = dict(payload)
+                response = self.backend_request(backend, endpoint, *args, method=method, **kwargs)
+            finally:
+                self.pool.release(backend)
+
+            if response.status_code != 503 or response.reason not in (Api.CONNECTION_ERROR, Api.CIRCUIT_OPEN):
+                return response
+
+    @staticmethod
+    def error_response(status_code, reason):
+        """
+            Fake response for the requests that did not complete.
+        :param int status_code: HTTP status code.
+        :param str reason: Response reason.
+        :return: Response
+        """
+
+        response = Response()
+        response.status_code = status_code
+        response.reason = reason
+        return response
+
+    def timeout(self, endpoint):
+        """
+            Request timeouts of an endpoint.
+        :param str endpoint: url endpoint
+        :return: The (connect, read) timeouts in seconds.
+        """
+
+        return Api.CONNECT_TIMEOUT, self.timeouts.get(endpoint, Api.DEFAULT_TIMEOUT)
+
+    def backoff(self, attempt):
+        """
+            Delay before retrying a request: exponential backoff with full jitter.
+        :param int attempt: Number of failed attempts.
+        :return: The delay in seconds.
+        """
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** (attempt - 1)))
+
+    def backend_request(self, backend, endpoint, *args, method="get", **kwargs):
+        """
+            Makes a request to a backend, track its health.
+
+            Connection errors are retried with backoff, until the endpoint deadline (its read timeout) is reached. POST
+            requests are not idempotent: only the failures to connect are retried, the request may have been processed
+            once the connection is established. Requests to an unavailable backend are short-circuited by its circuit
+            breaker.
+        :param Backend backend: The backend.
+        :param str endpoint: url endpoint
+        :return: Response
+        """
+
+        url = f'{backend.url}/{endpoint}'
         if method == 'post':
             fetch = self.session.post
         else:
             fetch = self.session.get
+
+        timeout = kwargs.setdefault('timeout', self.timeout(endpoint))
+        # patched once: the retries send the same payload, the 404 fallback the unpatched one
+        patched_kwargs = self.patch_api_1_9_x(kwargs)
+        deadline = time.monotonic() + (timeout[1] if isinstance(timeout, tuple) else timeout)
+        attempt = 0
+        while True:
+            if not self.pool.allow_request(backend):
+                return self.error_response(503, Api.CIRCUIT_OPEN)
+
+            start = time.perf_counter()
+            try:
+                with self.state.tracer.span("http"):
+                    response = fetch(url, *args, **patched_kwargs)
+                    if response.status_code == 404:
+                        response = fetch(url, *args, **kwargs)
+
+                self.pool.mark_success(backend)
+                self.observe_request(endpoint, response, time.perf_counter() - start, stream=kwargs.get('stream', False))
+                return response
+            except requests.exceptions.ConnectionError as error:
+                if method == 'post' and not Api.connect_failed(error):
+                    # connection dropped once the request was sent: a rendering may be in progress
+                    self.mark_failure(backend)
+                    response = self.error_response(502, Api.CONNECTION_LOST)
+                    self.observe_request(endpoint, response, time.perf_counter() - start)
+                    return response
+
+                attempt += 1
+                delay = self.backoff(attempt)
+                if backend.probing or attempt > self.retries or time.monotonic() + delay >= deadline:
+                    self.mark_failure(backend)
+                    response = self.error_response(503, Api.CONNECTION_ERROR)
+                    self.observe_request(endpoint, response, time.perf_counter() - start)
+                    return response
+                with self.state.tracer.span("backoff"):
+                    time.sleep(delay)
+            except requests.exceptions.Timeout:
+                # read timeout, the backend is busy: not retried, a rendering may be in progress
+                response = self.error_response(504, Api.TIMEOUT)
+                self.observe_request(endpoint, response, time.perf_counter() - start)
+                return response
+
+    @staticmethod
+    def connect_failed(error):
+        """
+            The connection error was raised while connecting: the request did not reach the backend.
+        :param requests.exceptions.ConnectionError error: The connection error.
+        :return: ``True`` on a connection timeout or refused connection.
+        """
+
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+    def observe_request(self, endpoint, response, duration, stream=False):
+        """
+            Update the API requests metrics.
+        :param str endpoint: url endpoint
+        :param Response response: The response.
+        :param float duration: Request duration in seconds.
+        :param bool stream: The response content is streamed, its size is measured while it is read.
+        """
+
+        self.requests_metric.inc(endpoint=endpoint, status=response.status_code)
+        self.duration_metric.observe(duration, endpoint=endpoint)
+        if response.request is not None and response.request.body:
+            self.sent_metric.inc(len(response.request.body), endpoint=endpoint)
+        if not stream:
+            self.received_metric.inc(len(response.content or b''), endpoint=endpoint)
+
+    def mark_failure(self, backend):
+        """
+            Count a backend failure, probe it periodically once its circuit is open.
+        :param Backend backend: The backend.
+        """
+
+        if self.pool.mark_failure(backend):
+            self.pool.start_health_checks(self.check_backend)
+
+    def check_backend(self, backend):
+        """
+            Backend health check.
+        :param Backend backend: The backend.
+        :return: The progress JSON response, or ``None`` if the backend is unreachable.
+        """
+
         try:
-            response = fetch(url, *args, **self.patch_api_1_9_x(kwargs))
-            if response.status_code == 404:
-                response = fetch(url, *args, **kwargs)
+            response = self.session.get(
+                f'{backend.url}/sdapi/v1/progress',
+                params={'skip_current_image': 'true'},
+                timeout=self.timeout('sdapi/v1/progress')
+            )
+        except requests.exceptions.RequestException:
+            return None
+
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    def get_controlnet_models(self):
+        """
+            Request the ControlNet models list from the API.
+        :return: The models names, or ``None`` on error.
+        """
+
+        response = self.request('controlnet/model_list')
+        if response.status_code == 200:
+            return response.json().get('model_list', [])
+        else:
+            print(f"Error code returned: HTTP {response.status_code}")
+            return None
+
+    def get_version(self):
+        """
+            Request the webui version from the API.
+        :return: The version, or ``None`` if unavailable.
+        """
 
-            return response
-        except requests.exceptions.ConnectionError:
-            response = Response()
-            response.status_code = 503
-            response.reason = 'Connection error'
-            return response
+        response = self.request('internal/sysinfo')
+        if response.status_code == 200:
+            try:
+                return response.json().get('Version', None)
+            except ValueError:
+                return None
+        else:
+            return None
 
-    def fetch_controlnet_models(self, state, safe_only=True):
+    def fetch_controlnet_models(self, state, safe_only=True, model_list=None):
         """
             Fetch the available ControlNet models list from the API.
         :param State state: Application state.
+        :param bool safe_only: Keep only the scribble and lineart models.
+        :param list[str]|None model_list: Models list already fetched from the API.
         :return: The ControlNet models.
         """
 
         controlnet_models = []
-        response = self.request('controlnet/model_list')
-        if response.status_code == 200:
-            r = response.json()
-            for model in r.get('model_list', []):  # type: str
+        if model_list is None:
+            model_list = self.get_controlnet_models()
+        if model_list is not None:
+            for model in model_list:  # type: str
                 if safe_only and 'scribble' not in model and 'lineart' not in model:
                     continue
 
@@ -93,8 +383,6 @@ class Api:
                 with open(state['configuration']["config_file"], "w") as f:
                     state.configuration["config"]['controlnet_models'] = controlnet_models
                     json.dump(state.configuration["config"], f, indent=4)
-        else:
-            print(f"Error code returned: HTTP {response.status_code}")
 
         state.control_net["controlnet_models"] = controlnet_models
 
@@ -104,7 +392,8 @@ class Api:
         :return: The API JSON response.
         """
 
-        response = self.request('sdapi/v1/progress')
+        # skip the current image preview to keep the response small
+        response = self.request('sdapi/v1/progress', params={'skip_current_image': 'true'})
         if response.status_code == 200:
             return response.json()
         else:
@@ -148,7 +437,7 @@ class Api:
     def fetch_img2img(self, state):
         """
             Call img2img from the API.
-        :param State state: Application state.
+        :param State|StateSnapshot state: Application state, or the rendering settings snapshot.
         :return: Requested status, image(s), and info.
         """
         json_data = get_img2img_json(state)
@@ -159,20 +448,51 @@ class Api:
             return {"status_code": response.status_code, "image": r['images'][0], "info": r["info"]}
         elif response.status_code == 500 and state.render['clip_skip_setting'] == 'clip_skip' and response.content.index(b'clip_skip') != -1:
             # Revert to old clip skip setting name if needed
-            state.render['clip_skip_setting'] = 'CLIP_stop_at_last_layers'
+            state.update_render('clip_skip_setting', 'CLIP_stop_at_last_layers')
             return self.fetch_img2img(state)
         else:
             return {"status_code": response.status_code}
 
-    def post_request(self, state):
+    def post_request(self, state, stream=False):
         """
             POST a request to the API.
-        :param State state: Application state.
-        :return: Requested status, image(s), and info.
+
+            In stream mode, the response images are decoded while the response is received: the returned ``stream``
+            value yields the images bytes one at a time, the ``info`` value being available from the stream once
+            the iteration is complete.
+        :param State|StateSnapshot state: Application state, or the rendering settings snapshot.
+        :param bool stream: Stream the response images.
+        :return: Requested status, image(s) or stream, and info.
         """
         endpoint = f'sdapi/v1/{"img2img" if state.img2img else "txt2img"}'
-        response = self.request(endpoint, method="post", json=controlnet_to_sdapi(state["main_json_data"]))
-        if response.status_code == 200:
+        with state.tracer.span("convert"):
+            json_data = controlnet_to_sdapi(state["main_json_data"])
+
+        # identical payload with the same checkpoint and VAE: reuse the previous result
+        with state.tracer.span("cache"):
+            cache_key = RenderCache.key(endpoint, json_data, state.render) if self.cache.enabled else None
+            result = self.cache.get(cache_key)
+        if result is not None:
+            self.cache_hits_metric.inc(endpoint=endpoint)
+            return result
+
+        response = self.request(endpoint, method="post", json=json_data, stream=stream)
+        self.renders_metric.inc(endpoint=endpoint, status=response.status_code)
+        if response.status_code == 200 and stream:
+            # the sketch images returned after the rendered images are skipped
+            batch_size = int(json_data.get('batch_size', 1)) * int(json_data.get('n_iter', 1))
+
+            # the images are stored in the cache as received, without keeping them
+            writer = self.cache.writer(cache_key, response.status_code)
+            images_stream = ImagesStream(
+                state.tracer.iterate("receive", self.iter_response(response, endpoint)),
+                max_images=batch_size,
+                on_image_data=writer.write if writer is not None else None,
+                on_complete=(lambda stream: writer.complete(stream.info)) if writer is not None else None,
+                on_abort=writer.abort if writer is not None else None
+            )
+            return {"status_code": response.status_code, "stream": images_stream, "batch_size": batch_size}
+        elif response.status_code == 200:
             r = response.json()
 
             ignore_images = 1  # last image returned is the sketch, ignore when updating
@@ -180,21 +500,39 @@ class Api:
                 ignore_images += 1  # two sketch images are returned with HR fix
 
             if len(r['images']) == 1 + ignore_images:
-                return {"status_code": response.status_code, "image":  r['images'][0], "info": r["info"]}
+                result = {"status_code": response.status_code, "image":  r['images'][0], "info": r["info"]}
             else:
-                return {"status_code": response.status_code, "batch_images": r['images'][:-ignore_images], "info": r["info"]}
+                result = {"status_code": response.status_code, "batch_images": r['images'][:-ignore_images], "info": r["info"]}
+
+            self.cache.put(cache_key, result)
+            return dict(result)
         elif response.status_code == 500 and state.render['clip_skip_setting'] == 'clip_skip' and response.content.index(b'clip_skip') != -1:
             # Revert to old clip skip setting name if needed
-            state.render['clip_skip_setting'] = 'CLIP_stop_at_last_layers'
+            state.update_render('clip_skip_setting', 'CLIP_stop_at_last_layers')
             state['main_json_data']['override_settings']['CLIP_stop_at_last_layers'] = state['main_json_data']['override_settings']['clip_skip']
             del (state['main_json_data']['override_settings']['clip_skip'])
-            return self.post_request(state)
+            return self.post_request(state, stream=stream)
         elif response.status_code == 404:
             print(f"Error code returned: HTTP {response.status_code} when accessing endpoint {endpoint}")
             return {"status_code": response.status_code}
         else:
             return {"status_code": response.status_code}
 
+    def iter_response(self, response, endpoint):
+        """
+            Iterate over a streamed response content, close the response at the end.
+        :param requests.Response response: The streamed response.
+        :param str endpoint: url endpoint
+        :return: Content chunks.
+        """
+
+        try:
+            for chunk in response.iter_content(Api.STREAM_CHUNK_SIZE):
+                self.received_metric.inc(len(chunk), endpoint=endpoint)
+                yield chunk
+        finally:
+            response.close()
+
     def fetch_configuration(self):
         """
             Request current configuration from the webui API.
@@ -250,4 +588,4 @@ class Api:
 
 
 # Type hinting imports:
-# from .state import State
+# from .state import State, StateSnapshot
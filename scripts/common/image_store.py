@@ -0,0 +1,232 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+
+
+class ImageBuffer:
+    """
+        Immutable image file data, shared by reference between its consumers.
+
+        Each holder of the buffer owns a reference, taken by ``acquire`` and given back by ``release``. The data is
+        dropped from the store when the last reference is released. Over the store memory budget, the data is spilled
+        to a file and read back when needed.
+    """
+
+    __slots__ = ('store', 'data', 'path', 'nbytes', 'render', 'refs', 'released')
+
+    def __init__(self, store, data, render):
+        """
+        :param ImageStore store: The owning store.
+        :param bytes data: Image file data.
+        :param int render: Rendering the image belongs to.
+        """
+
+        self.store = store
+        self.data = data  # type: bytes|None
+        self.path = None  # type: str|None
+        self.nbytes = len(data)
+        self.render = render
+        self.refs = 1
+        self.released = False
+
+    def read(self):
+        """
+            The image data, read back from the disk if spilled.
+        :return: The data.
+        """
+
+        data = self.data
+        if data is not None:
+            return data
+        if self.released:
+            raise ValueError("Released image buffer")
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.store.loads += 1
+        return data
+
+    def view(self):
+        """
+            Read-only view of the data, without copy if held in memory.
+        :return: The data view.
+        """
+
+        return memoryview(self.read())
+
+    def acquire(self):
+        """
+            Take a reference on the buffer.
+        :return: The buffer.
+        """
+
+        with self.store.lock:
+            if self.released:
+                raise ValueError("Released image buffer")
+            self.refs += 1
+            self.store.buffers.move_to_end(self)
+        return self
+
+    def release(self):
+        """
+            Give back a reference, the data being dropped with the last one.
+        """
+
+        with self.store.lock:
+            if self.released:
+                return
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            self.store.buffers.pop(self, None)
+            if self.data is not None:
+                self.store.memory_used -= self.nbytes
+            self.data = None
+            self.released = True
+            path = self.path
+
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+class ImageStore:
+    """
+        Store of the rendered images data.
+
+        The decoded image files are stored once, as ``bytes``, and shared by the consumers: the displayed image, the
+        batch images, the autosave and the saved files. ``io.BytesIO`` objects created from the stored ``bytes`` share
+        their memory until written, so decoding them does not copy the data either.
+
+        The data held in memory is bounded: over the memory budget, the least recently used images are spilled to a
+        temporary directory, and read back only when used again, e.g. when a batch image is selected.
+    """
+
+    def __init__(self, memory_budget=32 * 2**20, spill_dir=None):
+        """
+        :param int memory_budget: Maximum size of the images data kept in memory in bytes, ``0`` to never spill.
+        :param str|None spill_dir: Spilled images directory, a temporary directory if not set.
+        """
+
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.temporary_dir = None  # type: str|None
+
+        self.lock = threading.Lock()
+        self.buffers = collections.OrderedDict()  # type: collections.OrderedDict[ImageBuffer, None]
+        self.memory_used = 0
+        self.renders = 0
+        self.spills = 0
+        self.loads = 0
+
+    def begin_render(self):
+        """
+            Start a new rendering, for the memory report.
+        :return: The rendering number.
+        """
+
+        with self.lock:
+            self.renders += 1
+            return self.renders
+
+    def add(self, data, render=None):
+        """
+            Store image data.
+        :param bytes|bytearray|memoryview data: Image file data.
+        :param int|None render: Rendering the image belongs to, the current one if not set.
+        :return: The buffer, with a reference owned by the caller.
+        """
+
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        with self.lock:
+            buffer = ImageBuffer(self, data, self.renders if render is None else render)
+            self.buffers[buffer] = None
+            self.memory_used += buffer.nbytes
+
+        self.spill()
+        return buffer
+
+    def spill(self):
+        """
+            Spill the least recently used images to the disk, until the data held in memory fits in the budget. The
+            last added image is always kept in memory.
+        """
+
+        if not self.memory_budget:
+            return
+
+        with self.lock:
+            victims = []
+            used = self.memory_used
+            for buffer in list(self.buffers)[:-1]:
+                if used <= self.memory_budget:
+                    break
+                if buffer.data is not None:
+                    victims.append((buffer, buffer.data))
+                    used -= buffer.nbytes
+            if not victims:
+                return
+            directory = self.directory()
+
+        for buffer, data in victims:
+            path = os.path.join(directory, f"{id(buffer):x}.png")
+            with open(path, "wb") as f:
+                f.write(data)
+
+            with self.lock:
+                if buffer.released:
+                    os.remove(path)
+                    continue
+                buffer.path = path
+                buffer.data = None
+                self.memory_used -= buffer.nbytes
+                self.spills += 1
+
+    def directory(self):
+        """
+            Spilled images directory, created on first use. Must be called with the lock held.
+        :return: The directory path.
+        """
+
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            return self.spill_dir
+        if self.temporary_dir is None:
+            self.temporary_dir = tempfile.mkdtemp(prefix="sdpaint-images-")
+        return self.temporary_dir
+
+    def close(self):
+        """
+            Remove the temporary directory of the spilled images.
+        """
+
+        with self.lock:
+            temporary_dir, self.temporary_dir = self.temporary_dir, None
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    def memory_report(self):
+        """
+            Memory held by the stored images.
+        :return: The buffers count and size in bytes, in memory and spilled, in total and by rendering.
+        """
+
+        with self.lock:
+            renders = {}
+            for buffer in self.buffers:
+                report = renders.setdefault(buffer.render, {"buffers": 0, "bytes": 0, "spilled_bytes": 0, "refs": 0})
+                report["buffers"] += 1
+                report["bytes" if buffer.data is not None else "spilled_bytes"] += buffer.nbytes
+                report["refs"] += buffer.refs
+
+            return {
+                "buffers": len(self.buffers),
+                "bytes": self.memory_used,
+                "spilled_bytes": sum(report["spilled_bytes"] for report in renders.values()),
+                "budget_bytes": self.memory_budget,
+                "spills": self.spills,
+                "loads": self.loads,
+                "renders": dict(sorted(renders.items())),
+            }
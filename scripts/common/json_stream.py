@@ -0,0 +1,280 @@
+import binascii
+import json
+import re
+import time
+
+
+class ImagesStream:
+    """
+        Incremental reader of a SD API JSON response.
+
+        Iterate over the stream to get the images of the ``images`` list one at a time, base64-decoded while the
+        response is received: the whole JSON document and its base64 strings are never materialized. The other
+        top-level values (``info``, ``parameters``) are available in ``values`` once the iteration is complete.
+    """
+
+    STRUCTURE_PATTERN = re.compile(rb'["{}\[\],]')
+    WHITESPACE = b' \t\r\n'
+
+    def __init__(self, chunks, max_images=None, keep_values=('info',), on_image_data=None, on_complete=None, on_abort=None):
+        """
+        :param collections.abc.Iterable[bytes] chunks: Response content chunks.
+        :param int|None max_images: Number of images to decode, the next ones are skipped.
+        :param tuple[str]|list[str] keep_values: Top-level keys to parse, the other values are skipped.
+        :param callable|None on_image_data: Called with the image index and each raw base64 content part, as received.
+        :param callable|None on_complete: Called with the stream once the response is fully read.
+        :param callable|None on_abort: Called if the iteration stops before the end of the response.
+        """
+
+        self.chunks = iter(chunks)
+        self.max_images = max_images
+        self.keep_values = keep_values
+        self.on_image_data = on_image_data
+        self.on_complete = on_complete
+        self.on_abort = on_abort
+
+        self.buffer = b''
+        self.pos = 0
+        self.values = {}
+        self.count = 0  # number of images in the response
+        self.decode_time = 0.0  # base64 decoding time of the images, in seconds
+        self.complete = False
+
+    @property
+    def info(self):
+        return self.values.get('info', None)
+
+    def __iter__(self):
+        try:
+            self.expect(b'{')
+            while True:
+                char = self.next_char()
+                if char == b'}':
+                    break
+                if char == b',':
+                    continue
+                if char != b'"':
+                    raise ValueError(f"Unexpected character {char!r} in JSON response")
+
+                key = self.read_key()
+                self.expect(b':')
+
+                if key == 'images' and self.peek_char() == b'[':
+                    yield from self.read_images()
+                elif key in self.keep_values:
+                    self.values[key] = json.loads(self.read_value(capture=True))
+                else:
+                    self.read_value(capture=False)
+            self.complete = True
+        finally:
+            if not self.complete and self.on_abort is not None:
+                self.on_abort()
+
+        if self.on_complete is not None:
+            self.on_complete(self)
+
+    def fill(self):
+        """
+            Read the next chunk into the buffer, dropping the consumed data.
+        :return: ``False`` at the end of the response.
+        """
+
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek_char(self):
+        """
+            Next non-whitespace character, not consumed.
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ImagesStream.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos:self.pos + 1]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def next_char(self):
+        """
+            Next non-whitespace character, consumed.
+        """
+
+        char = self.peek_char()
+        self.pos += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} in JSON response, got {char!r}")
+
+    def read_string(self, output=None):
+        """
+            Read a JSON string content, the opening quote being consumed.
+        :param callable|None output: Called with each raw content part. The content is skipped if not set.
+        """
+
+        while True:
+            end = self.buffer.find(b'"', self.pos)
+            while end > 0 and self.escaped(end):
+                end = self.buffer.find(b'"', end + 1)
+
+            if end != -1:
+                if output is not None:
+                    output(self.buffer[self.pos:end])
+                self.pos = end + 1
+                return
+
+            # keep the trailing backslashes with the next chunk, to check escaping
+            stop = len(self.buffer)
+            while stop > self.pos and self.buffer[stop - 1] == ord('\\'):
+                stop -= 1
+            if output is not None:
+                output(self.buffer[self.pos:stop])
+            self.pos = stop
+
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def escaped(self, index):
+        """
+            The character at index is escaped by an odd number of backslashes.
+        """
+
+        backslashes = 0
+        while index - backslashes - 1 >= self.pos and self.buffer[index - backslashes - 1] == ord('\\'):
+            backslashes += 1
+        return backslashes % 2 == 1
+
+    def read_key(self):
+        parts = []
+        self.read_string(parts.append)
+        return json.loads(b'"' + b''.join(parts) + b'"')
+
+    def read_images(self):
+        """
+            Read the ``images`` list, yield the decoded images.
+        """
+
+        self.expect(b'[')
+        while True:
+            char = self.next_char()
+            if char == b']':
+                return
+            if char == b',':
+                continue
+            if char != b'"':
+                raise ValueError(f"Unexpected character {char!r} in images list")
+
+            self.count += 1
+            if self.max_images is not None and self.count > self.max_images:
+                self.read_string()
+                continue
+
+            decoder = Base64Decoder()
+            if self.on_image_data is None:
+                self.read_string(decoder.feed)
+            else:
+                index = self.count - 1
+
+                def output(data):
+                    self.on_image_data(index, data)
+                    decoder.feed(data)
+
+                self.read_string(output)
+            image = decoder.result()
+            self.decode_time += decoder.duration
+            yield image
+
+    def read_value(self, capture=True):
+        """
+            Read a JSON value.
+        :param bool capture: Return the raw value, or skip it.
+        :return: The raw JSON value.
+        """
+
+        parts = []
+        output = parts.append if capture else None
+        depth = 0
+        start = self.pos
+        while True:
+            match = ImagesStream.STRUCTURE_PATTERN.search(self.buffer, self.pos)
+            if match is None:
+                if capture:
+                    parts.append(self.buffer[start:])
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON response")
+                start = 0
+                continue
+
+            char = match.group()
+            index = match.start()
+            if char == b'"':
+                if capture:
+                    parts.append(self.buffer[start:index + 1])
+                self.pos = index + 1
+                self.read_string(output)
+                if capture:
+                    parts.append(b'"')
+                start = self.pos
+            elif char in (b'{', b'['):
+                depth += 1
+                self.pos = index + 1
+            elif depth > 0:
+                if char in (b'}', b']'):
+                    depth -= 1
+                self.pos = index + 1
+            else:
+                # end of the top-level value, the separator is left to the caller
+                if capture:
+                    parts.append(self.buffer[start:index])
+                self.pos = index
+                return b''.join(parts)
+
+
+class Base64Decoder:
+    """
+        Incremental base64 decoder.
+    """
+
+    def __init__(self):
+        self.pending = b''
+        self.output = bytearray()
+        self.duration = 0.0  # decoding time in seconds
+
+    def feed(self, data):
+        """
+            Decode a base64 data part. JSON escaped slashes are accepted.
+        :param bytes data: Base64 data.
+        """
+
+        start = time.perf_counter()
+        if b'\\' in data:
+            data = data.replace(b'\\/', b'/')
+
+        data = self.pending + data
+        length = len(data) - len(data) % 4
+        self.pending = data[length:]
+        if length:
+            self.output += binascii.a2b_base64(data[:length])
+        self.duration += time.perf_counter() - start
+
+    def result(self):
+        """
+            Decoded data.
+        :return: The decoded bytes.
+        """
+
+        start = time.perf_counter()
+        if self.pending:
+            self.output += binascii.a2b_base64(self.pending + b'=' * (-len(self.pending) % 4))
+            self.pending = b''
+        output = bytes(self.output)
+        self.duration += time.perf_counter() - start
+        return output
@@ -0,0 +1,160 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+
+class BackendMetadata:
+    """
+        Backend metadata discovery: samplers, upscalers, webui options, ControlNet models and webui version.
+
+        The metadata requests are made concurrently, and their results persisted to an on-disk cache keyed by backend
+        URL and webui version, so the next start can use the cached lists immediately and refresh them in background.
+        The cached metadata is invalidated when the refreshed webui version differs.
+    """
+
+    def __init__(self, api, url, cache_file=os.path.join("configs", "metadata_cache.json"), ttl=86400):
+        """
+        :param Api api: API connector.
+        :param str url: Backend URL.
+        :param str cache_file: On-disk cache file.
+        :param float ttl: Cached metadata time to live in seconds.
+        """
+
+        self.api = api
+        self.url = url
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+        self.values = {}
+        self.cached = False
+        self.cached_version = None  # type: str|None
+        self.timings = {}  # type: dict[str, float]
+        self.lock = threading.Lock()
+
+    @property
+    def fetchers(self):
+        return {
+            "samplers": self.api.get_samplers,
+            "upscalers": self.api.get_upscalers,
+            "options": self.api.fetch_configuration,
+            "controlnet_models": self.api.get_controlnet_models,
+            "version": self.api.get_version,
+        }
+
+    def __getitem__(self, key):
+        return self.values.get(key, None)
+
+    def read_cache(self):
+        """
+            Read the on-disk cache file.
+        :return: The cache content.
+        """
+
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self):
+        """
+            Load the most recent cached metadata of the backend, if not expired.
+        :return: ``True`` if cached metadata was loaded.
+        """
+
+        entries = [entry for entry in self.read_cache().values() if entry.get('url', None) == self.url]
+        if not entries:
+            return False
+
+        entry = max(entries, key=lambda e: e.get('timestamp', 0))
+        if time.time() - entry.get('timestamp', 0) > self.ttl:
+            return False
+
+        self.values = entry.get('values', {})
+        self.cached = True
+        self.cached_version = self.values.get('version', None)
+        return True
+
+    def invalidate(self):
+        """
+            Remove the cached entries of the backend.
+        """
+
+        cache = self.read_cache()
+        entries = {key: entry for key, entry in cache.items() if entry.get('url', None) != self.url}
+        if len(entries) != len(cache):
+            with open(self.cache_file, "w") as f:
+                json.dump(entries, f, indent=4)
+
+    def save(self):
+        """
+            Persist the metadata, replacing the previous entries of the backend.
+        """
+
+        cache = {key: entry for key, entry in self.read_cache().items() if entry.get('url', None) != self.url}
+        cache[f"{self.url}|{self.values.get('version', None)}"] = {
+            "url": self.url,
+            "timestamp": time.time(),
+            "values": self.values,
+        }
+
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(self.cache_file, "w") as f:
+            json.dump(cache, f, indent=4)
+
+    def fetch_one(self, key):
+        start = time.perf_counter()
+        value = self.fetchers[key]()
+        return key, value, time.perf_counter() - start
+
+    def fetch(self):
+        """
+            Fetch all the metadata concurrently, and persist it if the backend answered.
+        :return: The metadata.
+        """
+
+        values = {}
+        timings = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.fetchers)) as executor:
+            for key, value, duration in executor.map(self.fetch_one, self.fetchers):
+                values[key] = value
+                timings[key] = duration
+
+        with self.lock:
+            self.timings = timings
+            if values.get('samplers', None) or values.get('options', None):
+                self.values = values
+                self.cached = False
+                self.save()
+            elif self.cached and values.get('version', None) and values['version'] != self.cached_version:
+                # the cached metadata belongs to another webui version
+                self.values = values
+                self.cached = False
+                self.invalidate()
+            elif not self.values:
+                self.values = values
+
+        return self.values
+
+    def refresh(self, callback=None):
+        """
+            Fetch the metadata in background.
+        :param callable|None callback: Called with the metadata once fetched.
+        """
+
+        def refresh_thread():
+            values = self.fetch()
+            if callback is not None and not self.cached:
+                callback(values)
+
+        t = threading.Thread(target=refresh_thread, name="MetadataRefresh", daemon=True)
+        t.start()
+
+
+# Type hinting imports:
+# from .cn_requests import Api
@@ -0,0 +1,275 @@
+import math
+import threading
+
+
+class Metric:
+    """
+        Base metric, with a value per labels combination.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param str name: Metric name.
+        :param str documentation: Metric help text.
+        :param tuple[str]|list[str] labelnames: Label names.
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # type: dict[tuple, object]
+
+    def label_values(self, labels):
+        """
+            Label values, in label names order.
+        :param dict labels: Label values by name.
+        :return: The label values.
+        """
+
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @staticmethod
+    def format_labels(labelnames, values):
+        if not labelnames:
+            return ''
+
+        def escape(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(labelnames, values)) + '}'
+
+    @staticmethod
+    def format_value(value):
+        if value == math.inf:
+            return '+Inf'
+        if isinstance(value, float) and value.is_integer():
+            return f'{value:.1f}'
+        return str(value)
+
+    def samples(self):
+        """
+            Metric samples.
+        :return: Sample name suffix, label names, label values and value of each sample.
+        """
+
+        with self.lock:
+            return [('', self.labelnames, labels, value) for labels, value in self.values.items()]
+
+    def expose(self):
+        """
+            Prometheus text exposition of the metric.
+        :return: The metric lines.
+        """
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labelnames, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{self.format_labels(labelnames, labels)} {self.format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """
+        Monotonically increasing value.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+            Increase the counter.
+        :param int|float amount: Increment, positive.
+        :param labels: Label values.
+        """
+
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.label_values(labels), 0)
+
+
+class Gauge(Metric):
+    """
+        Value that can go up and down, set directly or read from a function when exposed.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}  # type: dict[tuple, callable]
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """
+            Read the gauge value from a function when exposed.
+        :param callable function: Returns the value.
+        :param labels: Label values.
+        """
+
+        key = self.label_values(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def get(self, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            function = self.functions.get(key, None)
+            if function is None:
+                return self.values.get(key, 0)
+        return function()
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+
+        for key, function in functions.items():
+            values[key] = float(function())
+        return [('', self.labelnames, labels, value) for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    """
+        Distribution of observed values in cumulative buckets.
+    """
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param str name: Metric name.
+        :param str documentation: Metric help text.
+        :param tuple[str]|list[str] labelnames: Label names.
+        :param tuple[float]|list[float] buckets: Buckets upper bounds.
+        """
+
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """
+            Observe a value.
+        :param float value: The value.
+        :param labels: Label values.
+        """
+
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', self.labelnames + ('le',), labels + (self.format_value(float(bound)),), cumulative))
+                samples.append(('_sum', self.labelnames, labels, total))
+                samples.append(('_count', self.labelnames, labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+        In-process metrics registry, exposed in the Prometheus text format.
+
+        Metrics are created on first use and shared by name, so every component of the application can feed the same
+        registry.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix='sdpaint_'):
+        """
+        :param str prefix: Metrics names prefix.
+        """
+
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}  # type: dict[str, Metric]
+
+    def get_or_create(self, metric_class, name, documentation, labelnames=(), **kwargs):
+        name = self.prefix + name
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered with another type or labels")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+            Get or create a counter.
+        :param str name: Metric name, without prefix.
+        :param str documentation: Metric help text.
+        :param tuple[str]|list[str] labelnames: Label names.
+        :return: The counter.
+        """
+
+        return self.get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+            Get or create a gauge.
+        :param str name: Metric name, without prefix.
+        :param str documentation: Metric help text.
+        :param tuple[str]|list[str] labelnames: Label names.
+        :return: The gauge.
+        """
+
+        return self.get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        """
+            Get or create a histogram.
+        :param str name: Metric name, without prefix.
+        :param str documentation: Metric help text.
+        :param tuple[str]|list[str] labelnames: Label names.
+        :param tuple[float]|list[float] buckets: Buckets upper bounds.
+        :return: The histogram.
+        """
+
+        return self.get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def expose(self):
+        """
+            Prometheus text exposition of all the metrics.
+        :return: The metrics text.
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
@@ -67,7 +67,7 @@ def autosave_cleanup(state, images_type):
 def autosave_image(state, image_bytes):
     """
         Auto save image(s) in the output dir.
-    :param io.BytesIO|list[io.BytesIO] image_bytes: The image(s) data.
+    :param bytes|memoryview|list[bytes|memoryview] image_bytes: The image(s) data.
     """
 
     file_path = "outputs"
@@ -106,8 +106,7 @@ def save_image(file_path, image_bytes):
     """
         Save an image file to disk.
     :param str file_path: The file path.
-    :param io.BytesIO image_bytes: The image data.
-    :param bool save_sketch: Save the sketch alongside the image.
+    :param bytes|memoryview image_bytes: The image data.
     """
 
     file_dir = os.path.dirname(file_path)
@@ -116,4 +115,4 @@ def save_image(file_path, image_bytes):
 
     # save last rendered image
     with open(file_path, "wb") as image_file:
-        image_file.write(image_bytes.getbuffer().tobytes())
\ No newline at end of file
+        image_file.write(image_bytes)
\ No newline at end of file
@@ -0,0 +1,150 @@
+import threading
+import traceback
+
+
+class ProgressMonitor:
+    """
+        Single long-lived rendering progress monitor.
+
+        Poll ``sdapi/v1/progress`` while the server is busy, and publish each response to the subscribers, so a single
+        progress request is made per interval whatever the number of views watching it. The poll interval is short
+        at the start and the end of a rendering, and longer in between.
+    """
+
+    def __init__(self, state, api, fast_interval=0.1, slow_interval=0.5, idle_interval=0.1):
+        """
+        :param State state: Application state.
+        :param Api api: API connector.
+        :param float fast_interval: Poll interval in seconds at the start and the end of a rendering.
+        :param float slow_interval: Poll interval in seconds in the middle of a rendering.
+        :param float idle_interval: Interval in seconds between local busy state checks when idle.
+        """
+
+        self.state = state
+        self.api = api
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.idle_interval = idle_interval
+
+        self.subscribers = []  # type: list[callable]
+        self.progress_json = {"progress": 0.0}
+        self.polls = 0
+
+        self.polls_metric = state.metrics.counter('progress_polls_total', "Rendering progress requests.")
+        state.metrics.gauge('render_progress', "Progress of the current rendering, from 0 to 1.").set_function(
+            lambda: self.progress or 0.0
+        )
+        self.running = False
+        self.wake_event = threading.Event()
+        self.thread = None
+
+    @property
+    def progress(self):
+        """
+            Last known progress, from 0.0 to 1.0.
+        """
+
+        return self.progress_json.get('progress', None)
+
+    def subscribe(self, callback):
+        """
+            Subscribe to progress updates.
+        :param callable callback: Called with the progress JSON response, from the monitor thread.
+        :return: The callback.
+        """
+
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        """
+            Unsubscribe from progress updates.
+        :param callable callback: The subscribed callback.
+        """
+
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def start(self):
+        """
+            Start the monitor thread.
+        """
+
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="ProgressMonitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stop the monitor thread.
+        """
+
+        self.running = False
+        self.wake_event.set()
+
+    def notify(self):
+        """
+            Wake up the monitor, a rendering started.
+        """
+
+        self.wake_event.set()
+
+    def interval(self):
+        """
+            Adaptive poll interval, according to the last known progress.
+        :return: Interval in seconds.
+        """
+
+        progress = self.progress
+        if progress is None or progress < 0.1 or progress > 0.9:
+            return self.fast_interval
+
+        # mid-rendering, poll about 10 times before the estimated end
+        eta = self.progress_json.get('eta_relative', None) or 0.0
+        return min(self.slow_interval, max(self.fast_interval, eta / 10))
+
+    def publish(self, progress_json):
+        """
+            Store and publish a progress update.
+        :param dict progress_json: The progress JSON response.
+        """
+
+        self.progress_json = progress_json
+        for callback in list(self.subscribers):
+            try:
+                callback(progress_json)
+            except Exception:
+                traceback.print_exc()
+
+    def run(self):
+        """
+            Monitor loop.
+        """
+
+        polling = False
+        while self.running:
+            if not self.state.server["busy"]:
+                if polling:
+                    # rendering ended
+                    polling = False
+                    self.publish({"progress": 0.0})
+
+                self.wake_event.wait(self.idle_interval)
+                self.wake_event.clear()
+                continue
+
+            polling = True
+            self.polls += 1
+            self.polls_metric.inc()
+            self.publish(self.api.progress_request())
+
+            self.wake_event.wait(self.interval())
+            self.wake_event.clear()
+
+
+# Type hinting imports:
+# from .state import State
+# from .cn_requests import Api
@@ -0,0 +1,352 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class RenderCache:
+    """
+        Content-addressed rendering results cache.
+
+        Results are keyed by a hash of the normalized API payload (sketch, seed, prompts, sampler, steps, ControlNet
+        unit, override settings) and the loaded checkpoint and VAE. They are kept in a size-bounded in-memory LRU, and
+        in a size-bounded on-disk store evicting the least recently used files.
+    """
+
+    def __init__(self, cache_dir=os.path.join("outputs", "cache"), memory_size=64 * 2**20, disk_size=512 * 2**20, enabled=True):
+        """
+        :param str cache_dir: On-disk store directory.
+        :param int memory_size: In-memory cache maximum size in bytes.
+        :param int disk_size: On-disk cache maximum size in bytes, ``0`` to disable the on-disk store.
+        :param bool enabled: Enable the cache.
+        """
+
+        self.cache_dir = cache_dir
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.enabled = enabled
+
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()  # type: collections.OrderedDict[str, tuple[dict, int]]
+        self.memory_used = 0
+        self.disk_used = None  # type: int|None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(endpoint, json_data, render=None):
+        """
+            Compute the cache key of a rendering.
+        :param str endpoint: API endpoint.
+        :param dict json_data: API payload.
+        :param dict|None render: Rendering state, for the loaded checkpoint and VAE.
+        :return: The cache key, or ``None`` if the rendering is not deterministic (random seed).
+        """
+
+        if int(json_data.get('seed', -1)) == -1:
+            return None
+
+        render = render or {}
+        content = json.dumps({
+            "endpoint": endpoint,
+            "checkpoint": render.get('checkpoint', None),
+            "vae": render.get('vae', None),
+            "payload": json_data,
+        }, sort_keys=True, separators=(',', ':'), default=str)
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def result_size(result):
+        """
+            Approximate size of a result in memory.
+        :param dict result: API result.
+        :return: Size in bytes.
+        """
+
+        size = len(result.get('info', '') or '')
+        if result.get('image', None):
+            size += len(result['image'])
+        for image in result.get('batch_images', None) or []:
+            size += len(image)
+        return size
+
+    @staticmethod
+    def images_result(status_code, images, info):
+        """
+            Build an API result from its images.
+        :param int status_code: Response status.
+        :param list[str] images: Base64 encoded images.
+        :param str info: Rendering info.
+        :return: The result, with an ``image`` value for a single image, ``batch_images`` otherwise.
+        """
+
+        if len(images) == 1:
+            return {"status_code": status_code, "image": images[0], "info": info}
+        else:
+            return {"status_code": status_code, "batch_images": images, "info": info}
+
+    def file_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+            Get a cached result.
+        :param str key: The cache key.
+        :return: A copy of the cached result, or ``None``.
+        """
+
+        if not self.enabled or key is None:
+            return None
+
+        with self.lock:
+            cached = self.memory.get(key, None)
+            if cached is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return dict(cached[0])
+
+        result = None
+        if self.disk_size:
+            file_path = self.file_path(key)
+            try:
+                with open(file_path, "r") as f:
+                    result = json.load(f)
+                if 'images' in result:  # streamed result
+                    result = RenderCache.images_result(result['status_code'], result['images'], result['info'])
+                os.utime(file_path)  # LRU on disk
+            except (OSError, ValueError):
+                result = None
+
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.store_memory(key, result)
+            return dict(result)
+
+    def put(self, key, result):
+        """
+            Store a result.
+        :param str key: The cache key.
+        :param dict result: API result, with ``status_code``, ``image`` or ``batch_images``, and ``info`` values.
+        """
+
+        if not self.enabled or key is None:
+            return
+
+        result = dict(result)
+        with self.lock:
+            self.store_memory(key, result)
+
+        if self.disk_size:
+            self.store_disk(key, result)
+
+    def store_memory(self, key, result):
+        """
+            Store a result in memory, evict the least recently used ones. Must be called with the lock held.
+        """
+
+        size = self.result_size(result)
+        if size > self.memory_size:
+            return
+
+        if key in self.memory:
+            self.memory_used -= self.memory.pop(key)[1]
+
+        self.memory[key] = (result, size)
+        self.memory_used += size
+
+        while self.memory_used > self.memory_size:
+            _, (_, evicted_size) = self.memory.popitem(last=False)
+            self.memory_used -= evicted_size
+
+    def store_disk(self, key, result):
+        """
+            Store a result on disk, evict the least recently used files.
+        """
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        file_path = self.file_path(key)
+        previous_size = RenderCache.file_size(file_path)
+        with open(file_path, "w") as f:
+            json.dump(result, f)
+
+        self.evict_disk(file_path, previous_size)
+
+    def writer(self, key, status_code=200):
+        """
+            Store a streamed result as it is received.
+        :param str key: The cache key.
+        :param int status_code: Response status.
+        :return: The result writer, or ``None`` if the cache is disabled.
+        """
+
+        if not self.enabled or key is None:
+            return None
+        return CacheWriter(self, key, status_code)
+
+    @staticmethod
+    def file_size(file_path):
+        """
+            Size of a stored file.
+        :param str file_path: The file path.
+        :return: The size in bytes, ``0`` if the file does not exist.
+        """
+
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def evict_disk(self, file_path, previous_size=0):
+        """
+            Account a stored file, evict the least recently used files.
+        :param str file_path: The stored file.
+        :param int previous_size: Size of the file replaced by the stored one.
+        """
+
+        with self.lock:
+            if self.disk_used is None:
+                files = self.disk_files()
+                self.disk_used = sum(size for _, _, size in files)
+            else:
+                self.disk_used += os.path.getsize(file_path) - previous_size
+                if self.disk_used <= self.disk_size:
+                    return
+                files = self.disk_files()
+                self.disk_used = sum(size for _, _, size in files)
+
+            for path, _, size in sorted(files, key=lambda f: f[1]):
+                if self.disk_used <= self.disk_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.disk_used -= size
+
+    def disk_files(self):
+        """
+            List the on-disk cache files.
+        :return: Path, modification time and size of each file.
+        """
+
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_mtime, stat.st_size))
+        return files
+
+    def stats(self):
+        """
+            Cache statistics.
+        :return: Hits, misses, and memory usage.
+        """
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_used,
+        }
+
+
+class CacheWriter:
+    """
+        Incremental store of a streamed rendering result.
+
+        The images are stored as their raw base64 content from the response, written as it is received: to a temporary
+        file of the on-disk store, renamed once the response is complete, or in memory when the on-disk store is
+        disabled. The decoded images are not kept, and never encoded again.
+    """
+
+    def __init__(self, cache, key, status_code=200):
+        """
+        :param RenderCache cache: The cache.
+        :param str key: The cache key.
+        :param int status_code: Response status.
+        """
+
+        self.cache = cache
+        self.key = key
+        self.status_code = status_code
+        self.index = None  # type: int|None
+        self.count = 0
+        self.images = []  # type: list[list[bytes]]
+        self.file = None
+        self.temp_path = None  # type: str|None
+
+        if cache.disk_size:
+            os.makedirs(cache.cache_dir, exist_ok=True)
+            fd, self.temp_path = tempfile.mkstemp(suffix=".tmp", dir=cache.cache_dir)
+            self.file = os.fdopen(fd, "wb")
+            self.file.write(b'{"status_code": %d, "images": [' % status_code)
+
+    def write(self, index, data):
+        """
+            Store a raw base64 content part of an image.
+        :param int index: Image index in the response.
+        :param bytes data: Raw base64 content, JSON escaped.
+        """
+
+        if index != self.index:
+            self.index = index
+            self.count += 1
+            if self.file is not None:
+                self.file.write(b'", "' if self.count > 1 else b'"')
+            else:
+                self.images.append([])
+
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.images[-1].append(data)
+
+    def complete(self, info):
+        """
+            Store the result once the response is fully received.
+        :param str info: Rendering info.
+        """
+
+        if self.file is None:
+            images = [b''.join(parts).replace(b'\\/', b'/').decode('ascii') for parts in self.images]
+            self.images = []
+            with self.cache.lock:
+                self.cache.store_memory(self.key, RenderCache.images_result(self.status_code, images, info))
+            return
+
+        if self.count:
+            self.file.write(b'"')
+        self.file.write(b'], "info": ' + json.dumps(info).encode('utf-8') + b'}')
+        self.file.close()
+        self.file = None
+
+        file_path = self.cache.file_path(self.key)
+        previous_size = RenderCache.file_size(file_path)
+        os.replace(self.temp_path, file_path)
+        self.temp_path = None
+        self.cache.evict_disk(file_path, previous_size)
+
+    def abort(self):
+        """
+            Drop the partially received result.
+        """
+
+        self.images = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temp_path is not None:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
@@ -0,0 +1,198 @@
+import threading
+import time
+import traceback
+
+
+class RenderScheduler:
+    """
+        Single worker rendering scheduler.
+
+        Only one rendering job is kept pending: a newer submission replaces the pending one (latest wins), so the
+        last sketch is always rendered and intermediate ones are never sent. An in-flight rendering made stale by a
+        newer submission can optionally be interrupted or skipped on the API side.
+    """
+
+    STALE_ACTIONS = ('none', 'interrupt', 'skip')
+
+    def __init__(self, state, api, stale_action='none'):
+        """
+        :param State state: Application state.
+        :param Api api: API connector, used to interrupt or skip stale renderings.
+        :param str stale_action: Action on the in-flight rendering when a newer job is submitted. ``[none, interrupt, skip]``
+        """
+
+        self.state = state
+        self.api = api
+        self.stale_action = stale_action if stale_action in RenderScheduler.STALE_ACTIONS else 'none'
+
+        self.condition = threading.Condition()
+        self.pending = None  # type: tuple[callable, callable|None, tuple]|None
+        self.pending_since = 0.0
+        self.wait_time = 0.0  # time spent pending by the running job, replaced submissions included
+        self.in_flight = False
+        self.stale = False
+        self.held = False
+        self.running = False
+        self.thread = None
+        self.subscribers = []  # type: list[callable]
+
+        metrics = state.metrics
+        metrics.gauge('render_pending', "Rendering job waiting to start.").set_function(lambda: int(self.pending is not None))
+        metrics.gauge('render_in_flight', "Rendering job running.").set_function(lambda: int(self.in_flight))
+        metrics.gauge('server_busy', "Rendering in progress on the server.").set_function(lambda: int(bool(state.server["busy"])))
+        self.jobs_metric = metrics.counter('render_jobs_total', "Rendering jobs run by the scheduler.")
+        self.replaced_metric = metrics.counter('render_jobs_replaced_total', "Pending rendering jobs replaced by a newer one.")
+        self.wait_metric = metrics.histogram('render_job_wait_seconds', "Time spent pending by the rendering jobs, debounce included.")
+        self.duration_metric = metrics.histogram('render_job_duration_seconds', "Rendering jobs duration.")
+
+    def start(self):
+        """
+            Start the scheduler worker thread.
+        """
+
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+
+        self.thread = threading.Thread(target=self.run, name="RenderScheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stop the scheduler worker thread, dropping the pending job.
+        """
+
+        with self.condition:
+            self.running = False
+            self.pending = None
+            self.condition.notify_all()
+
+    def subscribe(self, callback):
+        """
+            Subscribe to the jobs completion.
+        :param callable callback: Called without arguments after each job, from the worker thread.
+        :return: The callback.
+        """
+
+        self.subscribers.append(callback)
+        return callback
+
+    def hold(self):
+        """
+            Hold the pending job: no job starts until ``release``. The in-flight job, if any, runs to completion.
+        """
+
+        with self.condition:
+            self.held = True
+
+    def release(self, args=None):
+        """
+            Release the held pending job.
+        :param tuple|None args: New arguments of the pending job, e.g. a state snapshot taken after the changes made
+            while held.
+        """
+
+        with self.condition:
+            self.held = False
+            if args is not None and self.pending is not None:
+                self.pending = (self.pending[0], self.pending[1], args)
+            self.condition.notify_all()
+
+    @property
+    def busy(self):
+        """
+            A job is pending or in flight.
+        """
+
+        return self.in_flight or self.pending is not None
+
+    def submit(self, job, delay=None, args=()):
+        """
+            Submit a rendering job, replacing the pending one if any.
+        :param callable job: The rendering job, called from the worker thread.
+        :param callable|None delay: Returns the remaining wait time in seconds before the job can start. The job starts
+            once the value is zero or negative. Re-evaluated each time the worker wakes up.
+        :param tuple args: The job arguments, e.g. the state snapshot taken at submission.
+        """
+
+        with self.condition:
+            if self.pending is None:
+                self.pending_since = time.perf_counter()
+            else:
+                self.replaced_metric.inc()
+            self.pending = (job, delay, args)
+            cancel = self.in_flight and not self.stale and self.stale_action != 'none'
+            if cancel:
+                self.stale = True
+            self.condition.notify_all()
+
+        if cancel:
+            self.cancel_in_flight()
+
+    def cancel_in_flight(self):
+        """
+            Interrupt or skip the in-flight rendering on the API side, according to ``stale_action``.
+        """
+
+        if self.stale_action == 'interrupt':
+            self.api.interrupt_rendering()
+        elif self.stale_action == 'skip':
+            self.api.skip_rendering()
+
+    def wait_idle(self, timeout=None):
+        """
+            Wait for the pending and in-flight jobs to complete.
+        :param float|None timeout: Maximum wait time in seconds.
+        :return: ``True`` if the scheduler is idle.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.busy, timeout)
+
+    def run(self):
+        """
+            Worker loop: wait for the pending job to be ready, then run it.
+        """
+
+        while True:
+            with self.condition:
+                while self.running and (self.pending is None or self.held):
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                job, delay, args = self.pending
+                wait = delay() if delay is not None else 0
+                if wait > 0:
+                    # debounce, the pending job may be replaced meanwhile
+                    self.condition.wait(wait)
+                    continue
+
+                self.pending = None
+                self.wait_time = time.perf_counter() - self.pending_since
+                self.in_flight = True
+                self.stale = False
+                self.state.server["busy"] = True
+
+            self.jobs_metric.inc()
+            self.wait_metric.observe(self.wait_time)
+            start = time.perf_counter()
+            try:
+                job(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.duration_metric.observe(time.perf_counter() - start)
+                with self.condition:
+                    self.in_flight = False
+                    self.state.server["busy"] = False
+                    self.condition.notify_all()
+                for callback in list(self.subscribers):
+                    callback()
+
+
+# Type hinting imports:
+# from .state import State
+# from .cn_requests import Api
@@ -0,0 +1,221 @@
+import base64
+import io
+import struct
+import time
+import zlib
+
+import numpy as np
+from PIL import Image, ImageOps
+
+
+class SketchEncoder:
+    """
+        Compact PNG encoder for the sketch images sent to ControlNet.
+
+        The sketch is mostly black strokes on white: the smallest PNG format preserving its colors is used, and blank
+        sketches are encoded once per size and color. In gray sketches, the runs of blank rows are not compressed again:
+        their compressed data is cached, only the rows with strokes are compressed.
+
+        Encodings:
+
+        - ``rgb``: 24-bit PNG.
+        - ``auto``: 8-bit grayscale PNG if the sketch only has gray levels, 24-bit otherwise.
+
+        1-bit and palette PNG are not used: the ControlNet API does not convert its input images to RGB.
+    """
+
+    ENCODINGS = ('rgb', 'auto')
+    PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    # minimum number of blank rows encoded from the cache
+    MIN_BLANK_ROWS = 16
+
+    def __init__(self, encoding='auto', compress_level=1):
+        """
+        :param str encoding: Sketch encoding. ``[rgb, auto]``
+        :param int compress_level: PNG zlib compression level, from 0 (none) to 9 (smallest).
+        """
+
+        self.encoding = encoding if encoding in SketchEncoder.ENCODINGS else 'auto'
+        self.compress_level = compress_level
+
+        self.blank_cache = {}  # type: dict[tuple, str]
+        self.blank_rows_cache = {}  # type: dict[tuple, bytes]
+        self.last_stats = {}
+        self.total_stats = {"count": 0, "bytes": 0, "encode_time": 0.0}
+
+    def encode(self, image, invert=False):
+        """
+            Encode a sketch image as base64 PNG.
+        :param Image.Image image: The RGB sketch image.
+        :param bool invert: Invert the sketch colors.
+        :return: The base64 encoded PNG.
+        """
+
+        start = time.perf_counter()
+
+        colors = image.getcolors(256) if self.encoding != 'rgb' else None
+        if colors is not None and len(colors) == 1:
+            # blank sketch fast path
+            key = (image.size, colors[0][1], invert)
+            data = self.blank_cache.get(key, None)
+            if data is None:
+                data = self.blank_cache[key] = self.png_string(self.convert(image, colors, invert))
+            mode = 'blank'
+        else:
+            image = self.convert(image, colors, invert)
+            data = self.png_string(image)
+            mode = image.mode
+
+        self.update_stats(mode, len(data) * 3 // 4, time.perf_counter() - start)
+        return data
+
+    def encode_array(self, array):
+        """
+            Encode a sketch pixels array as base64 PNG. Gray sketches are encoded from a single channel, without
+            intermediate RGB image.
+        :param np.ndarray array: The ``(height, width, 3)`` RGB pixels, already inverted if needed.
+        :return: The base64 encoded PNG.
+        """
+
+        if self.encoding == 'rgb':
+            return self.encode(Image.fromarray(array))
+
+        start = time.perf_counter()
+
+        red = array[:, :, 0]
+        if not np.array_equal(red, array[:, :, 1]) or not np.array_equal(red, array[:, :, 2]):
+            return self.encode(Image.fromarray(array))
+
+        red = np.ascontiguousarray(red)
+        image = Image.fromarray(red)
+        colors = image.getcolors(256)
+        if colors is not None and len(colors) == 1:
+            # blank sketch fast path
+            key = (image.size, colors[0][1], image.mode)
+            data = self.blank_cache.get(key, None)
+            if data is None:
+                data = self.blank_cache[key] = self.png_string(image)
+            mode = 'blank'
+        else:
+            data = self.png_rows_string(red)
+            mode = image.mode
+
+        self.update_stats(mode, len(data) * 3 // 4, time.perf_counter() - start)
+        return data
+
+    def convert(self, image, colors, invert):
+        """
+            Convert the sketch image to the most compact mode allowed by the encoding.
+        :param Image.Image image: The RGB sketch image.
+        :param list[tuple]|None colors: The image colors, ``None`` if more than 256.
+        :param bool invert: Invert the sketch colors.
+        :return: The converted image.
+        """
+
+        gray = colors is not None and all(color[0] == color[1] == color[2] for _, color in colors)
+        if gray:
+            image = image.convert('L')
+        return ImageOps.invert(image) if invert else image
+
+    def png_string(self, image):
+        """
+            Save an image as base64 encoded PNG.
+        :param Image.Image image: The image.
+        :return: The base64 encoded PNG.
+        """
+
+        data = io.BytesIO()
+        image.save(data, format="png", compress_level=self.compress_level)
+        return base64.b64encode(data.getvalue()).decode('utf-8')
+
+    def png_rows_string(self, pixels):
+        """
+            Save an 8-bit gray image as base64 encoded PNG, compressing only the rows outside of the blank rows runs.
+
+            The image data is compressed by segments, each one flushed to a byte boundary and compressed without
+            reference to the previous ones: the compressed runs of blank rows are cached and reused.
+        :param np.ndarray pixels: The ``(height, width)`` gray pixels.
+        :return: The base64 encoded PNG.
+        """
+
+        height, width = pixels.shape
+        # PNG scanlines, without filter
+        scanlines = np.zeros((height, width + 1), dtype=np.uint8)
+        scanlines[:, 1:] = pixels
+
+        # runs of identical blank rows: the rows gray level, -1 for the other rows
+        value = np.where(np.all(pixels == pixels[:, :1], axis=1), pixels[:, 0].astype(np.int16), -1)
+        bounds = (np.flatnonzero(np.diff(value)) + 1).tolist()
+        runs = [
+            (start, end) for start, end in zip([0] + bounds, bounds + [height])
+            if value[start] >= 0 and end - start >= SketchEncoder.MIN_BLANK_ROWS
+        ]
+
+        segments = []
+        adler = 1
+        y = 0
+        for run_start, run_end in runs + [(height, height)]:
+            if run_start > y:
+                data = scanlines[y:run_start].tobytes()
+                compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+                segments.append(compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH))
+                adler = zlib.adler32(data, adler)
+            if run_end > run_start:
+                scanline = scanlines[run_start].tobytes()
+                segments.extend(self.blank_rows(scanline, int(value[run_start]), run_end - run_start))
+                adler = zlib.adler32(scanline * (run_end - run_start), adler)
+            y = run_end
+
+        # zlib stream: header, deflate segments, empty final block, checksum
+        idat = b'\x78\x01' + b''.join(segments) + b'\x03\x00' + struct.pack('>I', adler)
+        header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+        png = SketchEncoder.PNG_SIGNATURE + png_chunk(b'IHDR', header) + png_chunk(b'IDAT', idat) + png_chunk(b'IEND', b'')
+        return base64.b64encode(png).decode('utf-8')
+
+    def blank_rows(self, scanline, value, count):
+        """
+            Compressed run of blank rows, cached by power of two rows counts.
+        :param bytes scanline: The row scanline.
+        :param int value: The row pixels gray level.
+        :param int count: Number of rows.
+        :return: The compressed segments.
+        """
+
+        segments = []
+        rows = 1 << (count.bit_length() - 1)
+        while count:
+            if rows <= count:
+                key = (len(scanline), value, rows, self.compress_level)
+                segment = self.blank_rows_cache.get(key, None)
+                if segment is None:
+                    compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+                    segment = compressor.compress(scanline * rows) + compressor.flush(zlib.Z_FULL_FLUSH)
+                    self.blank_rows_cache[key] = segment
+                segments.append(segment)
+                count -= rows
+            rows >>= 1
+        return segments
+
+    def update_stats(self, mode, size, encode_time):
+        """
+            Store the last encoding statistics.
+        :param str mode: Encoded image mode.
+        :param int size: PNG size in bytes.
+        :param float encode_time: Encoding time in seconds.
+        """
+
+        self.last_stats = {"mode": mode, "bytes": size, "encode_time": encode_time}
+        self.total_stats["count"] += 1
+        self.total_stats["bytes"] += size
+        self.total_stats["encode_time"] += encode_time
+
+
+def png_chunk(tag, data):
+    """
+        Build a PNG chunk.
+    :param bytes tag: Chunk type.
+    :param bytes data: Chunk data.
+    :return: The chunk, with its length and CRC.
+    """
+
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
@@ -0,0 +1,314 @@
+import collections
+import threading
+import zlib
+
+import numpy as np
+
+
+class HistoryTile:
+    """
+        Saved pixels of a sketch tile, stored raw then compressed in the background.
+    """
+
+    __slots__ = ('shape', 'dtype', 'array', 'data')
+
+    def __init__(self, array):
+        """
+        :param np.ndarray array: Copy of the tile pixels.
+        """
+
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.array = array  # type: np.ndarray|None
+        self.data = None  # type: bytes|None
+
+    @property
+    def size(self):
+        """
+            Memory used by the tile pixels, in bytes.
+        """
+
+        array = self.array
+        return array.nbytes if array is not None else len(self.data)
+
+    def pixels(self):
+        """
+            The tile pixels.
+        :return: The pixels array, read-only if decompressed.
+        """
+
+        array = self.array
+        if array is not None:
+            return array
+        return np.frombuffer(zlib.decompress(self.data), dtype=self.dtype).reshape(self.shape)
+
+
+class SketchHistory:
+    """
+        Undo and redo history of the sketch, stored as copy-on-write tiles.
+
+        The history keeps a copy of the sketch as of the last step. The drawing code marks the areas it modified, and
+        on commit only the marked tiles that differ from the copy are saved in the new step, with their previous
+        content. Undoing or redoing a step swaps its tiles with the sketch pixels: the cost only depends on the step
+        size, not on the history depth. The saved tiles are compressed by a background thread, and the oldest steps
+        are dropped when the history exceeds its memory budget.
+
+        Pixels are given as 2D arrays indexed by ``[x, y]``, like ``pygame.surfarray.pixels2d`` views.
+    """
+
+    def __init__(self, tile_size=64, memory_budget=32 * 2**20, compress_level=1):
+        """
+        :param int tile_size: Saved tiles width and height.
+        :param int memory_budget: Maximum size of the saved tiles in bytes, the latest step being always kept.
+        :param int compress_level: Tiles zlib compression level, ``0`` to keep them raw.
+        """
+
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+        self.compress_level = compress_level
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.sketch = None  # type: np.ndarray|None
+        self.dirty = set()  # type: set[tuple[int, int]]
+        self.undo_steps = collections.deque()  # type: collections.deque[dict[tuple[int, int], HistoryTile]]
+        self.redo_steps = []  # type: list[dict[tuple[int, int], HistoryTile]]
+        self.compress_queue = collections.deque()  # type: collections.deque[HistoryTile]
+        self.compressing = False
+        self.evicted = 0
+        self.thread = None
+
+    def reset(self, pixels):
+        """
+            Start a new history from the current sketch.
+        :param np.ndarray pixels: The sketch pixels.
+        """
+
+        with self.lock:
+            self.sketch = np.array(pixels, copy=True)
+            self.dirty = set()
+            self.undo_steps.clear()
+            self.redo_steps = []
+            self.compress_queue.clear()
+
+    @property
+    def size(self):
+        """
+            Sketch size, ``None`` before the first reset.
+        """
+
+        return self.sketch.shape if self.sketch is not None else None
+
+    def tile_slice(self, index):
+        """
+            Pixels slice of a tile.
+        :param tuple[int, int] index: The tile index.
+        :return: The ``[x, y]`` slices.
+        """
+
+        x, y = index[0] * self.tile_size, index[1] * self.tile_size
+        return slice(x, x + self.tile_size), slice(y, y + self.tile_size)
+
+    def mark(self, left, top, width, height):
+        """
+            Mark a modified area of the sketch.
+        :param int left: Area left, in sketch coordinates.
+        :param int top: Area top.
+        :param int width: Area width.
+        :param int height: Area height.
+        """
+
+        with self.lock:
+            if self.sketch is None:
+                return
+            sketch_width, sketch_height = self.sketch.shape
+            right, bottom = min(left + width, sketch_width), min(top + height, sketch_height)
+            left, top = max(left, 0), max(top, 0)
+            if right <= left or bottom <= top:
+                return
+
+            size = self.tile_size
+            self.dirty.update(
+                (tx, ty)
+                for tx in range(left // size, (right - 1) // size + 1)
+                for ty in range(top // size, (bottom - 1) // size + 1)
+            )
+
+    def commit(self, pixels):
+        """
+            Save the marked changes of the sketch as a new step.
+        :param np.ndarray pixels: The sketch pixels, locked against concurrent drawing by the caller.
+        :return: ``True`` if a step was added, ``False`` if the marked tiles did not change.
+        """
+
+        with self.lock:
+            if self.sketch is None or not self.dirty:
+                return False
+            dirty, self.dirty = self.dirty, set()
+
+            step = {}
+            for index in dirty:
+                tile = self.tile_slice(index)
+                if not np.array_equal(pixels[tile], self.sketch[tile]):
+                    step[index] = HistoryTile(self.sketch[tile].copy())
+                    self.sketch[tile] = pixels[tile]
+
+            if not step:
+                return False
+
+            self.undo_steps.append(step)
+            self.redo_steps = []
+            self.queue_compression(step)
+            return True
+
+    def swap(self, step, pixels):
+        """
+            Swap the tiles of a step with the sketch pixels. Must be called with the lock held.
+        :param dict step: The step tiles, replaced by the swapped out sketch tiles.
+        :param np.ndarray pixels: The sketch pixels.
+        :return: The swapped areas, as ``(left, top, width, height)`` in sketch coordinates.
+        """
+
+        areas = []
+        for index, saved in step.items():
+            tile = self.tile_slice(index)
+            step[index] = HistoryTile(pixels[tile].copy())
+            pixels[tile] = saved.pixels()
+            self.sketch[tile] = pixels[tile]
+
+            width, height = self.sketch[tile].shape
+            areas.append((tile[0].start, tile[1].start, width, height))
+
+        self.queue_compression(step)
+        return areas
+
+    def undo(self, pixels):
+        """
+            Undo the last step. Uncommitted changes are committed first.
+        :param np.ndarray pixels: The sketch pixels, locked against concurrent drawing by the caller.
+        :return: The restored areas, ``None`` if there is nothing to undo.
+        """
+
+        self.commit(pixels)
+        with self.lock:
+            if not self.undo_steps:
+                return None
+            step = self.undo_steps.pop()
+            areas = self.swap(step, pixels)
+            self.redo_steps.append(step)
+            return areas
+
+    def redo(self, pixels):
+        """
+            Redo the last undone step. Uncommitted changes are committed first, dropping the undone steps.
+        :param np.ndarray pixels: The sketch pixels, locked against concurrent drawing by the caller.
+        :return: The restored areas, ``None`` if there is nothing to redo.
+        """
+
+        self.commit(pixels)
+        with self.lock:
+            if not self.redo_steps:
+                return None
+            step = self.redo_steps.pop()
+            areas = self.swap(step, pixels)
+            self.undo_steps.append(step)
+            return areas
+
+    @property
+    def steps(self):
+        """
+            Number of steps that can be undone and redone.
+        """
+
+        return len(self.undo_steps), len(self.redo_steps)
+
+    def memory_used(self):
+        """
+            Size of the saved tiles. Must be called with the lock held.
+        :return: Size in bytes.
+        """
+
+        return sum(tile.size for steps in (self.undo_steps, self.redo_steps) for step in steps for tile in step.values())
+
+    def memory_report(self):
+        """
+            Memory usage of the history.
+        :return: The steps, saved tiles and memory sizes in bytes.
+        """
+
+        with self.lock:
+            tiles = [tile for steps in (self.undo_steps, self.redo_steps) for step in steps for tile in step.values()]
+            return {
+                "undo_steps": len(self.undo_steps),
+                "redo_steps": len(self.redo_steps),
+                "evicted_steps": self.evicted,
+                "tiles": len(tiles),
+                "compressed_tiles": sum(1 for tile in tiles if tile.array is None),
+                "tiles_bytes": sum(tile.size for tile in tiles),
+                "raw_tiles_bytes": sum(int(np.prod(tile.shape)) * tile.dtype.itemsize for tile in tiles),
+                "sketch_bytes": self.sketch.nbytes if self.sketch is not None else 0,
+                "budget_bytes": self.memory_budget,
+            }
+
+    def evict(self):
+        """
+            Drop the oldest steps until the history fits in the memory budget. Must be called with the lock held.
+        """
+
+        used = self.memory_used()
+        while used > self.memory_budget and len(self.undo_steps) + len(self.redo_steps) > 1:
+            # oldest undo steps first, then the farthest redo steps
+            step = self.undo_steps.popleft() if self.undo_steps else self.redo_steps.pop(0)
+            used -= sum(tile.size for tile in step.values())
+            self.evicted += 1
+
+    def queue_compression(self, step):
+        """
+            Compress the tiles of a step in the background, the memory budget being applied once they are compressed.
+            Must be called with the lock held.
+        :param dict step: The step tiles.
+        """
+
+        if not self.compress_level:
+            self.evict()
+            return
+
+        self.compress_queue.extend(step.values())
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.compress_tiles, name="SketchHistory", daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def compress_tiles(self):
+        """
+            Compression thread: compress the queued tiles, then apply the memory budget to the compressed sizes.
+        """
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.compress_queue)
+                tile = self.compress_queue.popleft()
+                array = tile.array
+                self.compressing = True
+
+            if array is not None:
+                data = zlib.compress(np.ascontiguousarray(array), self.compress_level)
+                # the compressed data is set first, for the readers getting the pixels without lock
+                tile.data = data
+                tile.array = None
+
+            with self.condition:
+                self.compressing = False
+                if not self.compress_queue:
+                    self.evict()
+                    self.condition.notify_all()
+
+    def wait_compressed(self, timeout=None):
+        """
+            Wait for the queued tiles to be compressed.
+        :param float|None timeout: Maximum wait time in seconds.
+        :return: ``True`` if the queue is empty.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.compress_queue and not self.compressing, timeout)
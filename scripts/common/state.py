@@ -1,7 +1,13 @@
+import copy
 import json
+import threading
+import types
 
 from .cn_requests import Api
-from .utils import load_config, update_size
+from .metadata_cache import BackendMetadata
+from .metrics import MetricsRegistry
+from .tracing import Tracer
+from .utils import load_config, update_size, StartupTimer
 
 
 class State:
@@ -21,6 +27,7 @@ class State:
     }
     server = {
         "url": 'http://127.0.0.1:7860',
+        "urls": ['http://127.0.0.1:7860'],
         "busy": False,
     }
     render = {
@@ -83,14 +90,74 @@ class State:
         "negative_prompt": "",
     }
 
-    def __init__(self, img2img=""):
+    def __init__(self, img2img="", url=None):
+        """
+        :param str img2img: img2img source file, empty for the txt2img mode.
+        :param str|list[str]|None url: Backend URL(s), overriding the configuration.
+        """
+
         self.img2img = img2img
-        self.update_config(preload=True)
-        self.api = Api(self)
-        self.update_config()
-        self.update_settings()
-        self.update_webui_config()
-    
+        self.url = url
+        # held by the background threads updating the state, and while taking snapshots
+        self.lock = threading.RLock()
+        self.startup_timer = StartupTimer()
+        self.metrics = MetricsRegistry()
+
+        with self.startup_timer.step("configuration"):
+            self.update_config(preload=True)
+            self.tracer = Tracer(
+                enabled=self.configuration["config"].get('tracing', 'false') == 'true',
+                trace_file=self.configuration["config"].get('trace_file', '') or None
+            )
+            self.api = Api(self)
+
+        with self.startup_timer.step("metadata"):
+            self.load_metadata()
+
+        with self.startup_timer.step("settings"):
+            self.update_config()
+            self.update_settings()
+            self.update_webui_config(self.metadata["options"])
+
+        # refreshed once the settings are initialized, the refresh updating them
+        if self.metadata.cached:
+            self.metadata.refresh(self.update_metadata)
+
+    def load_metadata(self):
+        """
+            Load the backend metadata from cache, or fetch it if not cached. The cached metadata is refreshed in
+            background once the settings are initialized.
+        """
+
+        self.metadata = BackendMetadata(self.api, self.server["url"], ttl=self.configuration["config"].get('metadata_cache_ttl', 86400))
+
+        if not self.metadata.load():
+            self.metadata.fetch()
+
+        self.startup_timer.details.update({f"metadata {key}": duration for key, duration in self.metadata.timings.items()})
+
+    def update_metadata(self, metadata):
+        """
+            Apply refreshed backend metadata, keeping the current selections if still available.
+        :param dict metadata: The backend metadata.
+        """
+
+        with self.lock:
+            sampler = self.samplers["sampler"]
+            hr_upscaler = self.render["hr_upscaler"]
+
+            self.update_samplers()
+            self.update_upscalers()
+            self.update_webui_config(metadata.get('options', None))
+
+            if sampler in self.samplers["list"]:
+                self.samplers["sampler"] = sampler
+            if hr_upscaler in self.render["hr_upscalers"]:
+                self.render["hr_upscaler"] = hr_upscaler
+
+            if not self.configuration["config"]['controlnet_models'] and metadata.get('controlnet_models', None):
+                self.api.fetch_controlnet_models(self, model_list=metadata['controlnet_models'])
+
     def update_samplers(self):
         """
             Update samplers list from available samplers.
@@ -122,7 +189,7 @@ class State:
                 priority -= 2
             return priority
 
-        samplers_data = self.api.get_samplers()
+        samplers_data = self.metadata["samplers"] or []
         samplers_names = list(map(lambda x: x["name"], samplers_data))
         if len(samplers_names) == 0:
             samplers_names = self.configuration["config"].get("samplers", ["DDIM"])
@@ -139,7 +206,7 @@ class State:
             self.render["hr_upscaler"] = self.render["hr_upscalers"][0]
             return
 
-        upscalers_data = self.api.get_upscalers()
+        upscalers_data = self.metadata["upscalers"] or []
         upscalers_names = list(map(lambda x: x["name"], upscalers_data))
         if len(upscalers_names) == 0:
             upscalers_names = self.configuration["config"].get("hr_upscalers", ["Latent (bicubic)"])
@@ -155,7 +222,12 @@ class State:
         """
         self.configuration["config"] = load_config("configs/config.json")
 
-        self.server["url"] = self.configuration["config"].get('url', 'http://127.0.0.1:7860')
+        # a single backend URL, or a list of backends URLs
+        urls = self.url or self.configuration["config"].get('url', 'http://127.0.0.1:7860')
+        if isinstance(urls, str):
+            urls = [urls]
+        self.server["urls"] = urls
+        self.server["url"] = urls[0]
 
         if preload:
             return
@@ -178,7 +250,7 @@ class State:
         self.detectors["detector"] = self.detectors["list"][0]
 
         if not self.configuration["config"]['controlnet_models']:
-            self.api.fetch_controlnet_models(self)
+            self.api.fetch_controlnet_models(self, model_list=self.metadata["controlnet_models"])
         self.control_net["controlnet_models"]: list[str] = self.configuration["config"].get("controlnet_models", [])
         self.control_net["controlnet_weights"] = self.configuration["config"].get("controlnet_weights", [0.6, 1.0, 1.6])
         self.control_net["controlnet_weight"] = self.control_net["controlnet_weights"][0]
@@ -255,16 +327,89 @@ class State:
             with open(self.json_file, "w") as f:
                 json.dump(settings, f, indent=4)
 
-    def update_webui_config(self):
+    def update_webui_config(self, webui_config=None):
         """
             Update webui configuration from the API.
+        :param dict|None webui_config: Configuration already fetched from the API.
+        """
+        if webui_config is None:
+            webui_config = self.api.fetch_configuration()
+        with self.lock:
+            self.configuration["webui_config"] = webui_config
+            self.render['checkpoint'] = self.configuration["webui_config"].get('sd_model_checkpoint', None)
+            self.render['vae'] = self.configuration["webui_config"].get('sd_vae', None)
+
+    def update_render(self, key, value):
+        """
+            Update a rendering setting from a background thread.
+        :param str key: Setting name.
+        :param value: Setting value.
         """
-        self.configuration["webui_config"] = self.api.fetch_configuration()
-        self.render['checkpoint'] = self.configuration["webui_config"].get('sd_model_checkpoint', None)
-        self.render['vae'] = self.configuration["webui_config"].get('sd_vae', None)
+
+        with self.lock:
+            self.render[key] = value
+
+    def snapshot(self):
+        """
+            Immutable copy of the rendering settings, for a rendering submitted now.
+        :return: The snapshot.
+        """
+
+        return StateSnapshot(self)
 
     def __setitem__(self, key, value):
         setattr(self, key, value)
 
     def __getitem__(self, key):
         return getattr(self, key)
+
+
+class StateSnapshot:
+    """
+        Immutable copy of the rendering settings, taken when a rendering is submitted.
+
+        The rendering job reads its settings from the snapshot, so the settings changed by the main loop meanwhile
+        (seed, size, batch size, HR scale...) only apply to the next rendering. The settings are read-only mappings; the
+        payload built for the rendering, ``main_json_data``, is the only value set on the snapshot. The application
+        wide objects (configuration, tracer, metrics) are shared with the state.
+    """
+
+    FIELDS = ('render', 'gen_settings', 'control_net', 'samplers', 'detectors', 'autosave', 'settings')
+
+    def __init__(self, state):
+        """
+        :param State state: Application state.
+        """
+
+        self.state = state
+        self.configuration = state.configuration
+        self.server = state.server
+        self.tracer = state.tracer
+        self.metrics = state.metrics
+        self.img2img = state.img2img
+        self.json_file = state.json_file
+        self.main_json_data = {}
+
+        with state.lock:
+            for field in StateSnapshot.FIELDS:
+                # the batch images are the rendering output, not a setting
+                values = {key: value for key, value in getattr(state, field).items() if key != 'batch_images'}
+                setattr(self, field, types.MappingProxyType(copy.deepcopy(values)))
+
+    def update_render(self, key, value):
+        """
+            Update a rendering setting of the state, discovered while rendering, and of this snapshot.
+        :param str key: Setting name.
+        :param value: Setting value.
+        """
+
+        self.state.update_render(key, value)
+        self.render = types.MappingProxyType({**self.render, key: value})
+
+    def __setitem__(self, key, value):
+        if key != 'main_json_data':
+            raise TypeError(f"State snapshot is immutable, cannot set {key}")
+        self.main_json_data = value
+
+    def __getitem__(self, key):
+        return getattr(self, key)
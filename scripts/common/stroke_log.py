@@ -0,0 +1,240 @@
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+class StrokeLog:
+    """
+        Compact binary log of the sketch drawing operations.
+
+        The file starts with a header: magic, version, sketch size and session start time. Each record is an opcode
+        and the time since the session start in milliseconds, followed by the operation values. Positions are in sketch
+        coordinates, brush motion is stored as 8 bits deltas when possible.
+    """
+
+    MAGIC = b'SDPS'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBHHd')
+    RECORD = struct.Struct('<BI')
+
+    BRUSH = 1  # brush motion drawn in a frame: brushes colors and sizes, positions
+    BRUSH_END = 2  # end of brush stroke
+    CIRCLE = 3  # color, radius, center
+    POLYGON = 4  # color, width (0: filled), points
+    FILL = 5  # whole sketch filled with a color
+    UNDO = 6
+    REDO = 7
+    SKETCH = 8  # sketch replaced by a PNG image
+    RENDER = 9  # rendering request, with the seed
+    COMMIT = 10  # undo history step
+
+    @staticmethod
+    def pack_points(points):
+        """
+            Pack positions, as deltas from the first one if they all fit in 8 bits.
+        :param list[tuple[int, int]] points: The positions.
+        :return: The packed data.
+        """
+
+        array = np.asarray(points, dtype=np.int16).reshape(-1, 2)
+        deltas = np.diff(array, axis=0)
+        compact = bool(not deltas.size or (deltas.min() >= -128 and deltas.max() <= 127))
+        data = struct.pack('<HB', len(array), compact) + array[:1].tobytes()
+        return data + (deltas.astype(np.int8) if compact else array[1:]).tobytes()
+
+    @staticmethod
+    def unpack_points(data, offset):
+        """
+            Unpack positions.
+        :param bytes data: The data.
+        :param int offset: Packed positions offset.
+        :return: The positions as a ``(n, 2)`` array, and the offset of the next value.
+        """
+
+        count, compact = struct.unpack_from('<HB', data, offset)
+        offset += 3
+        if count == 0:
+            # no first position
+            return np.empty((0, 2), dtype=np.int32), offset
+        first = np.frombuffer(data, dtype=np.int16, count=2, offset=offset).astype(np.int32)
+        offset += 4
+        if compact:
+            deltas = np.frombuffer(data, dtype=np.int8, count=(count - 1) * 2, offset=offset).reshape(-1, 2)
+            offset += deltas.size
+            points = np.concatenate([first[None, :], first + np.cumsum(deltas, axis=0, dtype=np.int32)])
+        else:
+            rest = np.frombuffer(data, dtype=np.int16, count=(count - 1) * 2, offset=offset).reshape(-1, 2)
+            offset += rest.size * 2
+            points = np.concatenate([first[None, :], rest.astype(np.int32)])
+        return points, offset
+
+
+class StrokeLogWriter:
+    """
+        Write a stroke log incrementally. Thread safe, the renderings being recorded from the render thread.
+    """
+
+    def __init__(self, file_path, size):
+        """
+        :param str file_path: Log file path.
+        :param tuple[int, int] size: Sketch size.
+        """
+
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.file = open(file_path, "wb")
+        self.start = time.time()
+        self.file.write(StrokeLog.HEADER.pack(StrokeLog.MAGIC, StrokeLog.VERSION, size[0], size[1], self.start))
+        self.records = 0
+
+    def write(self, opcode, data=b''):
+        """
+            Write a record.
+        :param int opcode: Operation code.
+        :param bytes data: Operation values.
+        """
+
+        with self.lock:
+            if self.file is None:
+                return
+            elapsed = int((time.time() - self.start) * 1000)
+            self.file.write(StrokeLog.RECORD.pack(opcode, elapsed) + data)
+            self.records += 1
+
+    @staticmethod
+    def pack_color(color):
+        return struct.pack('<3B', *color[:3])
+
+    def brush(self, brushes, points):
+        """
+            Brush motion drawn in a frame. Skipped without positions.
+        :param list[tuple[tuple, int]] brushes: Colors and sizes of the pressed brushes.
+        :param list[tuple[int, int]] points: Positions.
+        """
+
+        if not len(points):
+            return
+
+        data = struct.pack('<B', len(brushes)) + b''.join(self.pack_color(color) + struct.pack('<H', size) for color, size in brushes)
+        self.write(StrokeLog.BRUSH, data + StrokeLog.pack_points(points))
+
+    def brush_end(self):
+        self.write(StrokeLog.BRUSH_END)
+
+    def circle(self, color, center, radius):
+        self.write(StrokeLog.CIRCLE, self.pack_color(color) + struct.pack('<Hhh', radius, *center))
+
+    def polygon(self, color, points, width=0):
+        if not len(points):
+            return
+        self.write(StrokeLog.POLYGON, self.pack_color(color) + struct.pack('<H', width) + StrokeLog.pack_points(points))
+
+    def fill(self, color):
+        self.write(StrokeLog.FILL, self.pack_color(color))
+
+    def undo(self, redo=False):
+        self.write(StrokeLog.REDO if redo else StrokeLog.UNDO)
+
+    def commit(self):
+        self.write(StrokeLog.COMMIT)
+
+    def sketch(self, png_data):
+        self.write(StrokeLog.SKETCH, struct.pack('<I', len(png_data)) + png_data)
+
+    def render(self, seed):
+        self.write(StrokeLog.RENDER, struct.pack('<q', seed))
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class StrokeLogReader:
+    """
+        Read a stroke log.
+    """
+
+    def __init__(self, file_path):
+        """
+        :param str file_path: Log file path.
+        """
+
+        with open(file_path, "rb") as f:
+            self.data = f.read()
+
+        magic, version, width, height, self.start = StrokeLog.HEADER.unpack_from(self.data)
+        if magic != StrokeLog.MAGIC or version != StrokeLog.VERSION:
+            raise ValueError(f"Not a stroke log: {file_path}")
+        self.size = (width, height)
+
+    def __iter__(self):
+        """
+            Decode the records. A truncated last record, from an interrupted session, is ignored.
+        :return: Records as ``(time in seconds, opcode, values)``.
+        """
+
+        data = self.data
+        offset = StrokeLog.HEADER.size
+        while offset < len(data):
+            try:
+                opcode, elapsed = StrokeLog.RECORD.unpack_from(data, offset)
+                offset += StrokeLog.RECORD.size
+                values, offset = self.decode(opcode, data, offset)
+            except (struct.error, ValueError, IndexError):
+                return
+            yield elapsed / 1000, opcode, values
+
+    @staticmethod
+    def decode(opcode, data, offset):
+        """
+            Decode the values of a record.
+        :return: The values, and the offset of the next record.
+        """
+
+        if opcode == StrokeLog.BRUSH:
+            count = data[offset]
+            offset += 1
+            brushes = []
+            for _ in range(count):
+                r, g, b, size = struct.unpack_from('<3BH', data, offset)
+                offset += 5
+                brushes.append(((r, g, b), size))
+            points, offset = StrokeLog.unpack_points(data, offset)
+            return (brushes, points), offset
+
+        if opcode == StrokeLog.CIRCLE:
+            r, g, b, radius, x, y = struct.unpack_from('<3BHhh', data, offset)
+            return ((r, g, b), (x, y), radius), offset + 9
+
+        if opcode == StrokeLog.POLYGON:
+            r, g, b, width = struct.unpack_from('<3BH', data, offset)
+            points, offset = StrokeLog.unpack_points(data, offset + 5)
+            return ((r, g, b), points, width), offset
+
+        if opcode == StrokeLog.FILL:
+            return (tuple(data[offset:offset + 3]),), offset + 3
+
+        if opcode == StrokeLog.SKETCH:
+            length, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            if offset + length > len(data):
+                raise ValueError("Truncated sketch")
+            return (data[offset:offset + length],), offset + length
+
+        if opcode == StrokeLog.RENDER:
+            seed, = struct.unpack_from('<q', data, offset)
+            return (seed,), offset + 8
+
+        if opcode in (StrokeLog.BRUSH_END, StrokeLog.UNDO, StrokeLog.REDO, StrokeLog.COMMIT):
+            return (), offset
+
+        raise ValueError(f"Unknown stroke log opcode {opcode}")
@@ -0,0 +1,82 @@
+import collections
+import threading
+import traceback
+
+
+class TaskWorker:
+    """
+        Long-lived worker thread running background tasks one after another, in submission order.
+
+        Replaces a thread per task: the tasks are queued, and the thread count stays bounded whatever the submission
+        rate. The thread is started on the first submission.
+    """
+
+    def __init__(self, name, max_pending=8):
+        """
+        :param str name: Worker thread name.
+        :param int max_pending: Maximum number of queued tasks, the oldest ones being dropped beyond.
+        """
+
+        self.name = name
+        self.condition = threading.Condition()
+        self.tasks = collections.deque(maxlen=max_pending)  # type: collections.deque[tuple[callable, tuple]]
+        self.running = False
+        self.busy = False
+        self.thread = None
+
+    def submit(self, task, *args):
+        """
+            Queue a task.
+        :param callable task: The task, called from the worker thread.
+        :param args: The task arguments.
+        """
+
+        with self.condition:
+            self.tasks.append((task, args))
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def stop(self):
+        """
+            Stop the worker thread, dropping the queued tasks.
+        """
+
+        with self.condition:
+            self.running = False
+            self.tasks.clear()
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """
+            Wait for the queued tasks to complete.
+        :param float|None timeout: Maximum wait time in seconds.
+        :return: ``True`` if the worker is idle.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.tasks and not self.busy, timeout)
+
+    def run(self):
+        """
+            Worker loop.
+        """
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.tasks or not self.running)
+                if not self.running:
+                    return
+                task, args = self.tasks.popleft()
+                self.busy = True
+
+            try:
+                task(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
@@ -0,0 +1,243 @@
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Trace:
+    """
+        Timing of a traced operation, split into spans.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None  # type: float|None
+        self.depth = 0  # nesting level of the running span
+        self.spans = []  # type: list[tuple[str, float, float, int]]
+
+    def add(self, name, start, duration, depth=None):
+        """
+            Add a span.
+        :param str name: Span name.
+        :param float start: Span start, ``time.perf_counter`` value.
+        :param float duration: Span duration in seconds.
+        :param int|None depth: Span nesting level, the current one if not set.
+        """
+
+        self.spans.append((name, start - self.start, duration, self.depth if depth is None else depth))
+
+    def stages(self, depth=None):
+        """
+            Total duration of the spans, by name, in order of first occurrence.
+        :param int|None depth: Keep the spans of this nesting level only.
+        :return: Durations in seconds.
+        """
+
+        stages = {}
+        for name, _, duration, span_depth in sorted(self.spans, key=lambda span: span[1]):
+            if depth is None or span_depth == depth:
+                stages[name] = stages.get(name, 0.0) + duration
+        return stages
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "spans": [
+                {"name": name, "start": start, "duration": duration, "depth": depth}
+                for name, start, duration, depth in self.spans
+            ],
+        }
+
+
+class Span:
+    """
+        Span context manager, adds its duration to the trace.
+    """
+
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self.start
+        self.trace.depth -= 1
+        self.trace.add(self.name, self.start, duration)
+
+
+NULL_SPAN = contextlib.nullcontext()
+END = object()
+
+
+def traced(name):
+    """
+        Method decorator, measure the method calls as spans of the ``tracer`` attribute of the instance.
+    :param str name: Span name.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer:
+    """
+        Lightweight per-stage timing of the renderings.
+
+        A trace is started by the thread running an operation, the spans measured by this thread while the trace is
+        active are added to it. When disabled, or without active trace on the thread, spans are no-op.
+    """
+
+    def __init__(self, enabled=False, max_traces=100, trace_file=None):
+        """
+        :param bool enabled: Record the traces.
+        :param int max_traces: Number of finished traces kept in memory.
+        :param str|None trace_file: JSONL file the finished traces are appended to. Enables the tracer.
+        """
+
+        self.enabled = enabled or bool(trace_file)
+        self.traces = collections.deque(maxlen=max_traces)  # type: collections.deque[Trace]
+        self.subscribers = []  # type: list[callable]
+        self.local = threading.local()
+
+        if trace_file:
+            self.subscribe(TraceFileWriter(trace_file))
+
+    @property
+    def last_trace(self):
+        """
+            Last finished trace, or ``None``.
+        """
+
+        return self.traces[-1] if self.traces else None
+
+    @property
+    def current(self):
+        """
+            Active trace of the current thread, or ``None``.
+        """
+
+        return getattr(self.local, 'trace', None)
+
+    def subscribe(self, callback):
+        """
+            Subscribe to the finished traces.
+        :param callable callback: Called with each finished trace, from the traced thread.
+        :return: The callback.
+        """
+
+        self.subscribers.append(callback)
+        return callback
+
+    @contextlib.contextmanager
+    def trace(self, name, **attributes):
+        """
+            Trace an operation in the current thread.
+        :param str name: Trace name.
+        :param attributes: Trace attributes.
+        :return: The trace, or ``None`` if disabled.
+        """
+
+        if not self.enabled:
+            yield None
+            return
+
+        parent = self.current
+        trace = self.local.trace = Trace(name, **attributes)
+        try:
+            yield trace
+        finally:
+            trace.duration = time.perf_counter() - trace.start
+            self.local.trace = parent
+            self.traces.append(trace)
+            for callback in list(self.subscribers):
+                callback(trace)
+
+    def span(self, name):
+        """
+            Measure a stage of the active trace.
+        :param str name: Span name.
+        :return: The span context manager.
+        """
+
+        trace = self.current if self.enabled else None
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name)
+
+    def record(self, name, duration, start=None):
+        """
+            Add a stage measured elsewhere to the active trace, ending now unless its start is given.
+        :param str name: Span name.
+        :param float duration: Stage duration in seconds.
+        :param float|None start: Stage start, ``time.perf_counter`` value.
+        """
+
+        trace = self.current if self.enabled else None
+        if trace is not None:
+            trace.add(name, time.perf_counter() - duration if start is None else start, duration)
+
+    def iterate(self, name, iterable):
+        """
+            Measure the time spent getting each item of an iterable.
+        :param str name: Span name.
+        :param collections.abc.Iterable iterable: The iterable.
+        :return: The iterable items.
+        """
+
+        trace = self.current if self.enabled else None
+        if trace is None:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            with Span(trace, name):
+                item = next(iterator, END)
+            if item is END:
+                return
+            yield item
+
+
+class TraceFileWriter:
+    """
+        Append the finished traces to a JSONL file, one trace per line.
+    """
+
+    def __init__(self, trace_file):
+        """
+        :param str trace_file: The JSONL file.
+        """
+
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+
+        trace_dir = os.path.dirname(trace_file)
+        if trace_dir and not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+
+    def __call__(self, trace):
+        line = json.dumps(trace.to_dict(), default=str) + '\n'
+        with self.lock:
+            with open(self.trace_file, "a") as f:
+                f.write(line)
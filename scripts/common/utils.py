@@ -1,10 +1,9 @@
+import contextlib
 import copy
-import functools
 import os
 import random
 import re
 import shutil
-import threading
 import base64
 import io
 import json
@@ -15,6 +14,43 @@ from PIL import Image
 from psd_tools import PSDImage
 
 
+class StartupTimer:
+    """
+        Measure the startup steps duration.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = {}  # type: dict[str, float]
+        self.details = {}  # type: dict[str, float]
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """
+            Measure a startup step.
+        :param str name: The step name.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self):
+        """
+            Startup timing report.
+        :return: The report text.
+        """
+
+        lines = [f"Startup in {time.perf_counter() - self.start:.2f}s"]
+        for name, duration in self.steps.items():
+            lines.append(f"  {name:<30} {duration:.3f}s")
+        for name, duration in self.details.items():
+            lines.append(f"    {name:<28} {duration:.3f}s")
+        return '\n'.join(lines)
+
+
 def load_config(config_file):
     """
         Load a configuration file, update the local configuration file with missing settings
@@ -158,19 +194,14 @@ def save_preset(state, preset_type, index):
     return {"preset_type": preset_type, "index": index}
 
 
-def update_size_thread(state, **kwargs):
+def target_size(state, hr_scale=None):
     """
-        Update interface threaded method.
-
-        If a rendering is in progress, wait before resizing.
+        Compute the interface geometry, according to image width & height, and HR scale if enabled.
     :param State state: Application state.
-    :param kwargs: Accepted override parameter: ``hr_scale``
+    :param float|None hr_scale: HR scale override, the current one if not set.
+    :return: The ``soft_upscale``, ``render_size``, ``width`` and ``height`` render values.
     """
 
-    while state.server["busy"]:
-        # Wait for rendering to end
-        time.sleep(0.25)
-
     interface_width = state.configuration["config"].get('interface_width', state.render["init_width"] * (1 if state.img2img else 2))
     interface_height = state.configuration["config"].get('interface_height', state.render["init_height"])
 
@@ -181,34 +212,37 @@ def update_size_thread(state, **kwargs):
         else:
             interface_height = math.floor(interface_width * ratio)
 
-    state.render["soft_upscale"] = 1.0
+    soft_upscale = 1.0
     if interface_width != state.render["init_width"] * (1 if state.img2img else 2) or interface_height != state.render["init_height"]:
-        state.render["soft_upscale"] = min(state.configuration["config"]['interface_width'] / state.render["init_width"], state.configuration["config"]['interface_height'] / state.render["init_height"])
+        soft_upscale = min(state.configuration["config"]['interface_width'] / state.render["init_width"], state.configuration["config"]['interface_height'] / state.render["init_height"])
 
-    if kwargs.get('hr_scale', None) is not None:
-        hr_scale = kwargs.get('hr_scale')
-    else:
+    if hr_scale is None:
         hr_scale = state.render["hr_scale"]
 
-    state.render["soft_upscale"] = state.render["soft_upscale"] / hr_scale
-    state.render["width"] = math.floor(state.render["init_width"] * hr_scale)
-    state.render["height"] = math.floor(state.render["init_height"] * hr_scale)
+    soft_upscale = soft_upscale / hr_scale
+    render_size = (math.floor(state.render["init_width"] * hr_scale), math.floor(state.render["init_height"] * hr_scale))
 
-    state.render["render_size"] = (state.render["width"], state.render["height"])
-
-    state.render["width"] = math.floor(state.render["width"] * state.render["soft_upscale"])
-    state.render["height"] = math.floor(state.render["height"] * state.render["soft_upscale"])
+    return {
+        "soft_upscale": soft_upscale,
+        "render_size": render_size,
+        "width": math.floor(render_size[0] * soft_upscale),
+        "height": math.floor(render_size[1] * soft_upscale),
+    }
 
 
 def update_size(state, **kwargs):
     """
-        Update the interface scale, according to image width & height, and HR scale if enabled.
+        Update the interface scale, according to image width & height, and HR scale if enabled. The geometry values
+        are updated at once. While rendering, the views defer the update until the rendering completes.
     :param State state: Application state.
     :param kwargs: Accepted override parameter: ``hr_scale``
+    :return: The new geometry.
     """
 
-    t = threading.Thread(target=functools.partial(update_size_thread, state, **kwargs))
-    t.start()
+    geometry = target_size(state, hr_scale=kwargs.get('hr_scale', None))
+    with state.lock:
+        state.render.update(geometry)
+    return geometry
 
 
 def new_random_seed(state):
@@ -226,7 +260,7 @@ def payload_submit(state, image_string):
     """
         Fill the payload to be sent to the API.
         Set ``state.main_json_data`` variable.
-    :param State state: Application state.
+    :param State|StateSnapshot state: Application state, or the rendering settings snapshot.
     :param str image_string: Image data as Base64 encoded string.
     """
 
@@ -288,7 +322,7 @@ def payload_submit(state, image_string):
 def get_img2img_json(state):
     """
        Construct img2img JSON payload.
-    :param State state: Application state.
+    :param State|StateSnapshot state: Application state, or the rendering settings snapshot.
     :return: JSON payload.
     """
 
@@ -0,0 +1,129 @@
+import threading
+import traceback
+
+
+class WebuiConfigMonitor:
+    """
+        Background-refreshed snapshot of the webui configuration.
+
+        The ``sdapi/v1/options`` configuration is fetched from a background thread, periodically and on demand, so the
+        views never wait for the API. Subscribers are notified when the loaded checkpoint or VAE changes.
+    """
+
+    WATCHED_FIELDS = ('checkpoint', 'vae')
+
+    def __init__(self, state, api, interval=30.0):
+        """
+        :param State state: Application state.
+        :param Api api: API connector.
+        :param float interval: Refresh interval in seconds.
+        """
+
+        self.state = state
+        self.api = api
+        self.interval = interval
+
+        self.subscribers = []  # type: list[callable]
+        self.refreshes = 0
+        self.running = False
+        self.wake_event = threading.Event()
+        self.thread = None
+
+    @property
+    def snapshot(self):
+        """
+            Last known webui configuration.
+        """
+
+        return self.state.configuration["webui_config"]
+
+    def subscribe(self, callback):
+        """
+            Subscribe to checkpoint and VAE changes.
+        :param callable callback: Called with the changed fields ``{field: (old value, new value)}``, from the monitor
+            thread.
+        :return: The callback.
+        """
+
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        """
+            Unsubscribe from changes.
+        :param callable callback: The subscribed callback.
+        """
+
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def start(self):
+        """
+            Start the monitor thread.
+        """
+
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="WebuiConfigMonitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stop the monitor thread.
+        """
+
+        self.running = False
+        self.wake_event.set()
+
+    def refresh(self):
+        """
+            Request a refresh of the configuration, without waiting for it.
+        """
+
+        self.wake_event.set()
+
+    def update(self):
+        """
+            Fetch the configuration, update the application state and notify the changes.
+        """
+
+        webui_config = self.api.fetch_configuration()
+        self.refreshes += 1
+        if not webui_config:
+            # keep the last known configuration if the API is unavailable
+            return
+
+        previous = {field: self.state.render[field] for field in WebuiConfigMonitor.WATCHED_FIELDS}
+        self.state.update_webui_config(webui_config)
+
+        changes = {
+            field: (previous[field], self.state.render[field])
+            for field in WebuiConfigMonitor.WATCHED_FIELDS
+            if previous[field] != self.state.render[field]
+        }
+        if not changes:
+            return
+
+        for callback in list(self.subscribers):
+            try:
+                callback(changes)
+            except Exception:
+                traceback.print_exc()
+
+    def run(self):
+        """
+            Monitor loop.
+        """
+
+        while self.running:
+            self.wake_event.wait(self.interval)
+            self.wake_event.clear()
+            if self.running:
+                self.update()
+
+
+# Type hinting imports:
+# from .state import State
+# from .cn_requests import Api
@@ -0,0 +1,214 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+# headless pygame, set before pygame is imported
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+import pygame.gfxdraw
+
+from scripts.tools.latency_benchmark import summarize
+from scripts.views.PygameBrush import BrushEngine
+from scripts.views.PygameSketch import SketchTracker
+
+
+def generate_events(rate=1000, duration=2.0, size=512, speed=4.0, seed=0):
+    """
+        Pen positions sampled at a fixed rate, along a wobbly Lissajous path.
+    :param int rate: Input rate, in events per second.
+    :param float duration: Stroke duration in seconds.
+    :param int size: Canvas size.
+    :param float speed: Path speed, the maximum speed is about ``speed * size * 1.2`` pixels per second.
+    :param int seed: Random seed.
+    :return: Event times and positions, ``[t, x, y]``.
+    """
+
+    rand = random.Random(seed)
+    phase = rand.random() * math.pi
+    events = []
+    for i in range(int(rate * duration)):
+        t = i / rate
+        x = size / 2 + size * 0.4 * math.sin(2 * speed * t + phase) + rand.uniform(-0.5, 0.5)
+        y = size / 2 + size * 0.4 * math.sin(3 * speed * t) + rand.uniform(-0.5, 0.5)
+        events.append([t, round(x), round(y)])
+    return events
+
+
+class LegacyBrush:
+    """
+        Previous brush: one shape drawn per motion event.
+    """
+
+    def __init__(self, canvas_changed):
+        """
+        :param callable canvas_changed: Called with each modified area.
+        """
+
+        self.canvas_changed = canvas_changed
+        self.prev_pos = None
+        self.prev_pos2 = None
+
+    @staticmethod
+    def get_angle(pos1, pos2):
+        rads = math.atan2(-(pos1[1] - pos2[1]), pos1[0] - pos2[0]) % (2 * math.pi)
+        return rads, math.degrees(rads), math.cos(rads), math.sin(rads)
+
+    def draw(self, surface, positions, color, size):
+        for pos in positions:
+            if self.prev_pos is None or (abs(pos[0] - self.prev_pos[0]) < size // 4 and abs(pos[1] - self.prev_pos[1]) < size // 4):
+                self.canvas_changed(pygame.draw.circle(surface, color, pos, size))
+            elif not self.prev_pos2 or size < 4:
+                self.canvas_changed(pygame.draw.polygon(surface, color, [self.prev_pos, pos], size * 2))
+            else:
+                angle_prev = self.get_angle(self.prev_pos, self.prev_pos2)
+                angle = self.get_angle(pos, self.prev_pos)
+                offset_prev = (size * angle_prev[3], size * angle_prev[2])
+                offset = (size * angle[3], size * angle[2])
+                points = [
+                    (self.prev_pos2[0] - offset_prev[0], self.prev_pos2[1] - offset_prev[1]),
+                    (self.prev_pos[0] - offset[0], self.prev_pos[1] - offset[1]),
+                    (pos[0] - offset[0], pos[1] - offset[1]),
+                    (pos[0] + offset[0], pos[1] + offset[1]),
+                    (self.prev_pos[0] + offset[0], self.prev_pos[1] + offset[1]),
+                    (self.prev_pos2[0] + offset_prev[0], self.prev_pos2[1] + offset_prev[1])
+                ]
+                pygame.gfxdraw.filled_polygon(surface, points, color)
+                xs, ys = [p[0] for p in points], [p[1] for p in points]
+                self.canvas_changed(pygame.Rect(min(xs) - 1, min(ys) - 1, max(xs) - min(xs) + 3, max(ys) - min(ys) + 3))
+            self.prev_pos2 = self.prev_pos
+            self.prev_pos = pos
+
+
+class EngineBrush:
+    """
+        Brush engine: the positions of a frame are smoothed and rasterized at once.
+    """
+
+    def __init__(self, canvas_changed):
+        """
+        :param callable canvas_changed: Called with each modified area.
+        """
+
+        self.canvas_changed = canvas_changed
+        self.engine = BrushEngine()
+
+    def draw(self, surface, positions, color, size):
+        for pos in positions:
+            self.engine.add(pos)
+        samples = self.engine.take(size)
+        if samples is not None:
+            area = self.engine.rasterize(surface, samples, color, size)
+            if area is not None:
+                self.canvas_changed(area)
+
+
+def replay(events, brush_class, size=512, brush_size=4, fps=120):
+    """
+        Replay the events in real time, drawing the received events and restoring the changed screen areas once per
+        frame like the main loop.
+    :param list events: Event times and positions.
+    :param type brush_class: The brush, ``LegacyBrush`` or ``EngineBrush``.
+    :param int size: Canvas size.
+    :param int brush_size: Brush radius.
+    :param int fps: Maximum frame rate.
+    :return: The results.
+    """
+
+    surface = pygame.Surface((size, size))
+    surface.fill((255, 255, 255))
+    screen = surface.copy()
+
+    # change tracking of the view, called with each modified area
+    tracker = SketchTracker()
+    tracker.reset(surface.get_rect())
+    dirty_rects = []
+
+    def canvas_changed(rect):
+        tracker.mark(rect)
+        dirty_rects.append(pygame.Rect(rect))
+
+    brush = brush_class(canvas_changed)
+    latencies = []
+    busy = 0.0
+    frames = 0
+    index = 0
+    updated_rects = 0
+
+    start = time.perf_counter()
+    while index < len(events):
+        frame_start = time.perf_counter()
+        now = frame_start - start
+
+        # events received since the last frame, drawn as ink visible at the end of the frame
+        received = index
+        while received < len(events) and events[received][0] <= now:
+            received += 1
+        if received > index:
+            brush.draw(surface, [(x, y) for _, x, y in events[index:received]], (0, 0, 0), brush_size)
+            for rect in dirty_rects:
+                screen.blit(surface, rect, rect)
+            updated_rects += len(dirty_rects)
+            dirty_rects.clear()
+            frame_end = time.perf_counter()
+            busy += frame_end - frame_start
+            latencies.extend(frame_end - start - t for t, _, _ in events[index:received])
+            index = received
+            frames += 1
+
+        # frame rate limit
+        remaining = 1 / fps - (time.perf_counter() - frame_start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    ink = pygame.mask.from_threshold(screen, (0, 0, 0), (1, 1, 1, 255)).count()
+    return {
+        "frames": frames,
+        "busy_ms": round(busy * 1000, 3),
+        "events_per_second": round(len(events) / busy) if busy else None,
+        "updated_rects": updated_rects,
+        "latency": summarize(latencies),
+        "ink_pixels": ink,
+    }
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Brush input-to-ink benchmark, replaying a pen stroke.")
+    argParser.add_argument("--rate", help="input events per second", type=int, default=1000)
+    argParser.add_argument("--duration", help="stroke duration in seconds", type=float, default=2.0)
+    argParser.add_argument("--speed", help="pen speed factor of the generated stroke", type=float, default=4.0)
+    argParser.add_argument("--brush-size", help="brush radius", type=int, default=4)
+    argParser.add_argument("--fps", help="maximum frame rate", type=int, default=120)
+    argParser.add_argument("--seed", help="random seed of the generated stroke", type=int, default=0)
+    argParser.add_argument("--input", help="replay the events of this JSON file instead of a generated stroke", default=None)
+    argParser.add_argument("--record", help="save the replayed events to this JSON file", default=None)
+    argParser.add_argument("--output", help="JSON results file, printed if not set", default=None)
+
+    args = argParser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as f:
+            replay_events = json.load(f)
+    else:
+        replay_events = generate_events(args.rate, args.duration, speed=args.speed, seed=args.seed)
+    if args.record:
+        with open(args.record, "w") as f:
+            json.dump(replay_events, f)
+
+    pygame.init()
+    results = {
+        "events": len(replay_events),
+        "settings": {"rate": args.rate, "speed": args.speed, "brush_size": args.brush_size, "fps": args.fps, "input": args.input},
+        "legacy": replay(replay_events, LegacyBrush, brush_size=args.brush_size, fps=args.fps),
+        "engine": replay(replay_events, EngineBrush, brush_size=args.brush_size, fps=args.fps),
+    }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
@@ -0,0 +1,465 @@
+import argparse
+import base64
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageChops, ImageOps
+
+
+class FakeBackend:
+    """
+        Stand-in for a SD webui backend with the ControlNet extension, for offline benchmarking and tests.
+
+        Renderings return deterministic images of the requested size and batch: a color and noise pattern derived from
+        the seed and prompt, blended with the ControlNet sketch. Renderings are queued like on a single GPU, their
+        duration is configurable, and their progress follows a configurable curve. Errors and dropped connections can
+        be injected on the rendering endpoints.
+    """
+
+    PROGRESS_CURVES = ('linear', 'ease', 'steps')
+
+    SAMPLERS = ["Euler a", "Euler", "DPM++ 2M Karras", "DPM++ SDE Karras", "LCM"]
+    UPSCALERS = ["None", "Lanczos", "Nearest", "Latent", "R-ESRGAN 4x+"]
+    CONTROLNET_MODELS = [
+        "control_v11p_sd15_scribble [d4ba51ff]",
+        "control_v11p_sd15_lineart [43d4be0d]",
+        "control_v11p_sd15_canny [d14c016b]",
+    ]
+    CONTROLNET_MODULES = ["none", "invert", "lineart", "lineart_anime", "scribble_hed", "scribble_xdog", "canny", "mlsd"]
+
+    def __init__(self, latency=1.0, step_time=0.0, jitter=0.0, progress_curve='linear', noise=32, failure_rate=0.0,
+                 failure_status=500, drop_rate=0.0, seed=None):
+        """
+        :param float latency: Fixed duration of a rendering in seconds.
+        :param float step_time: Additional duration per sampling step and image, in seconds.
+        :param float jitter: Random duration added to each rendering, from 0 to ``jitter`` seconds.
+        :param str progress_curve: Progress curve. ``[linear, ease, steps]``
+        :param int noise: Noise amplitude of the rendered images, from 0 (flat colors) to 255.
+        :param float failure_rate: Probability of an error response on the rendering endpoints.
+        :param int failure_status: HTTP status code of the injected errors.
+        :param float drop_rate: Probability of closing the connection without response on the rendering endpoints.
+        :param int|None seed: Random seed of the injected latency and failures.
+        """
+
+        self.latency = latency
+        self.step_time = step_time
+        self.jitter = jitter
+        self.progress_curve = progress_curve if progress_curve in FakeBackend.PROGRESS_CURVES else 'linear'
+        self.noise = max(0, min(255, noise))
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        self.options = {
+            "sd_model_checkpoint": "fake_model.safetensors [0123456789]",
+            "sd_vae": "Automatic",
+            "CLIP_stop_at_last_layers": 1,
+        }
+
+        self.gpu_lock = threading.Lock()  # one rendering at a time
+        self.lock = threading.Lock()
+        self.job_count = 0
+        self.job = None  # type: dict|None
+        self.interrupted = threading.Event()
+        self.skipped = threading.Event()
+        self.stats = {"requests": 0, "renders": 0, "failures": 0, "drops": 0, "interrupts": 0}
+
+    # Failure injection
+
+    def inject_failure(self):
+        """
+            Draw the injected failure of a rendering request.
+        :return: ``drop``, ``error`` or ``None``.
+        """
+
+        with self.lock:
+            draw = self.random.random()
+            if draw < self.drop_rate:
+                self.stats["drops"] += 1
+                return 'drop'
+            if draw < self.drop_rate + self.failure_rate:
+                self.stats["failures"] += 1
+                return 'error'
+            return None
+
+    # Rendering
+
+    def render_duration(self, steps, images):
+        """
+            Duration of a rendering.
+        :param int steps: Sampling steps.
+        :param int images: Number of rendered images.
+        :return: The duration in seconds.
+        """
+
+        with self.lock:
+            jitter = self.random.uniform(0, self.jitter) if self.jitter else 0.0
+        return self.latency + self.step_time * steps * images + jitter
+
+    def run_job(self, name, steps, images):
+        """
+            Simulate a rendering job: wait in the queue, then until the rendering duration is elapsed, or the job is
+            interrupted.
+        :param str name: Job name.
+        :param int steps: Sampling steps.
+        :param int images: Number of rendered images.
+        """
+
+        with self.lock:
+            self.job_count += 1
+
+        try:
+            with self.gpu_lock:
+                duration = self.render_duration(steps, images)
+                with self.lock:
+                    self.interrupted.clear()
+                    self.skipped.clear()
+                    self.job = {"name": name, "start": time.time(), "duration": duration, "steps": steps}
+
+                end = time.time() + duration
+                while not self.interrupted.is_set() and not self.skipped.is_set():
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self.interrupted.wait(min(remaining, 0.05))
+
+                with self.lock:
+                    self.job = None
+                    self.stats["renders"] += 1
+        finally:
+            with self.lock:
+                self.job_count -= 1
+
+    def progress(self):
+        """
+            Current rendering progress, as returned by ``sdapi/v1/progress``.
+        :return: The progress JSON.
+        """
+
+        with self.lock:
+            job = self.job
+            job_count = self.job_count
+
+        progress = 0.0
+        eta = 0.0
+        step = 0
+        steps = 0
+        if job is not None:
+            elapsed = time.time() - job["start"]
+            ratio = min(1.0, elapsed / job["duration"]) if job["duration"] > 0 else 1.0
+            steps = job["steps"]
+            step = min(steps, int(ratio * steps))
+            if self.progress_curve == 'ease':
+                progress = ratio * ratio * (3 - 2 * ratio)
+            elif self.progress_curve == 'steps':
+                progress = step / steps if steps else ratio
+            else:
+                progress = ratio
+            eta = max(0.0, job["duration"] - elapsed)
+
+        return {
+            "progress": progress,
+            "eta_relative": eta,
+            "state": {
+                "skipped": self.skipped.is_set(),
+                "interrupted": self.interrupted.is_set(),
+                "job": job["name"] if job is not None else "",
+                "job_count": job_count,
+                "job_timestamp": time.strftime("%Y%m%d%H%M%S"),
+                "job_no": 0,
+                "sampling_step": step,
+                "sampling_steps": steps,
+            },
+            "current_image": None,
+            "textinfo": None,
+        }
+
+    def interrupt(self):
+        with self.lock:
+            self.stats["interrupts"] += 1
+        self.interrupted.set()
+
+    def skip(self):
+        self.skipped.set()
+
+    # Images
+
+    @staticmethod
+    def decode_image(data):
+        """
+            Decode a base64 image of the payload.
+        :param str|None data: Base64 encoded image, with an optional data URL header.
+        :return: The RGB image, or ``None``.
+        """
+
+        if not data:
+            return None
+        if ',' in data[:64]:
+            data = data[data.index(',') + 1:]
+        try:
+            return Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB')
+        except (ValueError, OSError):
+            return None
+
+    @staticmethod
+    def encode_image(image):
+        data = io.BytesIO()
+        image.save(data, format="png", compress_level=1)
+        return base64.b64encode(data.getvalue()).decode('utf-8')
+
+    def render_image(self, width, height, seed, prompt, sketch=None):
+        """
+            Deterministic rendered image.
+        :param int width: Image width.
+        :param int height: Image height.
+        :param int seed: Image seed.
+        :param str prompt: Prompt.
+        :param Image.Image|None sketch: ControlNet sketch, black strokes on white, multiplied with the image.
+        :return: The RGB image.
+        """
+
+        digest = hashlib.sha256(f"{seed}|{prompt}".encode('utf-8')).digest()
+        image = Image.new('RGB', (width, height), tuple(64 + value // 2 for value in digest[:3]))
+
+        if self.noise:
+            noise = Image.frombytes('L', (width, height), random.Random(digest).randbytes(width * height))
+            noise = ImageOps.colorize(noise, (0, 0, 0), tuple(digest[3:6]))
+            image = Image.blend(image, noise, self.noise / 255)
+
+        if sketch is not None:
+            image = ImageChops.multiply(image, sketch.resize((width, height)))
+
+        return image
+
+    def txt2img(self, payload, init_image=None):
+        """
+            Render the images of a ``sdapi/v1/txt2img`` or ``sdapi/v1/img2img`` payload.
+        :param dict payload: The API payload.
+        :param Image.Image|None init_image: The img2img source image.
+        :return: The API response JSON.
+        """
+
+        width = int(payload.get('width', 512))
+        height = int(payload.get('height', 512))
+        hr = str(payload.get('enable_hr', 'false')).lower() == 'true'
+        if hr:
+            hr_scale = float(payload.get('hr_scale', 2.0))
+            width = int(width * hr_scale)
+            height = int(height * hr_scale)
+
+        batch_size = int(payload.get('batch_size', 1))
+        n_iter = int(payload.get('n_iter', 1))
+        steps = int(payload.get('steps', 20))
+        seed = int(payload.get('seed', -1))
+        if seed == -1:
+            seed = random.randint(0, 2**32 - 1)
+        prompt = payload.get('prompt', '')
+
+        units = (payload.get('alwayson_scripts', {}).get('controlnet', {}) or {}).get('args', None)
+        if units is None:
+            units = payload.get('controlnet_units', [])
+        sketches = [self.decode_image(unit.get('input_image', unit.get('image', None))) for unit in units]
+        sketch = next((s for s in sketches if s is not None), None)
+        if init_image is not None:
+            sketch = init_image if sketch is None else ImageChops.multiply(init_image.resize(sketch.size), sketch)
+
+        self.run_job(payload.get('script_name', None) or 'txt2img', steps + (steps if hr else 0), batch_size * n_iter)
+
+        seeds = [seed + i for i in range(batch_size * n_iter)]
+        images = [self.encode_image(self.render_image(width, height, s, prompt, sketch)) for s in seeds]
+
+        # ControlNet appends its input maps after the rendered images, twice with the hires fix
+        for unit_sketch in sketches:
+            if unit_sketch is not None:
+                images.extend([self.encode_image(unit_sketch)] * (2 if hr else 1))
+
+        info = {
+            "prompt": prompt,
+            "all_prompts": [prompt] * len(seeds),
+            "negative_prompt": payload.get('negative_prompt', ''),
+            "seed": seed,
+            "all_seeds": seeds,
+            "width": width,
+            "height": height,
+            "sampler_name": payload.get('sampler_name', None),
+            "steps": steps,
+            "cfg_scale": payload.get('cfg_scale', 7),
+            "batch_size": batch_size,
+            "sd_model_name": self.options["sd_model_checkpoint"],
+        }
+        return {"images": images, "parameters": payload, "info": json.dumps(info)}
+
+    def img2img(self, payload):
+        init_images = [self.decode_image(image) for image in payload.get('init_images', [])]
+        return self.txt2img(payload, init_image=init_images[0] if init_images else None)
+
+    def detect(self, payload):
+        """
+            ControlNet detection: the input images, inverted to white lines on black like the lineart detectors.
+        :param dict payload: The API payload.
+        :return: The API response JSON.
+        """
+
+        self.run_job('detect', 1, 1)
+
+        images = []
+        for data in payload.get('controlnet_input_images', []):
+            image = self.decode_image(data)
+            if image is not None:
+                images.append(self.encode_image(ImageOps.invert(ImageOps.grayscale(image)).convert('RGB')))
+        return {"images": images, "info": "Success"}
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    """
+        HTTP handler of the fake backend.
+    """
+
+    backend = None  # type: FakeBackend
+    quiet = True
+    protocol_version = "HTTP/1.1"
+
+    RENDERING_ENDPOINTS = ('/sdapi/v1/txt2img', '/sdapi/v1/img2img', '/controlnet/detect')
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, content, status=200):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        backend = self.backend
+        with backend.lock:
+            backend.stats["requests"] += 1
+
+        if path == '/sdapi/v1/progress':
+            self.send_json(backend.progress())
+        elif path == '/sdapi/v1/options':
+            self.send_json(backend.options)
+        elif path == '/sdapi/v1/samplers':
+            self.send_json([{"name": name, "aliases": [], "options": {}} for name in FakeBackend.SAMPLERS])
+        elif path == '/sdapi/v1/upscalers':
+            self.send_json([{"name": name, "model_name": None, "scale": 4} for name in FakeBackend.UPSCALERS])
+        elif path == '/controlnet/model_list':
+            self.send_json({"model_list": FakeBackend.CONTROLNET_MODELS})
+        elif path == '/controlnet/module_list':
+            self.send_json({"module_list": FakeBackend.CONTROLNET_MODULES})
+        elif path == '/internal/sysinfo':
+            self.send_json({"Version": "v0.0.0-fake"})
+        elif path == '/fake/stats':
+            self.send_json(backend.stats)
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        backend = self.backend
+        with backend.lock:
+            backend.stats["requests"] += 1
+
+        payload = self.read_json()
+        if payload is None:
+            self.send_json({"detail": "Invalid JSON"}, status=422)
+            return
+
+        if path in FakeBackendHandler.RENDERING_ENDPOINTS:
+            failure = backend.inject_failure()
+            if failure == 'drop':
+                self.close_connection = True
+                return
+            elif failure == 'error':
+                self.send_json({"error": "RuntimeError", "detail": "Injected failure"}, status=backend.failure_status)
+                return
+
+        if path == '/sdapi/v1/txt2img':
+            self.send_json(backend.txt2img(payload))
+        elif path == '/sdapi/v1/img2img':
+            self.send_json(backend.img2img(payload))
+        elif path == '/controlnet/detect':
+            self.send_json(backend.detect(payload))
+        elif path == '/sdapi/v1/options':
+            backend.options.update(payload)
+            self.send_json(None)
+        elif path == '/sdapi/v1/interrupt':
+            backend.interrupt()
+            self.send_json(None)
+        elif path == '/sdapi/v1/skip':
+            backend.skip()
+            self.send_json(None)
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+
+def serve(backend, host="127.0.0.1", port=7861, quiet=True):
+    """
+        Create the fake backend HTTP server.
+    :param FakeBackend backend: The fake backend.
+    :param str host: Listening address.
+    :param int port: Listening port, ``0`` for a free port.
+    :param bool quiet: Do not log the requests.
+    :return: The server, call its ``serve_forever`` method to run it.
+    """
+
+    handler = type('Handler', (FakeBackendHandler,), {"backend": backend, "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Fake SD webui backend, for offline benchmarking and tests.")
+    argParser.add_argument("--host", help="listening address", default="127.0.0.1")
+    argParser.add_argument("--port", help="listening port", type=int, default=7861)
+    argParser.add_argument("--latency", help="rendering duration in seconds", type=float, default=1.0)
+    argParser.add_argument("--step-time", help="additional duration per step and image in seconds", type=float, default=0.0)
+    argParser.add_argument("--jitter", help="maximum random duration added to each rendering", type=float, default=0.0)
+    argParser.add_argument("--progress-curve", help="progress curve", choices=FakeBackend.PROGRESS_CURVES, default='linear')
+    argParser.add_argument("--noise", help="noise amplitude of the rendered images, 0-255", type=int, default=32)
+    argParser.add_argument("--failure-rate", help="probability of an error response on renderings", type=float, default=0.0)
+    argParser.add_argument("--failure-status", help="HTTP status of the injected errors", type=int, default=500)
+    argParser.add_argument("--drop-rate", help="probability of a dropped connection on renderings", type=float, default=0.0)
+    argParser.add_argument("--seed", help="random seed of the injected latency and failures", type=int, default=None)
+    argParser.add_argument("--verbose", help="log the requests", action="store_true")
+
+    args = argParser.parse_args()
+
+    fake_backend = FakeBackend(
+        latency=args.latency,
+        step_time=args.step_time,
+        jitter=args.jitter,
+        progress_curve=args.progress_curve,
+        noise=args.noise,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+        drop_rate=args.drop_rate,
+        seed=args.seed
+    )
+    http_server = serve(fake_backend, args.host, args.port, quiet=not args.verbose)
+    print(f"Fake SD webui backend listening on http://{args.host}:{http_server.server_address[1]}")
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
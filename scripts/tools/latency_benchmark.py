@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# headless pygame, set before pygame is imported
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+from scripts.tools.fake_backend import FakeBackend, serve
+from scripts.views.PygameView import PygameView
+
+
+STAGES = ('debounce', 'diff', 'encode', 'payload', 'convert', 'cache', 'http', 'receive', 'decode', 'load', 'scale', 'tile_decode', 'tile_load', 'tile_scale', 'blit', 'autosave', 'save_sketch', 'present')
+
+
+def percentile(values, ratio):
+    """
+        Nearest-rank percentile.
+    :param list[float] values: Sorted values.
+    :param float ratio: Percentile, from 0 to 1.
+    :return: The percentile value.
+    """
+
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(ratio * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarize(values):
+    """
+        Latency distribution summary, in milliseconds.
+    :param list[float] values: Durations in seconds.
+    :return: Count, mean, p50, p95, p99 and max.
+    """
+
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LatencyBenchmark:
+    """
+        Stroke-to-pixels latency benchmark.
+
+        Drives a headless ``PygameView`` with scripted strokes against an in-process fake backend. Each stroke goes
+        through the real rendering path, traced per stage: debounce wait, sketch encoding, payload building, HTTP
+        request, base64 decoding, surface loading, scaling and blit, and the display of the result by the main loop.
+    """
+
+    def __init__(self, view, renders=20, stroke_points=20, timeout=30.0, seed=0):
+        """
+        :param PygameView view: The view, not started.
+        :param int renders: Number of measured renderings.
+        :param int stroke_points: Mouse motion events per stroke.
+        :param float timeout: Maximum wait for a rendering, in seconds.
+        :param int seed: Random seed of the strokes.
+        """
+
+        self.view = view
+        self.renders = renders
+        self.stroke_points = stroke_points
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        self.samples = []  # type: list[dict]
+        self.errors = 0
+        self.trace_done = threading.Event()
+        self.presented = threading.Event()
+        self.last_trace = None
+        self.present_time = None
+
+        view.tracer.enabled = True
+        view.tracer.subscribe(self.on_trace)
+
+        # measure the display of the rendered image by the main loop
+        for name in ('flip', 'update'):
+            setattr(pygame.display, name, self.wrap_display(getattr(pygame.display, name)))
+
+    def wrap_display(self, display_function):
+        def wrapper(*args, **kwargs):
+            result = display_function(*args, **kwargs)
+            if self.trace_done.is_set() and not self.presented.is_set():
+                self.present_time = time.perf_counter()
+                self.presented.set()
+            return result
+        return wrapper
+
+    def on_trace(self, trace):
+        self.last_trace = trace
+        self.trace_done.set()
+
+    def post_stroke(self):
+        """
+            Post a random brush stroke on the sketch.
+        """
+
+        width = self.view.state.render["width"]
+        height = self.view.state.render["height"]
+        x, y = width + self.random.randrange(width), self.random.randrange(height)
+
+        pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=(x, y)))
+        for _ in range(self.stroke_points):
+            dx, dy = self.random.randint(-8, 8), self.random.randint(-8, 8)
+            x = min(2 * width - 1, max(width, x + dx))
+            y = min(height - 1, max(0, y + dy))
+            pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=(x, y), rel=(dx, dy), buttons=(1, 0, 0)))
+            time.sleep(0.002)
+        pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, button=1, pos=(x, y)))
+
+    def drive(self):
+        """
+            Benchmark driver thread: one stroke at a time, wait for its rendering to be displayed.
+        """
+
+        try:
+            # let the main loop start, and the first frames be displayed
+            time.sleep(1.0)
+
+            for _ in range(self.renders):
+                self.view.scheduler.wait_idle(self.timeout)
+                self.trace_done.clear()
+                self.presented.clear()
+
+                self.post_stroke()
+                stroke_end = time.perf_counter()
+
+                if not self.trace_done.wait(self.timeout) or not self.presented.wait(self.timeout):
+                    self.errors += 1
+                    continue
+
+                trace = self.last_trace
+                stages = trace.stages()
+                stages['present'] = self.present_time - (trace.start + trace.duration)
+                self.samples.append({
+                    "stages": stages,
+                    "render": trace.duration,
+                    "end_to_end": self.present_time - stroke_end,
+                })
+        finally:
+            pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+    def run(self):
+        """
+            Run the benchmark.
+        :return: The results.
+        """
+
+        driver = threading.Thread(target=self.drive, name="BenchmarkDriver", daemon=True)
+        driver.start()
+        self.view.main()
+        driver.join()
+
+        return {
+            "samples": len(self.samples),
+            "errors": self.errors,
+            "stages": {
+                stage: summarize([sample["stages"][stage] for sample in self.samples if stage in sample["stages"]])
+                for stage in STAGES
+            },
+            "render": summarize([sample["render"] for sample in self.samples]),
+            "end_to_end": summarize([sample["end_to_end"] for sample in self.samples]),
+        }
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Stroke-to-pixels latency benchmark, against a fake backend.")
+    argParser.add_argument("--renders", help="number of measured renderings", type=int, default=20)
+    argParser.add_argument("--stroke-points", help="mouse motion events per stroke", type=int, default=20)
+    argParser.add_argument("--latency", help="fake backend rendering duration in seconds", type=float, default=0.2)
+    argParser.add_argument("--noise", help="noise amplitude of the fake rendered images, 0-255", type=int, default=32)
+    argParser.add_argument("--batch-size", help="batch size", type=int, default=1)
+    argParser.add_argument("--stream", help="stream the responses", choices=['true', 'false'], default=None)
+    argParser.add_argument("--autosave", help="autosave the rendered images", action="store_true")
+    argParser.add_argument("--seed", help="random seed of the strokes", type=int, default=0)
+    argParser.add_argument("--output", help="JSON results file, printed if not set", default=None)
+
+    args = argParser.parse_args()
+
+    fake_backend = FakeBackend(latency=args.latency, noise=args.noise, seed=args.seed)
+    http_server = serve(fake_backend, port=0)
+    threading.Thread(target=http_server.serve_forever, name="FakeBackend", daemon=True).start()
+
+    view = PygameView(False, url=f"http://127.0.0.1:{http_server.server_address[1]}")
+    view.state.render["batch_size"] = args.batch_size
+    view.state.autosave["images"] = args.autosave
+    view.api.cache.enabled = False
+    if args.stream is not None:
+        view.stream_responses = args.stream == 'true'
+
+    benchmark = LatencyBenchmark(view, renders=args.renders, stroke_points=args.stroke_points, seed=args.seed)
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "settings": {
+            "renders": args.renders,
+            "latency": args.latency,
+            "noise": args.noise,
+            "batch_size": args.batch_size,
+            "stream": view.stream_responses,
+            "autosave": args.autosave,
+            "size": (view.state.render["width"], view.state.render["height"]),
+            "render_wait": view.render_wait,
+        },
+    }
+    results.update(benchmark.run())
+    http_server.shutdown()
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    sys.exit(1 if results["errors"] else 0)
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+# headless pygame, set before pygame is imported
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+from PIL import Image, ImageOps
+
+from scripts.common.sketch_encoder import SketchEncoder
+from scripts.views.PygameSketch import SketchBuffer
+
+
+def draw_sketch(surface, rect, strokes=50, seed=0):
+    """
+        Draw random black strokes on white.
+    :param pygame.Surface surface: The canvas.
+    :param pygame.Rect rect: The sketch area.
+    :param int strokes: Number of strokes.
+    :param int seed: Random seed.
+    """
+
+    rand = random.Random(seed)
+    surface.fill((255, 255, 255), rect)
+    for _ in range(strokes):
+        points = [(rect.left + rand.randrange(rect.width), rect.top + rand.randrange(rect.height)) for _ in range(4)]
+        pygame.draw.lines(surface, (0, 0, 0), False, points, rand.randint(1, 6))
+
+
+def legacy_extract(surface, rect, invert=True):
+    """
+        Previous extraction path: subsurface bytes, PIL image, PIL inversion.
+    :return: The image.
+    """
+
+    pil_img = Image.frombytes('RGB', rect.size, pygame.image.tostring(surface.subsurface(rect), 'RGB'))
+    if invert:
+        return ImageOps.invert(pil_img)
+    return pil_img
+
+
+def measure(function, repeat):
+    """
+        Measure a function.
+    :return: Median and minimum durations in milliseconds, and the last result.
+    """
+
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return round(statistics.median(durations) * 1000, 3), round(min(durations) * 1000, 3), result
+
+
+def benchmark(size, repeat=20, encode=True):
+    """
+        Compare the extraction paths of a square sketch.
+    :param int size: Sketch width and height.
+    :param int repeat: Measures per path.
+    :param bool encode: Also measure the extraction followed by the PNG encoding.
+    :return: The results.
+    """
+
+    canvas = pygame.Surface((size * 2, size))
+    rect = pygame.Rect(size, 0, size, size)
+    draw_sketch(canvas, rect)
+
+    sketch_buffer = SketchBuffer()
+    encoder = SketchEncoder()
+
+    legacy_median, legacy_min, legacy_image = measure(lambda: legacy_extract(canvas, rect), repeat)
+    buffer_median, buffer_min, pixels = measure(lambda: sketch_buffer.extract(canvas, rect, invert=True), repeat)
+    array = sketch_buffer.array
+
+    results = {
+        "size": size,
+        "frame_bytes": size * size * 3,
+        "identical": legacy_image.tobytes() == pixels.tobytes(),
+        "legacy": {"median_ms": legacy_median, "min_ms": legacy_min},
+        "buffer": {
+            "median_ms": buffer_median,
+            "min_ms": buffer_min,
+            "buffer_reused": sketch_buffer.array is array,
+        },
+    }
+
+    if encode:
+        results["legacy"]["encode_median_ms"] = measure(lambda: encoder.encode(legacy_extract(canvas, rect, invert=False), invert=True), repeat)[0]
+        results["buffer"]["encode_median_ms"] = measure(lambda: encoder.encode_array(sketch_buffer.extract(canvas, rect, invert=True)), repeat)[0]
+
+    return results
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Sketch extraction micro-benchmark.")
+    argParser.add_argument("--sizes", help="sketch sizes", type=int, nargs='+', default=[512, 1024, 2048])
+    argParser.add_argument("--repeat", help="measures per path and size", type=int, default=20)
+    argParser.add_argument("--no-encode", help="do not measure the PNG encoding", action="store_true")
+    argParser.add_argument("--output", help="JSON results file, printed if not set", default=None)
+
+    args = argParser.parse_args()
+
+    pygame.init()
+    output = json.dumps([benchmark(size, args.repeat, not args.no_encode) for size in args.sizes], indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
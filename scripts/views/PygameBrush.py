@@ -0,0 +1,126 @@
+import numpy as np
+import pygame
+
+
+class BrushEngine:
+    """
+        Brush strokes drawn once per frame from the coalesced motion events.
+
+        The positions received since the last frame are smoothed by a Catmull-Rom spline, evaluated with NumPy for all
+        the segments at once and sampled every ``spacing`` brush radius. A disk stamp is drawn at each sample with a
+        single batched blit: one drawing call per frame, whatever the input rate.
+    """
+
+    def __init__(self, spacing=0.25):
+        """
+        :param float spacing: Maximum distance between two spline samples, relative to the brush radius.
+        """
+
+        self.spacing = spacing
+        self.context = []  # type: list[tuple[float, float]]
+        self.pending = []  # type: list[tuple[float, float]]
+        self.stamps = {}  # type: dict[tuple, pygame.Surface]
+        self.events = 0
+        self.frames = 0
+
+    def add(self, pos):
+        """
+            Add a brush position.
+        :param tuple[int]|list[int] pos: The position.
+        """
+
+        if self.pending and tuple(pos) == self.pending[-1]:
+            return
+        self.pending.append(tuple(pos))
+        self.events += 1
+
+    def reset(self):
+        """
+            End the stroke.
+        """
+
+        self.context = []
+        self.pending = []
+
+    def take(self, radius):
+        """
+            Smoothed path of the pending positions, continuing the already drawn path.
+        :param int|float radius: Brush radius, sets the sampling distance.
+        :return: The ``(n, 2)`` path samples, ``None`` if there is nothing to draw.
+        """
+
+        if not self.pending:
+            return None
+
+        points = self.context + self.pending
+        self.frames += 1
+        if len(points) == 1:
+            # stroke start, a single dot
+            self.context = points
+            self.pending = []
+            return np.array(points, dtype=np.float64)
+
+        first = len(self.context) - 1 if self.context else 0
+        controls = np.array([points[0]] + points + [points[-1]], dtype=np.float64)
+        step = max(1.0, radius * self.spacing)
+
+        # control points of the new segments, from the last drawn position
+        segments = len(points) - 1 - first
+        p0, p1, p2, p3 = (controls[first + i:first + i + segments] for i in range(4))
+
+        # all the segments sampled at once: each segment repeated by its number of samples
+        counts = np.maximum(1, np.ceil(np.hypot(*(p2 - p1).T) / step)).astype(int)
+        index = np.repeat(np.arange(segments), counts)
+        t = ((np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts) + 1) / counts[index])[:, None]
+        p0, p1, p2, p3 = p0[index], p1[index], p2[index], p3[index]
+        curve = 0.5 * (2 * p1 + (p2 - p0) * t + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t * t + (3 * p1 - p0 - 3 * p2 + p3) * t * t * t)
+
+        self.context = points[-2:]
+        self.pending = []
+        return np.concatenate([controls[first + 1:first + 2], curve])
+
+    def stamp(self, surface, color, radius):
+        """
+            Brush stamp, a color keyed disk in the format of the target surface.
+        :param pygame.Surface surface: The target surface.
+        :param tuple color: Brush color.
+        :param int radius: Brush radius.
+        :return: The stamp surface.
+        """
+
+        key = (tuple(color), radius, surface.get_bitsize())
+        stamp = self.stamps.get(key, None)
+        if stamp is None:
+            background = tuple(255 - c for c in color[:3])
+            stamp = pygame.Surface((radius * 2 + 1, radius * 2 + 1), 0, surface)
+            stamp.fill(background)
+            pygame.draw.circle(stamp, color, (radius, radius), radius)
+            stamp.set_colorkey(background, pygame.RLEACCEL)
+            self.stamps[key] = stamp
+        return stamp
+
+    def rasterize(self, surface, samples, color, radius):
+        """
+            Draw a path with a round brush, the stamps of all the samples in a single batched blit.
+        :param pygame.Surface surface: The target surface.
+        :param np.ndarray samples: The ``(n, 2)`` path samples.
+        :param tuple color: Brush color.
+        :param int|float radius: Brush radius.
+        :return: The modified area, ``None`` if outside the surface.
+        """
+
+        radius = max(1, int(radius))
+        positions = np.rint(samples).astype(int)
+        if len(positions) > 1:
+            # samples rounded to the same pixel
+            positions = positions[np.concatenate(([True], np.any(positions[1:] != positions[:-1], axis=1)))]
+
+        left, top = positions.min(axis=0) - radius
+        right, bottom = positions.max(axis=0) + radius + 1
+        area = pygame.Rect(int(left), int(top), int(right - left), int(bottom - top)).clip(surface.get_rect())
+        if not area.width or not area.height:
+            return None
+
+        stamp = self.stamp(surface, color, radius)
+        surface.blits([(stamp, (x, y)) for x, y in (positions - radius).tolist()], doreturn=False)
+        return area
@@ -0,0 +1,125 @@
+import base64
+import concurrent.futures
+import io
+import os
+import threading
+import time
+
+import pygame
+from PIL import Image
+
+
+class DecodedTile:
+    """
+        Batch image decoded and downsampled to its tile size.
+    """
+
+    __slots__ = ('index', 'data', 'surface', 'start', 'timings')
+
+    def __init__(self, index, data, surface, start, timings):
+        """
+        :param int index: Image index in the batch.
+        :param bytes data: Image file data.
+        :param pygame.Surface surface: Tile surface.
+        :param float start: Decoding start, ``time.perf_counter`` value.
+        :param dict[str, float] timings: Decoding stages durations in seconds.
+        """
+
+        self.index = index
+        self.data = data
+        self.surface = surface
+        self.start = start
+        self.timings = timings
+
+    @property
+    def duration(self):
+        return sum(self.timings.values())
+
+
+class TileDecoder:
+    """
+        Parallel decoding of the batch images, off the thread receiving them.
+
+        Each image is decoded and downsampled to its tile size by a pool of worker threads, PIL releasing the GIL while
+        decoding and resampling. JPEG images are decoded at a reduced DCT scale with ``draft``, and images at least
+        twice as large as their tile are first reduced by box averaging with ``reduce``, so most of the pixels are never
+        resampled. The tiles are returned as soon as they are decoded, in completion order.
+    """
+
+    def __init__(self, workers=None):
+        """
+        :param int|None workers: Number of decoding threads, up to 4 by default.
+        """
+
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.executor = None  # type: concurrent.futures.ThreadPoolExecutor|None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+            Start the worker threads, on first use.
+        :return: The executor.
+        """
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="TileDecoder")
+            return self.executor
+
+    @staticmethod
+    def decode(index, image_data, size):
+        """
+            Decode an image to a tile surface.
+        :param int index: Image index in the batch.
+        :param str|bytes image_data: Image data, if ``str`` type : base64 encoded from API response.
+        :param tuple[int, int] size: Tile size.
+        :return: The decoded tile.
+        """
+
+        timings = {}
+        start = time.perf_counter()
+
+        if isinstance(image_data, str):
+            image_data = base64.b64decode(image_data)
+        now = time.perf_counter()
+        timings["decode"], mark = now - start, now
+
+        image = Image.open(io.BytesIO(image_data))
+        image.draft('RGB', size)
+        image.load()
+        now = time.perf_counter()
+        timings["load"], mark = now - mark, now
+
+        factor = min(image.width // size[0], image.height // size[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.BILINEAR)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        surface = pygame.image.frombytes(image.tobytes(), image.size, 'RGB')
+        timings["scale"] = time.perf_counter() - mark
+
+        return DecodedTile(index, image_data, surface, start, timings)
+
+    def map(self, image_datas, size):
+        """
+            Decode images in parallel, as they are received.
+        :param collections.abc.Iterable[str]|collections.abc.Iterable[bytes] image_datas: Images data, if ``str`` type : base64 encoded from API response.
+        :param tuple[int, int] size: Tiles size.
+        :return: The decoded tiles, in completion order.
+        """
+
+        executor = self.start()
+        pending = set()
+        for index, image_data in enumerate(image_datas):
+            pending.add(executor.submit(self.decode, index, image_data, size))
+
+            # tiles decoded while receiving the next images
+            done = {future for future in pending if future.done()}
+            pending -= done
+            for future in done:
+                yield future.result()
+
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
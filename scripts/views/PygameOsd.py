@@ -0,0 +1,136 @@
+import collections
+
+import pygame
+
+
+class OsdTextCache:
+    """
+        Rendered OSD text lines, with their outline, kept in a least recently used cache.
+    """
+
+    def __init__(self, max_size=256):
+        """
+        :param int max_size: Maximum number of cached lines.
+        """
+
+        self.max_size = max_size
+        self.surfaces = collections.OrderedDict()  # type: collections.OrderedDict[tuple, pygame.Surface]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, font, text, color, shadow_color, distance):
+        """
+            Outlined text surface.
+        :param pygame.font.Font font: The font.
+        :param str text: The text.
+        :param tuple|int color: Text color.
+        :param tuple|int shadow_color: Outline color.
+        :param int distance: Outline size.
+        :return: The surface, the text being offset by ``distance`` from the top left corner.
+        """
+
+        key = (id(font), text, color, shadow_color, distance)
+        surface = self.surfaces.get(key, None)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        shadow_surface = font.render(text, True, shadow_color)
+        text_surface = font.render(text, True, color)
+
+        surface = pygame.Surface((text_surface.get_width() + distance * 2, text_surface.get_height() + distance * 2), pygame.SRCALPHA)
+        for dx, dy in ((1, 1), (-1, 1), (1, -1), (-1, -1)):
+            surface.blit(shadow_surface, (distance + dx * distance, distance + dy * distance))
+        surface.blit(text_surface, (distance, distance))
+
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+class OsdLayer:
+    """
+        Persistent transparent overlay of the OSD, composed again only when its content changes.
+    """
+
+    def __init__(self, font, text_cache=None):
+        """
+        :param pygame.font.Font font: Text font.
+        :param OsdTextCache|None text_cache: Rendered text cache.
+        """
+
+        self.font = font
+        self.text_cache = text_cache if text_cache is not None else OsdTextCache()
+        self.surface = None  # type: pygame.Surface|None
+        self.areas = []  # type: list[pygame.Rect]
+        self.bounds = None  # type: pygame.Rect|None
+        self.content = None
+        self.compositions = 0
+
+    def update(self, size, content, compose):
+        """
+            Compose the overlay if its content changed.
+        :param tuple[int] size: Overlay size, the screen size.
+        :param content: Comparable description of the overlay content.
+        :param callable compose: Draws the overlay content, called with the layer.
+        :return: ``True`` if the overlay was composed.
+        """
+
+        if self.surface is None or self.surface.get_size() != tuple(size):
+            self.surface = pygame.Surface(size, pygame.SRCALPHA)
+            self.areas = []
+            self.bounds = None
+            self.content = None
+
+        if content == self.content:
+            return False
+
+        if self.bounds is not None:
+            self.surface.fill((0, 0, 0, 0), self.bounds)
+        self.areas = []
+        self.content = content
+        compose(self)
+        self.bounds = self.areas[0].unionall(self.areas[1:]) if self.areas else None
+        self.compositions += 1
+        return True
+
+    def blit(self, surface, pos):
+        """
+            Draw a surface on the overlay.
+        :param pygame.Surface surface: The surface.
+        :param tuple[int]|pygame.Rect pos: Position.
+        :return: The drawn area.
+        """
+
+        area = self.surface.blit(surface, pos)
+        self.areas.append(area)
+        return area
+
+    def text(self, text, pos, color=(255, 255, 255), shadow_color=(0, 0, 0), distance=1, right_align=False):
+        """
+            Draw outlined text on the overlay.
+        :param str text: The text.
+        :param tuple[int]|list[int]|pygame.Rect pos: Text position, the top right corner if right aligned.
+        :param tuple|int color: Text color.
+        :param tuple|int shadow_color: Outline color.
+        :param int distance: Outline size.
+        :param bool right_align: Align text to the right.
+        :return: The drawn area.
+        """
+
+        surface = self.text_cache.get(self.font, text, color, shadow_color, distance)
+        left = pos[0] - (surface.get_width() - distance * 2 if right_align else 0)
+        return self.blit(surface, (left - distance, pos[1] - distance))
+
+    def draw(self, screen):
+        """
+            Draw the overlay on the screen. Only the drawn areas of the overlay are blitted, cheaper than its bounds
+            for sparse text.
+        :param pygame.Surface screen: The screen.
+        :return: The drawn areas.
+        """
+
+        return [screen.blit(self.surface, area, area) for area in self.areas]
@@ -0,0 +1,263 @@
+import sys
+import threading
+import zlib
+
+import numpy as np
+import pygame
+
+
+class SketchBuffer:
+    """
+        Reusable pixel buffer between Pygame surfaces, the sketch encoder and PIL images.
+
+        The canvas pixels are copied once, as whole 32 bits words through a ``pygame.surfarray`` view, into a NumPy
+        array allocated once per size, and inverted in place if needed. The encoder gets an RGB view of the buffer.
+
+        The returned array is only valid until the next extraction: use one buffer per thread.
+    """
+
+    def __init__(self):
+        self.array = None  # type: np.ndarray|None
+
+    def buffer(self, width, height, channels=3):
+        """
+            Get the reusable array, reallocated if the size changed.
+        :param int width: Image width.
+        :param int height: Image height.
+        :param int channels: Bytes per pixel.
+        :return: The ``(height, width, channels)`` array.
+        """
+
+        if self.array is None or self.array.shape != (height, width, channels):
+            self.array = np.empty((height, width, channels), dtype=np.uint8)
+        return self.array
+
+    @staticmethod
+    def rgb_view(array, surface):
+        """
+            RGB channels of a 32 bits pixels array.
+        :param np.ndarray array: The ``(height, width, 4)`` pixels of the surface format.
+        :param pygame.Surface surface: The surface.
+        :return: The ``(height, width, 3)`` RGB array, a view if the channels are evenly spaced.
+        """
+
+        offsets = [shift // 8 for shift in surface.get_shifts()[:3]]
+        if sys.byteorder == 'big':
+            offsets = [3 - offset for offset in offsets]
+
+        red, green, blue = offsets
+        step = green - red
+        if step and blue - green == step:
+            stop = blue + step
+            return array[:, :, red:stop if stop >= 0 else None:step]
+        return array[:, :, offsets]
+
+    def extract(self, surface, rect, invert=False):
+        """
+            Extract the RGB pixels of a surface area.
+        :param pygame.Surface surface: The surface.
+        :param pygame.Rect rect: The area.
+        :param bool invert: Invert the colors.
+        :return: The ``(height, width, 3)`` pixels array, a view of the reusable buffer.
+        """
+
+        if surface.get_bytesize() != 4:
+            array = self.buffer(rect.width, rect.height)
+            pixels = pygame.surfarray.pixels3d(surface)
+            try:
+                np.copyto(array, pixels[rect.left:rect.right, rect.top:rect.bottom].transpose(1, 0, 2))
+            finally:
+                del pixels
+            if invert:
+                np.invert(array, out=array)
+            return array
+
+        array = self.buffer(rect.width, rect.height, 4)
+        words = array.view(np.uint32).reshape(rect.height, rect.width)
+
+        # column-major view of the surface pixels, the surface is locked while the view exists
+        pixels = pygame.surfarray.pixels2d(surface)
+        try:
+            np.copyto(words, pixels[rect.left:rect.right, rect.top:rect.bottom].T)
+        finally:
+            del pixels
+        if invert:
+            np.invert(words, out=words)
+
+        return self.rgb_view(array, surface)
+
+    def blit_image(self, image, surface, pos, invert=False):
+        """
+            Draw a PIL image on a surface.
+        :param Image.Image image: The image.
+        :param pygame.Surface surface: The target surface.
+        :param tuple[int] pos: Target position.
+        :param bool invert: Invert the colors.
+        """
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # the PIL array export is a copy, inverted or copied into the buffer
+        array = self.buffer(image.width, image.height, 4)
+        if invert:
+            np.subtract(255, np.asarray(image), out=array[:, :, :3])
+        else:
+            np.copyto(array[:, :, :3], np.asarray(image))
+
+        # surface sharing the buffer memory, copied to the target by the blit
+        surface.blit(pygame.image.frombuffer(array, image.size, 'RGBX'), pos)
+
+
+class SketchTracker:
+    """
+        Incremental change detection of the sketch, since the last rendered version.
+
+        The drawing code marks the areas it modified. On check, the tiles covered by these dirty areas are hashed, and
+        the pixels of the tiles whose hash changed are compared to the reference: the pixels of the last rendered sketch.
+        The tiles of a single color are tracked, to detect a blank sketch without reading it.
+        Checking and committing run in the render thread, marking in the main thread.
+    """
+
+    def __init__(self, tile_size=64):
+        """
+        :param int tile_size: Hashed tiles width and height.
+        """
+
+        self.tile_size = tile_size
+        self.area = None  # type: pygame.Rect|None
+        self.dirty = None  # type: pygame.Rect|None
+        self.reference = None  # type: np.ndarray|None
+        self.tile_hashes = {}  # type: dict[tuple[int, int], int]
+        self.tile_colors = {}  # type: dict[tuple[int, int], int|None]
+        self.pending = None  # type: tuple[pygame.Rect, np.ndarray, dict, dict]|None
+        self.lock = threading.Lock()
+
+    def reset(self, area):
+        """
+            Track a new sketch area, without reference.
+        :param pygame.Rect area: The sketch area of the canvas.
+        """
+
+        with self.lock:
+            self.area = pygame.Rect(area)
+            self.dirty = pygame.Rect(area)
+            self.reference = None
+            self.tile_hashes = {}
+            self.tile_colors = {}
+            self.pending = None
+
+    def mark(self, rect=None):
+        """
+            Mark a modified area of the canvas.
+        :param pygame.Rect|tuple|None rect: The area, the whole sketch if not set.
+        """
+
+        with self.lock:
+            if self.area is None:
+                return
+            rect = self.area.clip(rect) if rect is not None else pygame.Rect(self.area)
+            if rect.width and rect.height:
+                self.dirty = self.dirty.union(rect) if self.dirty else rect
+
+    def tiles(self, rect):
+        """
+            Tiles covering an area.
+        :param pygame.Rect rect: The area, in sketch coordinates.
+        :return: The tile indices and areas, in sketch coordinates.
+        """
+
+        size = self.tile_size
+        for ty in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for tx in range(rect.left // size, (rect.right - 1) // size + 1):
+                yield (tx, ty), pygame.Rect(tx * size, ty * size, size, size).clip(0, 0, self.area.width, self.area.height)
+
+    def changes(self, surface, area):
+        """
+            Count the sketch pixels changed since the last commit. Must be followed by ``commit`` or ``discard``.
+        :param pygame.Surface surface: The canvas, locked by the caller against concurrent blits.
+        :param pygame.Rect area: The current sketch area of the canvas.
+        :return: Number of changed pixels, all the sketch pixels if there is no reference.
+        """
+
+        if area != self.area:
+            self.reset(area)
+
+        with self.lock:
+            dirty, self.dirty = self.dirty, None
+        if dirty is None:
+            self.pending = None
+            return 0
+
+        # dirty area in sketch coordinates, extended to the tiles
+        dirty = dirty.move(-self.area.left, -self.area.top)
+        size = self.tile_size
+        left, top = dirty.left // size * size, dirty.top // size * size
+        right = min(-(-dirty.right // size) * size, self.area.width)
+        bottom = min(-(-dirty.bottom // size) * size, self.area.height)
+        local = pygame.Rect(left, top, right - left, bottom - top)
+
+        pixels = pygame.surfarray.pixels2d(surface)
+        try:
+            current = pixels[self.area.left + local.left:self.area.left + local.right, local.top:local.bottom].T.copy()
+        finally:
+            del pixels
+
+        hashes = {}
+        colors = {}
+        changed = 0
+        for index, tile in self.tiles(local):
+            tile_pixels = current[tile.top - local.top:tile.bottom - local.top, tile.left - local.left:tile.right - local.left]
+            tile_hash = zlib.crc32(np.ascontiguousarray(tile_pixels))
+            hashes[index] = tile_hash
+            color = tile_pixels[0, 0]
+            colors[index] = int(color) if np.all(tile_pixels == color) else None
+            if self.reference is None:
+                changed += tile_pixels.size
+            elif self.tile_hashes.get(index, None) != tile_hash:
+                changed += int(np.count_nonzero(tile_pixels != self.reference[tile.top:tile.bottom, tile.left:tile.right]))
+
+        self.pending = (local, current, hashes, colors)
+        return changed
+
+    def commit(self):
+        """
+            The checked sketch was rendered, make it the reference.
+        """
+
+        if self.pending is None:
+            return
+
+        local, current, hashes, colors = self.pending
+        if self.reference is None:
+            if local.size != self.area.size:
+                # partial check without reference, the whole sketch is checked next time
+                self.mark()
+                self.pending = None
+                return
+            self.reference = current
+        else:
+            self.reference[local.top:local.bottom, local.left:local.right] = current
+        self.tile_hashes.update(hashes)
+        self.tile_colors.update(colors)
+        self.pending = None
+
+    def blank(self):
+        """
+            The committed sketch is blank: all its pixels have the same color.
+        :return: ``True`` if the sketch is blank.
+        """
+
+        if self.reference is None:
+            return False
+        colors = set(self.tile_colors.values())
+        return len(colors) == 1 and None not in colors
+
+    def discard(self):
+        """
+            The checked sketch was not rendered, keep the dirty area for the next check.
+        """
+
+        if self.pending is not None:
+            self.mark(self.pending[0].move(self.area.left, self.area.top))
+            self.pending = None
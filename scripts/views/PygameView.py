@@ -1,22 +1,34 @@
-import functools
+import collections
 import gc
 import os
 
 import pygame
-import pygame.gfxdraw
+import requests
 import threading
 import base64
 import io
 import json
 import time
 import math
-from PIL import Image, ImageOps
+from PIL import Image
 import tkinter as tk
 from tkinter import filedialog, simpledialog
 from scripts.common.utils import payload_submit, update_config, save_preset, update_size, new_random_seed, ckpt_name
-from scripts.common.cn_requests import Api
+from scripts.common.image_store import ImageBuffer, ImageStore
 from scripts.common.output_files_utils import autosave_image, save_image
+from scripts.common.progress_monitor import ProgressMonitor
+from scripts.common.render_scheduler import RenderScheduler
+from scripts.common.sketch_encoder import SketchEncoder
+from scripts.common.sketch_history import SketchHistory
+from scripts.common.stroke_log import StrokeLog, StrokeLogReader, StrokeLogWriter
 from scripts.common.state import State
+from scripts.common.task_worker import TaskWorker
+from scripts.common.tracing import traced
+from scripts.common.webui_config_monitor import WebuiConfigMonitor
+from scripts.views.PygameBrush import BrushEngine
+from scripts.views.PygameDecode import TileDecoder
+from scripts.views.PygameOsd import OsdLayer
+from scripts.views.PygameSketch import SketchBuffer, SketchTracker
 from sys import platform
 
 # workaround for MacOS as per https://bugs.python.org/issue46573
@@ -71,11 +83,22 @@ class PygameView:
     """
 
     ACCEPTED_FILE_TYPES = ["png", "jpg", "jpeg", "bmp"]
+    MAX_FPS = 120
+    IDLE_TIMEOUT = 1000  # maximum wait for events when nothing is animated, in milliseconds
+    ANIMATION_TIMEOUT = 100  # maximum wait for events while rendering, in milliseconds
 
-    def __init__(self, img2img):
+    def __init__(self, img2img, url=None, stroke_log=None, replay=None, replay_renders=False, replay_speed=1.0):
+        """
+        :param str img2img: img2img source file, empty for the txt2img mode.
+        :param str|None url: Backend URL, overriding the configuration.
+        :param str|None stroke_log: Stroke log file path, overriding the configuration.
+        :param str|None replay: Stroke log file to replay.
+        :param bool replay_renders: Request the renderings of the replayed log, at their recorded times.
+        :param float replay_speed: Replay speed factor, ``0`` to replay without waiting.
+        """
 
-        self.state = State(img2img)
-        self.api = Api(self.state)
+        self.state = State(img2img, url=url)
+        self.api = self.state.api
         if self.state.img2img:
             if not os.path.exists(self.state.img2img):
                 root = tk.Tk()
@@ -91,7 +114,6 @@ class PygameView:
                 self.state.render["init_height"] = self.state.render["height"] * 1.0
                 update_size(self.state)
 
-        self.img2img_waiting = False
         self.img2img_time = None
         self.img2img_time_prev = None
 
@@ -101,31 +123,67 @@ class PygameView:
         self.image_click = False
         self.pause_render = False
         self.osd_always_on_text: str | None = None
+        self.configuration_lines: list[tuple[str, int | bool, str]] = []
+        self.configuration_display: str | None = None
         self.progress = 0.0
         self.need_redraw = False
         self.running = False
 
         self.last_detect_time = time.time()
-        self.osd_text = None
-        self.osd_text_display_start = None
-
-        if not self.state.configuration["config"]['controlnet_models']:
-            self.api.fetch_controlnet_models(self.state)
-
-        # Initialize Pygame
-        pygame.init()
-        self.clock = pygame.time.Clock()
-
-        # Set up the display
-        self.fullscreen = False
-        self.screen = pygame.display.set_mode((self.state.render["width"] * (1 if self.state.img2img else 2), self.state.render["height"]))
-        self.display_caption = "Sd Paint"
-        pygame.display.set_caption(self.display_caption)
-
-        # Setup text
-        self.font = pygame.font.SysFont(None, size=24)
-        self.font_bold = pygame.font.SysFont(None, size=24, bold=True)
-        self.text_input = ""
+        # OSD text message, display time and start, set as one tuple: the OSD is updated from the worker threads
+        self.osd_message: tuple[str, float, float] | None = None
+        self.osd_lock = threading.Lock()
+
+        self.tracer = self.state.tracer
+        self.latency_metric = self.state.metrics.histogram('render_latency_seconds', "Time from the request of a rendering to its display, debounce included.", ('view',))
+        self.tracer.subscribe(self.update_trace_panel)
+        self.tracing = self.tracer.enabled  # tracing enabled by the configuration
+        self.trace_panel = False
+        self.scheduler = RenderScheduler(self.state, self.api, stale_action=self.state.configuration["config"].get('render_stale_action', 'none'))
+        self.progress_monitor = ProgressMonitor(self.state, self.api)
+        self.tasks = TaskWorker("ViewTasks")  # background tasks of the main loop: detections
+        self.progress_monitor.subscribe(self.update_progress)
+        # size changes are coalesced, and applied between renderings
+        self.pending_resize = None  # type: dict|None
+        self.scheduler.subscribe(self.wakeup)
+        self.webui_config_monitor = WebuiConfigMonitor(self.state, self.api, interval=self.state.configuration["config"].get('webui_config_interval', 30))
+        # configuration display changes, applied by the main loop
+        self.pending_configuration_changes = {}  # type: dict[str, tuple]
+        self.configuration_lock = threading.Lock()
+        self.webui_config_monitor.subscribe(self.update_configuration_display)
+
+        with self.state.startup_timer.step("window"):
+            # Initialize Pygame
+            pygame.init()
+            self.clock = pygame.time.Clock()
+
+            # Set up the display
+            self.fullscreen = False
+            self.screen = pygame.display.set_mode((self.state.render["width"] * (1 if self.state.img2img else 2), self.state.render["height"]))
+            self.display_caption = "Sd Paint"
+            pygame.display.set_caption(self.display_caption)
+
+            # Setup text
+            self.font = pygame.font.SysFont(None, size=24)
+            self.font_bold = pygame.font.SysFont(None, size=24, bold=True)
+            self.text_input = ""
+
+            # Screen refresh: the main loop waits for events when idle, and only redraws the changed areas
+            self.wakeup_event = pygame.event.custom_type()
+            self.wakeup_posted = False
+            self.dirty_lock = threading.Lock()
+            self.dirty_rects = []  # type: list[pygame.Rect]
+            self.full_redraw = True
+            self.overlay_rects = []  # type: list[pygame.Rect]
+            self.overlay_state = None
+            self.cursor_surface = None  # type: pygame.Surface|None
+            self.cursor_surface_color = None
+            self.mouse_visible = True
+            self.caption = self.display_caption
+
+            # OSD overlay, composed when its content changes
+            self.osd_layer = OsdLayer(self.font)
+            self.osd_surfaces = {}  # type: dict[tuple, pygame.Surface]
 
         # Set up the drawing surface
         self.canvas = pygame.Surface((self.state.render["width"] * 2, self.state.render["height"]))
@@ -143,8 +201,7 @@ class PygameView:
         self.brush_color = self.brush_colors[1]
         self.brush_pos = {1: None, 2: None, 'e': None}  # type: dict[int|str, tuple[int, int]|None]
         self.button_down = False
-        self.prev_pos = None
-        self.prev_pos2 = None
+        self.brush = BrushEngine()
         self.shift_pos = None
         self.eraser_down = False
         self.erase_zone_down = False
@@ -152,7 +209,48 @@ class PygameView:
         self.zone_pos = []
         self.render_wait = 0.5 if not self.state.img2img else 0.0  # wait time max between 2 draw before launching the render
         self.last_draw_time = time.time()
-        self.last_render_bytes: io.BytesIO | None = None
+        # rendered images data, shared by the displayed image, the batch images and the saved files
+        self.image_store = ImageStore(memory_budget=int(self.state.configuration["config"].get('image_memory_mb', 32)) * 2**20)
+        self.last_render = None  # type: ImageBuffer|None
+        self.state.metrics.gauge('image_store_bytes', "Memory held by the rendered images data.").set_function(lambda: self.image_store.memory_report()["bytes"])
+        self.tile_decoder = TileDecoder(workers=self.state.configuration["config"].get('decode_workers', None))
+        self.tile_decode_metric = self.state.metrics.histogram('batch_tile_decode_seconds', "Batch images decoding and downsampling duration, by image.")
+        self.stream_responses = self.state.configuration["config"].get('stream_responses', 'true') == 'true'
+        # one buffer and encoder per thread: renderings run in the scheduler thread, detections in the tasks thread
+        self.sketch_encoder = self.create_sketch_encoder()
+        self.detect_encoder = self.create_sketch_encoder()
+        self.sketch_buffer = SketchBuffer()
+        self.detect_buffer = SketchBuffer()
+        # the canvas is locked while its pixels are read, and cannot be blitted meanwhile
+        self.canvas_lock = threading.RLock()
+
+        # Sketch change detection, to skip the renderings of an unchanged sketch with unchanged parameters
+        self.sketch_tracker = SketchTracker()
+        self.min_changed_pixels = max(1, int(self.state.configuration["config"].get('render_min_changed_pixels', 1)))
+        self.force_render = False  # render even if nothing changed
+        self.last_sketch = None  # type: tuple[bool, str]|None
+        self.last_payload_key = None  # type: str|None
+        self.skipped_metric = self.state.metrics.counter('renders_skipped_total', "Renderings skipped, the sketch and parameters being unchanged, or the sketch blank.")
+
+        # Undo history of the sketch
+        self.history = SketchHistory(memory_budget=int(self.state.configuration["config"].get('undo_memory_mb', 32)) * 2**20)
+        self.sketch_history(self.history.reset)
+        self.state.metrics.gauge('undo_history_bytes', "Memory used by the saved tiles of the sketch undo history.").set_function(lambda: self.history.memory_report()["tiles_bytes"])
+        self.state.metrics.gauge('undo_history_steps', "Sketch changes that can be undone.").set_function(lambda: self.history.steps[0])
+
+        # Stroke log of the session, and replay of a recorded one
+        self.stroke_log = None  # type: StrokeLogWriter|None
+        if stroke_log is None and self.state.configuration["config"].get('stroke_log', 'false') == 'true' and not replay:
+            os.makedirs(os.path.join("outputs", "strokes"), exist_ok=True)
+            stroke_log = os.path.join("outputs", "strokes", f"{time.strftime('%Y%m%d-%H%M%S')}.strokes")
+        if stroke_log:
+            self.stroke_log = StrokeLogWriter(stroke_log, self.sketch_area().size)
+        self.replay = replay
+        self.replay_renders = replay_renders
+        self.replay_speed = replay_speed
+        self.replay_ops = collections.deque()  # operations read by the replay thread, drawn by the main loop
+        self.replaying = False
+        self.replay_brush = BrushEngine()
 
         # Define the cursor size and color
         self.cursor_size = 1
@@ -162,6 +260,9 @@ class PygameView:
         save_preset(self.state, 'render', 0)
         save_preset(self.state, 'controlnet', 0)
 
+        if self.state.configuration["config"].get('startup_report', 'false') == 'true':
+            print(self.state.startup_timer.report())
+
     def load_preset(self, preset_type, index):
         """
             Load a preset values.
@@ -203,7 +304,7 @@ class PygameView:
                 self.state.control_net[preset_field] = preset[preset_field]
                 text += f"\n  {preset_field[:1].upper()}{preset_field[1:].replace('_', ' ')} :n: {preset[preset_field]}"
 
-        update_size(self.state)
+        self.request_resize()
         return text
 
     def interrupt_rendering(self):
@@ -227,6 +328,60 @@ class PygameView:
         img = pygame.image.load(file_path)
         img = pygame.transform.smoothscale(img, (self.state.render["width"], self.state.render["height"]))
         self.canvas.blit(img, (self.state.render["width"], 0))
+        self.canvas_changed()
+        self.log_sketch()
+
+    def request_resize(self, **kwargs):
+        """
+            Request an update of the interface size. The requests are coalesced, the last one being applied once the
+            in-flight rendering completes, the pending rendering waiting for it.
+        :param kwargs: Accepted override parameter: ``hr_scale``
+        """
+
+        self.pending_resize = kwargs
+        self.scheduler.hold()
+
+    def apply_resize(self):
+        """
+            Apply the requested size update, if no rendering is in flight: compute the new geometry, reallocate the
+            canvas and the screen, then release the pending rendering with the new settings.
+        """
+
+        if self.pending_resize is None or self.scheduler.in_flight:
+            return
+
+        kwargs, self.pending_resize = self.pending_resize, None
+        size = (self.state.render["width"], self.state.render["height"])
+        update_size(self.state, **kwargs)
+        self.resize_canvas(size)
+        self.scheduler.release(args=(self.state.snapshot(),))
+
+    def resize_canvas(self, size):
+        """
+            Reallocate the canvas and the screen once for the current size, rescaling the rendered image and the sketch.
+        :param tuple[int, int] size: Previous width and height.
+        """
+
+        width, height = self.state.render["width"], self.state.render["height"]
+        if (width, height) == tuple(size):
+            return
+
+        width_modificator = 1 if self.state.img2img else 2
+        with self.canvas_lock:
+            canvas = pygame.Surface((width * 2, height))
+            canvas.fill((255, 255, 255), (0, 0, width * width_modificator, height))
+            for area in range(width_modificator):
+                # rendered image, then sketch
+                previous = self.canvas.subsurface((area * size[0], 0, size[0], size[1]))
+                canvas.blit(pygame.transform.smoothscale(previous, (width, height)), (area * width, 0))
+            self.canvas = canvas
+
+        if not self.fullscreen:
+            self.screen = pygame.display.set_mode((width * width_modificator, height))
+        self.brush.reset()
+        self.canvas_changed()
+        self.sketch_history(self.history.reset)
+        self.log_sketch()
 
     def finger_pos(self, finger_x, finger_y):
         """
@@ -250,10 +405,13 @@ class PygameView:
         file_path = filedialog.asksaveasfilename(defaultextension=".png")
 
         if file_path:
-            save_image(file_path, self.last_render_bytes)
+            last_render = self.last_render
+            if last_render is not None:
+                save_image(file_path, last_render.view())
             self.save_sketch(file_path)
             time.sleep(1)  # add a 1-second delay
 
+    @traced("save_sketch")
     def save_sketch(self, file_path):
         """
             Save sketch canvas to a file.
@@ -278,93 +436,115 @@ class PygameView:
         if extension in PygameView.ACCEPTED_FILE_TYPES:
             self.load_filepath_into_canvas(file_path)
 
-    def update_image(self, image_data):
+    @traced("update_image")
+    def update_image(self, image_data, state=None):
         """
             Redraw the image canvas.
-        :param str|bytes image_data: Base64 encoded image data, from API response.
+        :param str|bytes|ImageBuffer image_data: Base64 encoded image data, from API response, or stored image data.
+        :param StateSnapshot|None state: Settings of the rendering, the current ones if not set.
         """
 
+        state = state or self.state
+
         # Decode base64 image data
         if isinstance(image_data, str):
-            image_data = base64.b64decode(image_data)
+            with self.tracer.span("decode"):
+                image_data = base64.b64decode(image_data)
+
+        if isinstance(image_data, ImageBuffer):
+            image = image_data.acquire()
+        else:
+            image = self.image_store.add(image_data, self.image_store.begin_render())
 
-        img_bytes = io.BytesIO(image_data)
-        img_surface = pygame.image.load(img_bytes)
+        with self.tracer.span("load"):
+            img_surface = pygame.image.load(io.BytesIO(image.read()))
 
-        if self.state.autosave["images"]:
-            file_name = autosave_image(self.state, io.BytesIO(image_data))
+        if state.autosave["images"]:
+            with self.tracer.span("autosave"):
+                file_name = autosave_image(state, image.view())
             self.save_sketch(file_name)
-        self.last_render_bytes = io.BytesIO(image_data)  # store rendered image in memory
+        self.set_last_render(image)
 
-        if self.state.render["soft_upscale"] != 1.0:
-            width = img_surface.get_width() * self.state.render["soft_upscale"]
-            height = img_surface.get_height() * self.state.render["soft_upscale"]
-            img_surface = pygame.transform.smoothscale(img_surface, (width, height))
+        if state.render["soft_upscale"] != 1.0:
+            width = img_surface.get_width() * state.render["soft_upscale"]
+            height = img_surface.get_height() * state.render["soft_upscale"]
+            with self.tracer.span("scale"):
+                img_surface = pygame.transform.smoothscale(img_surface, (width, height))
 
-        self.canvas.blit(img_surface, (0, 0))
-        self.need_redraw = True
+        with self.tracer.span("blit"), self.canvas_lock:
+            self.canvas_changed(self.canvas.blit(img_surface, (0, 0)))
 
-    def update_batch_images(self, image_datas):
+    def set_last_render(self, image):
         """
-            Redraw the image canvas with multiple images.
-        :param list[str]|list[bytes] image_datas: Images data, if ``str`` type : base64 encoded from API response.
+            Keep the last rendered image data, for the file save.
+        :param ImageBuffer image: The image data, its reference being taken over.
         """
 
-        # Close old batch images
+        previous, self.last_render = self.last_render, image
+        if previous is not None:
+            previous.release()
+
+    @traced("update_batch_images")
+    def update_batch_images(self, image_datas, count=None, state=None):
+        """
+            Redraw the image canvas with multiple images. Each image is displayed as soon as it is available.
+        :param collections.abc.Iterable[str]|collections.abc.Iterable[bytes] image_datas: Images data, if ``str`` type : base64 encoded from API response.
+        :param int|None count: Number of images, if ``image_datas`` is not a list.
+        :param StateSnapshot|None state: Settings of the rendering, the current ones if not set.
+        """
+
+        state = state or self.state
+
+        # Release old batch images
         if len(self.state.render["batch_images"]):
             for batch_image in self.state.render["batch_images"]:
-                image_bytes = batch_image.get('image', None)
-                if isinstance(image_bytes, io.BytesIO):
-                    image_bytes.close()
+                image = batch_image.get('image', None)
+                if image is not None:
+                    image.release()
 
             self.state.render["batch_images"] = []
 
+        nb = math.ceil(math.sqrt(count if count is not None else len(image_datas)))
+        size = (state.render["width"] // nb, state.render["height"] // nb)
+        seed = state.gen_settings["seed"]
+        render = self.image_store.begin_render()
         to_autosave = []
-        nb = math.ceil(math.sqrt(len(image_datas)))
-        i, j, batch_index = 0, 0, 1
-        for image_data in image_datas:
-            pos = (i * self.state.render["width"] // nb, j * self.state.render["height"] // nb)
 
-            # Decode base64 image data
-            if isinstance(image_data, str):
-                image_data = base64.b64decode(image_data)
+        # the images are decoded in parallel, each one displayed as soon as decoded
+        for tile in self.tile_decoder.map(image_datas, size):
+            start = tile.start
+            for stage, duration in tile.timings.items():
+                self.tracer.record(f"tile_{stage}", duration, start=start)
+                start += duration
+            self.tile_decode_metric.observe(tile.duration)
 
-            img_bytes = io.BytesIO(image_data)
-            img_surface = pygame.image.load(img_bytes)
+            i, j = tile.index % nb, tile.index // nb
+            pos = (i * state.render["width"] // nb, j * state.render["height"] // nb)
 
-            if (i, j) == (0, 0):
+            image = self.image_store.add(tile.data, render)
+            if tile.index == 0:
                 # store first rendered image in memory
-                self.last_render_bytes = io.BytesIO(image_data)
+                self.set_last_render(image.acquire())
 
-            if self.state.render["soft_upscale"] != 1.0:
-                width = img_surface.get_width() * self.state.render["soft_upscale"] // nb
-                height = img_surface.get_height() * self.state.render["soft_upscale"] // nb
-                img_surface = pygame.transform.smoothscale(img_surface, (width, height))
-
-            if self.state.autosave["images"]:
-                to_autosave.append(io.BytesIO(image_data))
+            if state.autosave["images"]:
+                to_autosave.append((tile.index, image.view()))
 
             self.state.render["batch_images"].append({
-                "seed": self.state.gen_settings["seed"] + batch_index - 1,
-                "image": io.BytesIO(image_data),
-                "coord": (pos[0], pos[1], img_surface.get_width(), img_surface.get_height())
+                "seed": seed + tile.index,
+                "image": image,
+                "coord": (pos[0], pos[1], tile.surface.get_width(), tile.surface.get_height())
             })
 
-            self.canvas.blit(img_surface, pos)
-
-            # increase indices
-            i = (i + 1) % nb
-            if i == 0:
-                j = (j + 1) % nb
-            batch_index += 1
+            with self.tracer.span("blit"), self.canvas_lock:
+                self.canvas_changed(self.canvas.blit(tile.surface, pos))
 
+        to_autosave = [image for _, image in sorted(to_autosave, key=lambda item: item[0])]
         if to_autosave:
-            file_names = autosave_image(self.state, to_autosave)
+            with self.tracer.span("autosave"):
+                file_names = autosave_image(state, to_autosave)
             for file_name in file_names:
                 self.save_sketch(file_name)
 
-        self.need_redraw = True
-
     def select_batch_image(self, pos):
         """
             Select a batch image by clicking on it.
@@ -382,7 +562,7 @@ class PygameView:
                 self.osd(text_time=f"Select batch image seed {batch_image['seed']}")
 
                 if batch_image.get('image', None):
-                    self.update_image(batch_image['image'].getbuffer().tobytes())
+                    self.update_image(batch_image['image'])
 
                 self.state.gen_settings["seed"] = batch_image['seed']
 
@@ -390,86 +570,167 @@ class PygameView:
 
                 break
 
-    def img2img_submit(self, force=False):
+    def img2img_submit(self, state=None):
         """
-            Read the ``img2img`` file if modified since last render, check every 1s. Call the API to render if needed.
-        :param bool force: Force the rendering, even if the file is not modified.
+            Call the API to render the ``img2img`` source file. Run by the render scheduler.
+        :param StateSnapshot|None state: Settings of the rendering, taken at submission.
         """
-        self.img2img_waiting = False
-
-        self.img2img_time = os.path.getmtime(self.state.img2img)
-        if self.img2img_time != self.img2img_time_prev or force:
-            self.img2img_time_prev = self.img2img_time
 
-            self.state.server["busy"] = True
+        state = state or self.state.snapshot()
+        self.img2img_time_prev = os.path.getmtime(state.img2img)
+        self.progress_monitor.notify()
 
-            t = threading.Thread(target=self.progress_bar)
-            t.start()
+        response = self.api.fetch_img2img(state)
+        if response["status_code"] == 200:
+            return_img = response["image"]
+            self.update_image(return_img, state=state)
+            r_info = json.loads(response['info'])
+            return_prompt = r_info['prompt']
+            return_seed = r_info['seed']
+            self.display_caption = f"Sd Paint | Seed: {return_seed} | Prompt: {return_prompt}"
+        else:
+            self.osd(text=f"Error code returned: HTTP {response['status_code']}")
 
-            response = self.api.fetch_img2img(self.state)
-            if response["status_code"] == 200:
-                return_img = response["image"]
-                self.update_image(return_img)
-                r_info = json.loads(response['info'])
-                return_prompt = r_info['prompt']
-                return_seed = r_info['seed']
-                self.display_caption = f"Sd Paint | Seed: {return_seed} | Prompt: {return_prompt}"
-            else:
-                self.osd(text=f"Error code returned: HTTP {response['status_code']}")
+    def img2img_watch(self):
+        """
+            Watch the ``img2img`` file, check every 1s. Submit a rendering if modified since last render.
+        """
 
-            self.state.server["busy"] = False
+        while self.running:
+            self.img2img_time = os.path.getmtime(self.state.img2img)
+            if self.img2img_time != self.img2img_time_prev:
+                self.img2img_time_prev = self.img2img_time
+                self.scheduler.submit(self.img2img_submit, args=(self.state.snapshot(),))
 
-        if not self.img2img_waiting and self.running:
-            self.img2img_waiting = True
             time.sleep(1.0)
-            self.img2img_submit()
 
-    def progress_bar(self):
+    def update_progress(self, progress_json):
         """
-            Update the progress bar every 0.25s
+            Update the progress bar, called by the progress monitor.
+        :param dict progress_json: The progress JSON response.
         """
-        if not self.state.server["busy"]:
-            return
 
-        progress_json = self.api.progress_request()
         if progress_json.get("status_code", None):
             self.osd(text=f"Error code returned: HTTP {progress_json['status_code']}")
         self.progress = progress_json.get('progress', None)
+        self.wakeup()
         # if progress is not None and progress > 0.0:
         #     print(f"{progress*100:.0f}%")
 
-        if self.state.server["busy"]:
-            time.sleep(0.25)
-            self.progress_bar()
-
     def draw_osd_text(self, text, rect, color=(255, 255, 255), shadow_color=(0, 0, 0), distance=1, right_align=False):
         """
-            Draw OSD text with outline.
+            Draw OSD text with outline on the OSD layer.
         :param str text: The text to draw.
         :param list[int]|tuple[int]|pygame.Rect rect: Destination rect.
         :param tuple|int color: Text color.
         :param tuple|int shadow_color: Outline color.
         :param int distance: Outline/shadow size.
         :param bool right_align: Align text to the right.
+        :return: The drawn area.
         """
 
-        align_offset = 0
-        if right_align:
-            align_offset = -1
-
-        text_surface = self.font.render(text, True, shadow_color)
-        self.screen.blit(text_surface, (rect[0] + text_surface.get_width() * align_offset + distance, rect[1] + distance, rect[2], rect[3]))
-        self.screen.blit(text_surface, (rect[0] + text_surface.get_width() * align_offset - distance, rect[1] + distance, rect[2], rect[3]))
-        self.screen.blit(text_surface, (rect[0] + text_surface.get_width() * align_offset + distance, rect[1] - distance, rect[2], rect[3]))
-        self.screen.blit(text_surface, (rect[0] + text_surface.get_width() * align_offset - distance, rect[1] - distance, rect[2], rect[3]))
-        text_surface = self.font.render(text, True, color)
-        self.screen.blit(text_surface, (rect[0] + text_surface.get_width() * align_offset, rect[1], rect[2], rect[3]))
+        return self.osd_layer.text(text, rect, color=color, shadow_color=shadow_color, distance=distance, right_align=right_align)
 
     def osd(self, **kwargs):
         """
-            OSD display: progress bar and text messages.
+            Update the OSD: progress bar and text messages. The OSD is drawn by the main loop.
+
+        :param kwargs: Accepted parameters : ``progress, text, text_time, always_on``
+        """
+
+        self.progress = kwargs.get('progress', self.progress)  # type: float
+        if kwargs.get('text', None):
+            with self.osd_lock:
+                self.osd_message = (kwargs['text'], kwargs.get('text_time', 2.0), time.time())
+        self.osd_always_on_text = kwargs.get('always_on', self.osd_always_on_text)
+
+        if kwargs:
+            self.redraw()
+
+    def osd_text_remaining(self, message=None):
+        """
+            Remaining display time of the OSD text.
+        :param tuple[str, float, float]|None message: The OSD message, the current one if not set.
+        :return: Remaining time in seconds, ``None`` without OSD text.
+        """
+
+        message = message or self.osd_message
+        if message is None:
+            return None
+        _, text_time, start = message
+        if start is None:
+            return None
+        return text_time - (time.time() - start)
 
-        :param kwargs: Accepted parameters : ``progress, text, text_time, need_redraw``
+    def osd_state(self):
+        """
+            Displayed OSD content, the OSD is redrawn when it changes.
+        :return: The OSD state.
+        """
+
+        message = self.osd_message
+        remaining = self.osd_text_remaining(message)
+        return (
+            self.osd_dot_visible(),
+            round(self.progress * 100) if self.progress is not None and self.progress > 0.01 else None,
+            message[0] if remaining is not None and remaining > 0 else None,
+            self.osd_always_on_text,
+            id(self.tracer.last_trace) if self.trace_panel else None,
+        )
+
+    def osd_dot_visible(self):
+        """
+            Display the rendering dot: rendering requested, or waiting for the server to start it.
+        """
+
+        return bool(self.rendering or (self.state.server["busy"] and self.progress is not None and self.progress < 0.02))
+
+    def draw_osd(self):
+        """
+            Draw the OSD on the screen, the OSD layer being composed again if its content changed.
+        :return: The drawn areas.
+        """
+
+        with self.osd_lock:
+            remaining = self.osd_text_remaining()
+            if remaining is not None and remaining <= 0:
+                self.osd_message = None
+
+        content = (self.state.render["width"], self.state.render["height"], self.osd_state())
+        self.osd_layer.update(self.screen.get_size(), content, self.compose_osd)
+        return self.osd_layer.draw(self.screen)
+
+    def osd_surface(self, name, size, color, value=1.0):
+        """
+            Cached OSD shape surface: rendering dot or progress bar.
+        :param str name: Shape name, ``dot`` or ``progress``.
+        :param tuple[int] size: Surface size.
+        :param tuple color: Shape color.
+        :param float value: Progress bar value.
+        :return: The surface.
+        """
+
+        width = math.floor(size[0] * value)
+        key = (name, size, color, width)
+        surface = self.osd_surfaces.get(key, None)
+        if surface is None:
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            if name == 'dot':
+                dot_size = size[1] // 2
+                pygame.draw.circle(surface, (0, 0, 0), (dot_size + 2, dot_size + 2), dot_size - 2)
+                pygame.draw.circle(surface, color, (dot_size, dot_size), dot_size - 2)
+            else:
+                pygame.draw.rect(surface, (0, 0, 0), pygame.Rect(2, 2, width, size[1]))
+                pygame.draw.rect(surface, color, pygame.Rect(0, 0, width, size[1] - 2))
+            if len(self.osd_surfaces) > 128:
+                self.osd_surfaces.clear()
+            self.osd_surfaces[key] = surface
+        return surface
+
+    def compose_osd(self, layer):
+        """
+            Draw the OSD content on the OSD layer.
+        :param OsdLayer layer: The OSD layer.
         """
 
         osd_size = (128, 20)
@@ -490,200 +751,545 @@ class PygameView:
 
         osd_text_split_offset = 250
 
-        self.progress = kwargs.get('progress', self.progress)  # type: float
-        text = kwargs.get('text', self.osd_text)  # type: str
-        text_time = kwargs.get('text_time', 2.0)  # type: float
-        self.need_redraw = kwargs.get('need_redraw', self.need_redraw)  # type: bool
-        self.osd_always_on_text = kwargs.get('always_on', self.osd_always_on_text)
-
-        if self.rendering or (self.state.server["busy"] and self.progress is not None and self.progress < 0.02):
-            rendering_dot_surface = pygame.Surface(osd_size, pygame.SRCALPHA)
+        # the OSD state the layer is composed for
+        dot_visible, progress, text, always_on_text, trace_panel = layer.content[2]
 
-            pygame.draw.circle(rendering_dot_surface, (0, 0, 0), (osd_dot_size + 2, osd_dot_size + 2), osd_dot_size - 2)
-            pygame.draw.circle(rendering_dot_surface, (0, 200, 160), (osd_dot_size, osd_dot_size), osd_dot_size - 2)
-            self.screen.blit(rendering_dot_surface, osd_dot_pos)
-
-        if self.progress is not None and self.progress > 0.01:
-            self.need_redraw = True
+        if dot_visible:
+            layer.blit(self.osd_surface('dot', osd_size, (0, 200, 160)), osd_dot_pos)
 
+        if progress is not None:
             # progress bar
-            progress_surface = pygame.Surface(osd_size, pygame.SRCALPHA)
-            width = math.floor(osd_size[0] * self.progress)
-            pygame.draw.rect(progress_surface, (0, 0, 0), pygame.Rect(2, 2, width, osd_size[1]))
-            pygame.draw.rect(progress_surface, (0, 200, 160), pygame.Rect(0, 0, width, osd_size[1] - 2))
-
-            self.screen.blit(progress_surface, pygame.Rect(osd_progress_pos[0], osd_progress_pos[1], osd_size[0], osd_size[1]))
+            layer.blit(self.osd_surface('progress', osd_size, (0, 200, 160), progress / 100), osd_progress_pos)
 
             # progress text
-            self.draw_osd_text(f"{self.progress * 100:.0f}%", (osd_size[0] - osd_margin + osd_progress_pos[0], 3 + osd_progress_pos[1], osd_size[0], osd_size[1]), right_align=True)
+            self.draw_osd_text(f"{progress}%", (osd_size[0] - osd_margin + osd_progress_pos[0], 3 + osd_progress_pos[1], osd_size[0], osd_size[1]), right_align=True)
 
             osd_text_offset = osd_size[1] + osd_margin
 
-        if self.osd_always_on_text:
-            self.need_redraw = True
-
+        if always_on_text:
             # OSD always-on text
-            for line in self.osd_always_on_text.split('\n'):
-                self.need_redraw = True
+            osd_text_offset = self.draw_osd_lines(always_on_text, osd_text_pos, osd_text_offset, osd_size, osd_text_split_offset)
 
-                if ':n:' in line:
-                    line, line_value = line.split(':n:')
-                    line = line.rstrip(' ')
-                    line_value = line_value.lstrip(' ')
-                else:
-                    line_value = None
+        if trace_panel is not None:
+            # last rendering stages
+            osd_text_offset = self.draw_osd_lines(self.trace_text(), osd_text_pos, osd_text_offset, osd_size, osd_text_split_offset)
 
-                self.draw_osd_text(line, (osd_text_pos[0], osd_text_pos[1] + osd_text_offset, osd_size[0], osd_size[1]))
-                if line_value:
-                    self.draw_osd_text(line_value, (osd_text_pos[0] + osd_text_split_offset, osd_text_pos[1] + osd_text_offset, osd_size[0], osd_size[1]))
+        if text:
+            # OSD text
+            self.draw_osd_lines(text, osd_text_pos, osd_text_offset, osd_size, osd_text_split_offset)
 
-                osd_text_offset += osd_size[1]
+    def draw_osd_lines(self, text, pos, offset, line_size, split_offset):
+        """
+            Draw OSD text lines. The ``:n:`` separator splits a line into a label and a value column.
+        :param str text: The text.
+        :param tuple[int] pos: Text position.
+        :param int offset: Vertical offset of the first line.
+        :param tuple[int] line_size: Line size.
+        :param int split_offset: Horizontal offset of the value column.
+        :return: The vertical offset after the last line.
+        """
 
-        if text:
-            self.need_redraw = True
+        for line in text.split('\n'):
+            if ':n:' in line:
+                line, line_value = line.split(':n:')
+                line = line.rstrip(' ')
+                line_value = line_value.lstrip(' ')
+            else:
+                line_value = None
 
-            # OSD text
-            if self.osd_text_display_start is None or text != self.osd_text:
-                self.osd_text_display_start = time.time()
-            self.osd_text = text
+            self.draw_osd_text(line, (pos[0], pos[1] + offset, line_size[0], line_size[1]))
+            if line_value:
+                self.draw_osd_text(line_value, (pos[0] + split_offset, pos[1] + offset, line_size[0], line_size[1]))
 
-            for line in self.osd_text.split('\n'):
-                self.need_redraw = True
+            offset += line_size[1]
+
+        return offset
+
+    def trace_text(self):
+        """
+            Stages of the last traced rendering, for the OSD panel.
+        :return: The text.
+        """
+
+        trace = self.tracer.last_trace
+        if trace is None:
+            return "Tracing: waiting for a rendering"
+
+        # total duration of each stage, nested stages indented, in order of first occurrence
+        stages = {}
+        for name, _, duration, depth in sorted(trace.spans, key=lambda span: span[1]):
+            stages[(depth, name)] = stages.get((depth, name), 0.0) + duration
+
+        lines = [f"Last rendering :n: {trace.duration * 1000:.1f} ms"]
+        for (depth, name), duration in stages.items():
+            lines.append(f"{'    ' * (depth + 1)}{name} :n: {duration * 1000:.1f} ms")
+
+        # rendered images data held in memory, and spilled to the disk
+        report = self.image_store.memory_report()
+        lines.append(f"Images data :n: {report['bytes'] / 1024:.0f} KB, {report['spilled_bytes'] / 1024:.0f} KB spilled")
+        for render, render_report in report["renders"].items():
+            lines.append(f"    rendering {render} ({render_report['buffers']}) :n: {render_report['bytes'] / 1024:.0f} KB, {render_report['spilled_bytes'] / 1024:.0f} KB spilled")
+        return '\n'.join(lines)
+
+    def update_trace_panel(self, trace):
+        """
+            Redraw the tracing panel when a trace is finished. Called from the traced thread.
+        :param Trace trace: The finished trace.
+        """
+
+        if self.trace_panel:
+            self.redraw()
+
+    def toggle_trace_panel(self):
+        """
+            Toggle the tracing panel, tracing the renderings while displayed.
+        """
+
+        self.trace_panel = not self.trace_panel
+        self.tracer.enabled = self.trace_panel or self.tracing
+        self.need_redraw = True
+        self.osd(text=f"Tracing panel: {'on' if self.trace_panel else 'off'}")
+
+    def sketch_area(self):
+        """
+            Sketch area of the canvas.
+        :return: The area.
+        """
+
+        return pygame.Rect(self.state.render["width"], 0, self.state.render["width"], self.state.render["height"])
+
+    def canvas_changed(self, rect=None):
+        """
+            Mark a modified area of the canvas, to be refreshed on screen and checked for sketch changes.
+        :param pygame.Rect|tuple|None rect: The area, the whole canvas if not set.
+        """
+
+        self.sketch_tracker.mark(rect)
+        area = self.sketch_area()
+        if rect is None:
+            self.history.mark(0, 0, area.width, area.height)
+        else:
+            rect = pygame.Rect(rect)
+            self.history.mark(rect.left - area.left, rect.top - area.top, rect.width, rect.height)
+        with self.dirty_lock:
+            if rect is None:
+                self.full_redraw = True
+            else:
+                self.dirty_rects.append(pygame.Rect(rect))
+        self.wakeup()
+
+    def sketch_pos(self, pos):
+        """
+            Sketch coordinates of a canvas position.
+        """
+
+        return pos[0] - self.state.render["width"], pos[1]
+
+    def canvas_pos(self, pos):
+        """
+            Canvas coordinates of a sketch position.
+        """
+
+        return int(pos[0]) + self.state.render["width"], int(pos[1])
+
+    def draw_circle(self, color, pos, radius):
+        """
+            Draw a filled circle on the canvas, recorded in the stroke log.
+        :param tuple color: The color.
+        :param tuple[int] pos: Center, in canvas coordinates.
+        :param int radius: Radius.
+        """
+
+        self.canvas_changed(pygame.draw.circle(self.canvas, color, pos, radius))
+        if self.stroke_log is not None:
+            self.stroke_log.circle(color, self.sketch_pos(pos), radius)
+
+    def draw_polygon(self, color, points, width=0):
+        """
+            Draw a polygon on the canvas, recorded in the stroke log.
+        :param tuple color: The color.
+        :param list[tuple[int]]|tuple points: Points, in canvas coordinates.
+        :param int width: Outline width, ``0`` to fill the polygon.
+        """
+
+        self.canvas_changed(pygame.draw.polygon(self.canvas, color, points, width))
+        if self.stroke_log is not None:
+            self.stroke_log.polygon(color, [self.sketch_pos(point) for point in points], width)
+
+    def fill_sketch(self, color):
+        """
+            Fill the sketch with a color, recorded in the stroke log.
+        :param tuple color: The color.
+        """
+
+        self.canvas_changed(pygame.draw.rect(self.canvas, color, self.sketch_area()))
+        if self.stroke_log is not None:
+            self.stroke_log.fill(color)
+
+    def draw_brush(self, engine, brushes):
+        """
+            Draw the pending brush motion of a brush engine.
+        :param BrushEngine engine: The brush engine.
+        :param list[tuple[tuple, int]] brushes: Colors and sizes of the pressed brushes.
+        """
 
-                if ':n:' in line:
-                    line, line_value = line.split(':n:')
-                    line = line.rstrip(' ')
-                    line_value = line_value.lstrip(' ')
-                else:
-                    line_value = None
+        samples = engine.take(min(size for _, size in brushes))
+        for color, size in brushes:
+            with self.canvas_lock:
+                area = engine.rasterize(self.canvas, samples, color, size)
+            if area is not None:
+                self.canvas_changed(area)
 
-                self.draw_osd_text(line, (osd_text_pos[0], osd_text_pos[1] + osd_text_offset, osd_size[0], osd_size[1]))
-                if line_value:
-                    self.draw_osd_text(line_value, (osd_text_pos[0] + osd_text_split_offset, osd_text_pos[1] + osd_text_offset, osd_size[0], osd_size[1]))
+    def log_sketch(self):
+        """
+            Record the whole sketch in the stroke log, after it was replaced.
+        """
 
-                osd_text_offset += osd_size[1]
+        if self.stroke_log is None:
+            return
 
-            if time.time() - self.osd_text_display_start > text_time:
-                self.osd_text = None
-                self.osd_text_display_start = None
+        data = io.BytesIO()
+        with self.canvas_lock:
+            pygame.image.save(self.canvas.subsurface(self.sketch_area()), data, "sketch.png")
+        self.stroke_log.sketch(data.getvalue())
+
+    def sketch_history(self, operation):
+        """
+            Run an undo history operation on the sketch pixels. The history is reset if the sketch size changed.
+        :param callable operation: History method, called with the ``[x, y]`` sketch pixels.
+        :return: The operation result, ``None`` if the canvas pixels cannot be accessed.
+        """
+
+        area = self.sketch_area().clip(self.canvas.get_rect())
+        if not area.width or not area.height or self.canvas.get_bytesize() == 3:
+            return None
+
+        with self.canvas_lock:
+            pixels = pygame.surfarray.pixels2d(self.canvas)
+            sketch = pixels[area.left:area.right, area.top:area.bottom]
+            try:
+                if self.history.size != sketch.shape:
+                    self.history.reset(sketch)
+                return operation(sketch)
+            finally:
+                # release the surface lock
+                del pixels, sketch
+
+    def undo(self, redo=False, render=True):
+        """
+            Undo or redo the last sketch change, a brush stroke, zone erase, line or sketch replacement.
+        :param bool redo: Redo the last undone change.
+        :param bool render: Render the restored sketch.
+        """
+
+        if self.stroke_log is not None:
+            self.stroke_log.undo(redo)
+        areas = self.sketch_history(self.history.redo if redo else self.history.undo)
+        if not areas:
+            self.osd(text="Nothing to redo" if redo else "Nothing to undo")
+            return
+
+        area = self.sketch_area()
+        self.canvas_changed(pygame.Rect(areas[0]).unionall(areas[1:]).move(area.left, area.top))
+        if render:
+            self.rendering = True
+            self.instant_render = True
+
+        undo_steps, redo_steps = self.history.steps
+        self.osd(text=f"{'Redo' if redo else 'Undo'} ({undo_steps} undo, {redo_steps} redo)")
+
+    def wakeup(self):
+        """
+            Wake up the main loop waiting for events, if called from another thread.
+        """
+
+        if self.wakeup_posted or threading.current_thread() is threading.main_thread():
+            return
+        self.wakeup_posted = True
+        try:
+            pygame.event.post(pygame.event.Event(self.wakeup_event))
+        except pygame.error:
+            # display closed
+            self.wakeup_posted = False
+
+    def create_sketch_encoder(self):
+        """
+            Create a sketch encoder with the configured settings.
+        :return: The encoder.
+        """
+
+        return SketchEncoder(
+            encoding=self.state.configuration["config"].get('sketch_encoding', 'auto'),
+            compress_level=self.state.configuration["config"].get('sketch_compress_level', 1)
+        )
+
+    def redraw(self):
+        """
+            Request a screen refresh.
+        """
+
+        self.need_redraw = True
+        self.wakeup()
 
     def get_image_string_from_pygame(self):
         """
             Get base64 encoded image string from canvas.
         :return: The encoder image.
         """
-        img = self.canvas.subsurface(pygame.Rect(self.state.render["width"], 0, self.state.render["width"], self.state.render["height"])).copy()
+        rect = self.sketch_area()
 
-        if not self.state.render["use_invert_module"]:
-            # Convert the Pygame surface to a PIL image
-            pil_img = Image.frombytes('RGB', img.get_size(), pygame.image.tostring(img, 'RGB'))
+        # Copy the sketch pixels into the reusable buffer, inverted if needed
+        with self.canvas_lock:
+            pixels = self.sketch_buffer.extract(self.canvas, rect, invert=not self.state.render["use_invert_module"])
 
-            # Invert the colors of the PIL image
-            pil_img = ImageOps.invert(pil_img)
+        return self.sketch_encoder.encode_array(pixels)
 
-            # Convert the PIL image back to a Pygame surface
-            img = pygame.image.fromstring(pil_img.tobytes(), pil_img.size, pil_img.mode).convert_alpha()
+    def update_stream_images(self, response, state=None):
+        """
+            Redraw the image canvas while the streamed API response is received. Set the response ``info`` value.
+        :param dict response: The API response, with ``stream`` and ``batch_size`` values.
+        :param StateSnapshot|None state: Settings of the rendering, the current ones if not set.
+        :return: ``True`` if the response was successfully read.
+        """
 
-        # Save the inverted image as base64-encoded data
-        data = io.BytesIO()
-        pygame.image.save(img, data)
-        return base64.b64encode(data.getvalue()).decode('utf-8')
+        # the response chunks wait is traced as "receive", their base64 decoding as "decode"
+        def decoded_images(stream):
+            decode_time = 0.0
+            for image in stream:
+                self.tracer.record("decode", stream.decode_time - decode_time)
+                decode_time = stream.decode_time
+                yield image
+
+        images = decoded_images(response["stream"])
+        try:
+            if response["batch_size"] == 1:
+                for image_data in images:
+                    self.update_image(image_data, state=state)
+            else:
+                self.update_batch_images(images, count=response["batch_size"], state=state)
+        except (ValueError, requests.exceptions.RequestException) as e:
+            self.osd(text=f"Error reading response: {e.__class__.__name__}")
+            return False
+
+        response["info"] = response["stream"].info
+        return True
 
-    def send_request(self):
+    def send_request(self, state):
         """
             Send the API request.
+        :param StateSnapshot state: Settings of the rendering, with its payload.
+        :return: ``True`` if the rendered image was displayed.
         """
 
-        response = self.api.post_request(self.state)
+        response = self.api.post_request(state, stream=self.stream_responses)
         if response["status_code"] == 200:
-            if response.get("image", None):
-                self.update_image(response["image"])
+            if response.get("stream", None) is not None:
+                if not self.update_stream_images(response, state=state):
+                    return False
+            elif response.get("image", None):
+                self.update_image(response["image"], state=state)
             elif response.get("batch_images", None):
-                self.update_batch_images(response["batch_images"])
+                self.update_batch_images(response["batch_images"], state=state)
 
             r_info = json.loads(response['info'])
             return_prompt = r_info['prompt']
             return_seed = r_info['seed']
             self.display_caption = f"Sd Paint | Seed: {return_seed} | Prompt: {return_prompt}"
+            self.wakeup()
+            return True
         else:
             self.osd(text=f"Error code returned: HTTP {response['status_code']}")
-        self.state.server["busy"] = False
+            return False
 
-    def render(self):
+    def render_delay(self):
         """
-            Call the API to launch the rendering, if another rendering is not in progress.
+            Remaining wait time before launching the render, since the last draw.
+        :return: Wait time in seconds.
         """
-        if time.time() - self.last_draw_time < self.render_wait and not self.instant_render:
-            time.sleep(0.25)
-            self.render()
-            return
 
-        self.instant_render = False
+        return self.render_wait - (time.time() - self.last_draw_time)
 
-        if not self.state.server["busy"]:
-            self.state.server["busy"] = True
+    def sketch_changed(self, changed, send=False):
+        """
+            Check if the sketch must be encoded again: changed since its last encoding by at least
+            ``min_changed_pixels`` pixels, or by any pixel when the rendering is sent anyway.
+        :param int changed: Number of changed pixels, checked by the sketch tracker.
+        :param bool send: The rendering is sent whatever the sketch changes: forced, or its parameters changed.
+        :return: ``True`` if the sketch must be encoded again.
+        """
 
-            if not self.state.img2img:
-                image_string = self.get_image_string_from_pygame()
-                payload_submit(self.state, image_string)
-                t = threading.Thread(target=self.send_request)
-                t.start()
-                t = threading.Thread(target=self.progress_bar)
-                t.start()
-            else:
-                t = threading.Thread(target=functools.partial(self.img2img_submit, True))
-                t.start()
+        invert = not self.state.render["use_invert_module"]
+        if self.last_sketch is None or self.last_sketch[0] != invert or changed >= self.min_changed_pixels or (send and changed):
+            return True
+
+        if changed:
+            # small changes, kept until they reach the threshold
+            self.sketch_tracker.discard()
+        else:
+            self.sketch_tracker.commit()
+        return False
 
     @staticmethod
-    def get_angle(pos1, pos2):
+    def payload_key(payload):
         """
-            Get the angle between two position.
-        :param tuple[int]|list[int] pos1: First position.
-        :param tuple[int]|list[int] pos2: Second position.
-        :return: radians, degrees, cos, sin
+            Rendering parameters of a payload, without the sketch.
+        :param dict payload: The payload.
+        :return: The parameters key.
         """
 
-        dx = pos1[0] - pos2[0]
-        dy = pos1[1] - pos2[1]
-        rads = math.atan2(-dy, dx)
-        rads %= 2 * math.pi
+        unit = payload['controlnet_units'][0]
+        image = unit.pop('input_image', None)
+        try:
+            return json.dumps(payload, sort_keys=True, default=str)
+        finally:
+            unit['input_image'] = image
 
-        return rads, math.degrees(rads), math.cos(rads), math.sin(rads)
+    def render(self, state=None):
+        """
+            Call the API to launch the rendering. Run by the render scheduler, only one rendering is in progress at a time.
+            The rendering is skipped if the sketch and parameters did not change since the last displayed rendering, or if
+            the sketch became blank.
+        :param StateSnapshot|None state: Settings of the rendering, taken at submission.
+        """
 
-    def brush_stroke(self, event, button, pos):
+        state = state or self.state.snapshot()
+        if not state.img2img:
+            start = time.perf_counter()
+            force, self.force_render = self.force_render, False
+            # wait since the last stroke, or since the submission for the renders not triggered by a stroke
+            wait = min(time.time() - self.last_draw_time, self.scheduler.wait_time)
+            with self.tracer.trace("render") as trace:
+                self.tracer.record("debounce", wait)
+                with self.tracer.span("diff"):
+                    with self.canvas_lock:
+                        changed = self.sketch_tracker.changes(self.canvas, self.sketch_area())
+                with self.tracer.span("payload"):
+                    payload_submit(state, self.last_sketch[1] if self.last_sketch is not None else None)
+                    payload_key = self.payload_key(state["main_json_data"])
+
+                # a forced rendering, or with changed parameters, is sent with all the sketch changes
+                send = force or payload_key != self.last_payload_key
+                sketch_changed = self.sketch_changed(changed, send)
+                with self.tracer.span("encode"):
+                    if sketch_changed:
+                        image_string = self.get_image_string_from_pygame()
+                        self.sketch_tracker.commit()
+                        self.last_sketch = (not self.state.render["use_invert_module"], image_string)
+                        state["main_json_data"]['controlnet_units'][0]['input_image'] = image_string
+
+                # a blank sketch, e.g. fully erased, is not rendered again with the same parameters
+                blank = sketch_changed and self.sketch_tracker.blank()
+                if not send and (not sketch_changed or blank):
+                    self.skipped_metric.inc()
+                    if trace is not None:
+                        trace.attributes["skipped"] = True
+                        trace.attributes["blank"] = blank
+                    return
+
+                if self.stroke_log is not None:
+                    self.stroke_log.render(int(state["main_json_data"].get('seed', -1)))
+                self.progress_monitor.notify()
+                displayed = self.send_request(state)
+                self.last_payload_key = payload_key if displayed else None
+
+            if displayed:
+                self.latency_metric.observe(wait + time.perf_counter() - start, view='pygame')
+        else:
+            self.img2img_submit(state)
+
+    def replay_strokes(self):
         """
-            Draw the brush stroke.
-        :param pygame.event.Event|dict event: The pygame event.
-        :param int|str button: The active button.
-        :param tuple[int]|list[int] pos: The brush current position.
+            Replay thread: read the replayed stroke log, and queue its operations for the main loop at their recorded
+            times.
         """
 
-        if self.prev_pos is None or (abs(event.pos[0] - self.prev_pos[0]) < self.brush_size[button] // 4 and abs(event.pos[1] - self.prev_pos[1]) < self.brush_size[button] // 4):
-            # Slow brush stroke, draw circles
-            pygame.draw.circle(self.canvas, self.brush_colors[button], event.pos, self.brush_size[button])
+        try:
+            reader = StrokeLogReader(self.replay)
+        except (OSError, ValueError) as e:
+            print(f"Stroke log replay error: {e}")
+            self.replay_ops.append((None, None))
+            self.wakeup()
+            return
 
-        elif not self.prev_pos2 or self.brush_size[button] < 4:
-            # Draw a simple polygon for small brush sizes
-            pygame.draw.polygon(self.canvas, self.brush_colors[button], [self.prev_pos, event.pos], self.brush_size[button] * 2)
+        if reader.size != tuple(self.sketch_area().size):
+            print(f"Replayed sketch size {reader.size} differs from the current one {tuple(self.sketch_area().size)}")
 
-        else:
-            # Draw a complex shape with gfxdraw for bigger bush sizes to avoid gaps
-            angle_prev = self.get_angle(self.prev_pos, self.prev_pos2)
-            angle = self.get_angle(event.pos, self.prev_pos)
-
-            offset_pos_prev = [(self.brush_size[button] * angle_prev[3]), (self.brush_size[button] * angle_prev[2])]
-            offset_pos = [(self.brush_size[button] * angle[3]), (self.brush_size[button] * angle[2])]
-            pygame.gfxdraw.filled_polygon(self.canvas, [
-                (self.prev_pos2[0] - offset_pos_prev[0], self.prev_pos2[1] - offset_pos_prev[1]),
-                (self.prev_pos[0] - offset_pos[0], self.prev_pos[1] - offset_pos[1]),
-                (event.pos[0] - offset_pos[0], event.pos[1] - offset_pos[1]),
-                (event.pos[0] + offset_pos[0], event.pos[1] + offset_pos[1]),
-                (self.prev_pos[0] + offset_pos[0], self.prev_pos[1] + offset_pos[1]),
-                (self.prev_pos2[0] + offset_pos_prev[0], self.prev_pos2[1] + offset_pos_prev[1])
-            ], self.brush_colors[button])
-
-        self.prev_pos2 = self.prev_pos
-        self.prev_pos = event.pos
+        start = time.perf_counter()
+        for elapsed, opcode, values in reader:
+            if self.replay_speed > 0:
+                wait = elapsed / self.replay_speed - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            if not self.running:
+                return
+            self.replay_ops.append((opcode, values))
+            self.wakeup()
+
+        self.replay_ops.append((None, None))
+        self.wakeup()
+
+    def apply_replay(self):
+        """
+            Draw the operations queued by the replay thread.
+        """
+
+        while self.replay_ops:
+            opcode, values = self.replay_ops.popleft()
+            if opcode is None:
+                self.replaying = False
+                self.osd(text="Replay done")
+            elif opcode == StrokeLog.BRUSH:
+                brushes, points = values
+                for point in points:
+                    self.replay_brush.add(self.canvas_pos(point))
+                self.draw_brush(self.replay_brush, brushes)
+            elif opcode == StrokeLog.BRUSH_END:
+                self.replay_brush.reset()
+            elif opcode == StrokeLog.CIRCLE:
+                color, pos, radius = values
+                self.draw_circle(color, self.canvas_pos(pos), radius)
+            elif opcode == StrokeLog.POLYGON:
+                color, points, width = values
+                if len(points):
+                    self.draw_polygon(color, [self.canvas_pos(point) for point in points], width)
+            elif opcode == StrokeLog.FILL:
+                self.fill_sketch(values[0])
+            elif opcode in (StrokeLog.UNDO, StrokeLog.REDO):
+                # the replayed renderings are requested by the rendering records
+                self.undo(redo=opcode == StrokeLog.REDO, render=False)
+            elif opcode == StrokeLog.COMMIT:
+                self.sketch_history(self.history.commit)
+            elif opcode == StrokeLog.SKETCH:
+                area = self.sketch_area()
+                image = pygame.image.load(io.BytesIO(values[0]), "sketch.png")
+                if image.get_size() != area.size:
+                    image = pygame.transform.smoothscale(image, area.size)
+                with self.canvas_lock:
+                    self.canvas.blit(image, area)
+                self.canvas_changed(area)
+                self.log_sketch()
+            elif opcode == StrokeLog.RENDER and self.replay_renders:
+                if values[0] != -1:
+                    self.state.gen_settings["seed"] = values[0]
+                self.force_render = True
+                self.instant_render = True
+
+    def flush_brush(self):
+        """
+            Draw the brush motion received since the last call, with each pressed brush.
+        """
+
+        if not self.brush.pending:
+            return
+
+        brushes = [(self.brush_colors[button], self.brush_size[button]) for button, pos in self.brush_pos.items() if pos is not None and button in self.brush_colors]
+        if not brushes:
+            self.brush.pending = []
+            return
+
+        if self.stroke_log is not None:
+            self.stroke_log.brush(brushes, [self.sketch_pos(pos) for pos in self.brush.pending])
+        self.draw_brush(self.brush, brushes)
 
     @property
     def shift_down(self):
@@ -702,42 +1308,80 @@ class PygameView:
             Call ControlNet active detector on the last rendered image, replace the canvas sketch by the detector result.
         :param str detector: The detector to apply.
         """
-        img = self.canvas.subsurface(pygame.Rect(0, 0, self.state.render["width"], self.state.render["height"])).copy()
+        rect = pygame.Rect(0, 0, self.state.render["width"], self.state.render["height"])
 
-        # Convert the Pygame surface to a PIL image
-        pil_img = Image.frombytes('RGB', img.get_size(), pygame.image.tostring(img, 'RGB'))
+        # Copy the rendered image pixels into the reusable buffer, and encode it inverted
+        with self.canvas_lock:
+            pixels = self.detect_buffer.extract(self.canvas, rect, invert=True)
+        data = self.detect_encoder.encode_array(pixels)
 
-        # Invert the colors of the PIL image
-        pil_img = ImageOps.invert(pil_img)
-
-        # Convert the PIL image back to a Pygame surface
-        img = pygame.image.fromstring(pil_img.tobytes(), pil_img.size, pil_img.mode).convert_alpha()
-
-        # Save the inverted image as base64-encoded data
-        data = io.BytesIO()
-        pygame.image.save(img, data)
-        data = base64.b64encode(data.getvalue()).decode('utf-8')
-
-        response = self.api.fetch_detect_image(detector, data, img.get_width(), img.get_height())
+        response = self.api.fetch_detect_image(detector, data, rect.width, rect.height)
         if response["status_code"] == 200:
             return_img = response["image"]
             img_bytes = io.BytesIO(base64.b64decode(return_img))
             pil_img = Image.open(img_bytes)
-            pil_img = ImageOps.invert(pil_img)
-            pil_img = pil_img.convert('RGB')
-            img_surface = pygame.image.fromstring(pil_img.tobytes(), pil_img.size, pil_img.mode)
 
-            self.canvas.blit(img_surface, (self.state.render["width"], 0))
+            # Draw the inverted detection result on the sketch
+            with self.canvas_lock:
+                self.detect_buffer.blit_image(pil_img, self.canvas, (self.state.render["width"], 0), invert=True)
+            self.canvas_changed(pygame.Rect(self.state.render["width"], 0, pil_img.width, pil_img.height))
+            self.log_sketch()
         else:
             self.osd(text=f"Error code returned: HTTP {response['status_code']}")
 
     def display_configuration(self, wrap=True):
         """
-            Display configuration on screen.
+            Display configuration on screen, from the last known webui configuration. Request a refresh of the webui
+            configuration in background, the display being updated if the checkpoint or VAE changed.
         :param bool wrap: Wrap long text.
         """
 
-        self.state.update_webui_config()
+        self.webui_config_monitor.refresh()
+        self.osd(always_on=self.configuration_text(wrap))
+
+    def update_configuration_display(self, changes):
+        """
+            Request an update of the configuration display when the webui checkpoint or VAE changed. Called by the
+            webui configuration monitor, the display is updated by the main loop.
+        :param dict changes: The changed fields.
+        """
+
+        with self.configuration_lock:
+            self.pending_configuration_changes.update(changes)
+        self.wakeup()
+
+    def apply_configuration_changes(self):
+        """
+            Update the configuration display lines of the changed fields. Run by the main loop.
+        """
+
+        with self.configuration_lock:
+            changes, self.pending_configuration_changes = self.pending_configuration_changes, {}
+        if not changes:
+            return
+
+        if not self.osd_always_on_text or self.osd_always_on_text != self.configuration_display:
+            return
+
+        # only the lines of the changed fields are built again
+        updated = False
+        for index, (field, wrap, line) in enumerate(self.configuration_lines):
+            if field[field.rfind('/') + 1:] in changes:
+                new_line = self.configuration_line(field, wrap)
+                if new_line != line:
+                    self.configuration_lines[index] = (field, wrap, new_line)
+                    updated = True
+
+        if updated:
+            self.configuration_display = ''.join(line for _, _, line in self.configuration_lines).strip('\n')
+            self.osd(always_on=self.configuration_display)
+
+    def configuration_text(self, wrap=True):
+        """
+            Configuration display text.
+        :param bool wrap: Wrap long text.
+        :return: The OSD text.
+        """
 
         fields = [
             '--Prompt',
@@ -768,95 +1412,101 @@ class PygameView:
         elif wrap:
             wrap = 80
 
-        text = ''
+        self.configuration_lines = [(field, wrap, self.configuration_line(field, wrap)) for field in fields]
+        self.configuration_display = ''.join(line for _, _, line in self.configuration_lines).strip('\n')
+        return self.configuration_display
+
+    def configuration_line(self, field, wrap):
+        """
+            Configuration display line of a field.
+        :param str field: The field path.
+        :param int|bool wrap: Wrap length of the long values, ``False`` to not wrap.
+        :return: The line text, with its trailing line break.
+        """
+
+        if field in ('state/render/steps', 'state/samplers/sampler', 'state/render/cfg_scale', 'state/gen_settings/prompt') and self.state.render["quick_mode"]:
+            field = 'state/render/quick/'+field[field.rfind('/')+1:]
+
+        # Display separator
+        if field.startswith('--'):
+            return '\n'+field[2:]+'\n'
+
+        # Field value
+        label = ''
+        value = ''
+
+        if field == 'state/render/quick/prompt':
+            field_components = field.replace('state/', '').split('/')
+            label = field_components[2]
+            value = self.state.gen_settings['prompt']
+            if self.state.render['quick'].get('lora', None) and self.state.render['quick'].get('lora_weight', None):
+                value += f" <lora:{self.state.render['quick']['lora']}:{self.state.render['quick']['lora_weight']}>"
+
+        elif '.' in field:
+            field = field.split('.')
+            var = globals().get(field[0], locals().get(field[0], None))
+            if var is None:
+                return ''
+
+            if isinstance(var, dict) and var.get(field[1], None) is not None:
+                label = field[1]
+                value = var.get(field[1])
+            elif (isinstance(var, list) or isinstance(var, tuple)) and field[1].isnumeric() and int(field[1]) < len(var):
+                label = field[0]
+                value = var[int(field[1])]
+            elif getattr(var, field[1], None) is not None:
+                label = field[1]
+                value = getattr(var, field[1])
+        else:
+            if field.startswith('state/'):
+                field_components = field.replace('state/', '').split('/')
+                label = field_components[1]
+                field_value = getattr(self.state, field_components[0])[field_components[1]]
+                if isinstance(field_value, dict) and len(field_components) > 2:
+                    label = field_components[2]
+                    field_value = field_value.get(field_components[2], None)
+                    if field_components[1] == 'quick':
+                        field_value = f'{field_value} -quick-'
+            else:
+                label = field
+                field_value = globals().get(field, locals().get(field, None))
+
+            if field_value is not None:
+                value = field_value
+
+        if label and value is not None:
+            # prettify
+            label = label.replace('_', ' ')
+            if label.endswith('prompt'):
+                value = value.replace(', ', ',').replace(',', ', ')  # nicer prompt display
+            elif 'size' in label and isinstance(value, tuple) and len(value) == 2:
+                value = f"{value[0]}x{value[1]}"
+            elif label in ('checkpoint', 'vae'):
+                value = ckpt_name(value)
+            else:
+                value = str(value)
+
+            # wrap text
+            if wrap and len(value) > wrap:
+                new_value = ''
+                to_wrap = 0
+                for i in range(len(value)):
+                    if i % wrap == wrap - 1:
+                        to_wrap = i
 
-        for field in fields:
-            if field in ('state/render/steps', 'state/samplers/sampler', 'state/render/cfg_scale', 'state/gen_settings/prompt') and self.state.render["quick_mode"]:
-                field = 'state/render/quick/'+field[field.rfind('/')+1:]
+                    # try to wrap after space
+                    if to_wrap and value[i] in [' ', ')'] or (to_wrap and i - to_wrap > 5):
+                        new_value += value[i]+'\n:n:'
+                        to_wrap = 0
+                        continue
 
-            # Display separator
-            if field.startswith('--'):
-                text += '\n'+field[2:]+'\n'
-                continue
+                    new_value += value[i]
 
-            # Field value
-            label = ''
-            value = ''
+                value = new_value
 
-            if field == 'state/render/quick/prompt':
-                field_components = field.replace('state/', '').split('/')
-                label = field_components[2]
-                value = self.state.gen_settings['prompt']
-                if self.state.render['quick'].get('lora', None) and self.state.render['quick'].get('lora_weight', None):
-                    value += f" <lora:{self.state.render['quick']['lora']}:{self.state.render['quick']['lora_weight']}>"
-
-            elif '.' in field:
-                field = field.split('.')
-                var = globals().get(field[0], locals().get(field[0], None))
-                if var is None:
-                    continue
+            return f"    {label} :n: {value}\n"
 
-                if isinstance(var, dict) and var.get(field[1], None) is not None:
-                    label = field[1]
-                    value = var.get(field[1])
-                elif (isinstance(var, list) or isinstance(var, tuple)) and field[1].isnumeric() and int(field[1]) < len(var):
-                    label = field[0]
-                    value = var[int(field[1])]
-                elif getattr(var, field[1], None) is not None:
-                    label = field[1]
-                    value = getattr(var, field[1])
-            else:
-                if field.startswith('state/'):
-                    field_components = field.replace('state/', '').split('/')
-                    label = field_components[1]
-                    field_value = getattr(self.state, field_components[0])[field_components[1]]
-                    if isinstance(field_value, dict) and len(field_components) > 2:
-                        label = field_components[2]
-                        field_value = field_value.get(field_components[2], None)
-                        if field_components[1] == 'quick':
-                            field_value = f'{field_value} -quick-'
-                else:
-                    label = field
-                    field_value = globals().get(field, locals().get(field, None))
-
-                if field_value is not None:
-                    value = field_value
-
-            if label and value is not None:
-                # prettify
-                label = label.replace('_', ' ')
-                if label.endswith('prompt'):
-                    value = value.replace(', ', ',').replace(',', ', ')  # nicer prompt display
-                elif 'size' in label and isinstance(value, tuple) and len(value) == 2:
-                    value = f"{value[0]}x{value[1]}"
-                elif label in ('checkpoint', 'vae'):
-                    value = ckpt_name(value)
-                else:
-                    value = str(value)
-
-                # wrap text
-                if wrap and len(value) > wrap:
-                    new_value = ''
-                    to_wrap = 0
-                    for i in range(len(value)):
-                        if i % wrap == wrap - 1:
-                            to_wrap = i
-
-                        # try to wrap after space
-                        if to_wrap and value[i] in [' ', ')'] or (to_wrap and i - to_wrap > 5):
-                            new_value += value[i]+'\n:n:'
-                            to_wrap = 0
-                            continue
-
-                        new_value += value[i]
-
-                    value = new_value
-
-                text += f"    {label} :n: {value}"
-
-            text += '\n'
-
-        self.osd(always_on=text.strip('\n'))
+        return '\n'
 
     def toggle_batch_mode(self, cycle=False):
         """
@@ -879,32 +1529,143 @@ class PygameView:
 
         if self.state.render["batch_size"] == 1:
             self.state.render["hr_scale"] = self.state.render["batch_hr_scale_prev"]
-            update_size(self.state)
+            self.request_resize()
             self.osd(text=f"Batch rendering: off")
         else:
             self.state.render["batch_hr_scale_prev"] = self.state.render["hr_scale"]
             self.state.render["hr_scale"] = 1.0
-            update_size(self.state)
+            self.request_resize()
             self.osd(text=f"Batch rendering size: {self.state.render['batch_size']}")
 
-    def main(self):
-        # Initial img2img call
-        if self.state.img2img:
-            t = threading.Thread(target=self.img2img_submit)
-            t.start()
+    def idle_timeout(self):
+        """
+            Maximum wait for the next event: until the OSD text expires, shorter while rendering.
+        :return: Wait time in milliseconds.
+        """
+
+        timeout = self.IDLE_TIMEOUT
+        remaining = self.osd_text_remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining * 1000 + 1)
+        if self.scheduler.busy or self.state.server["busy"]:
+            timeout = min(timeout, self.ANIMATION_TIMEOUT)
+
+        return max(1, int(timeout))
+
+    def wait_events(self):
+        """
+            Get the pending events, waiting for the next one if there is nothing to draw.
+        :return: The events.
+        """
+
+        if self.need_redraw or self.full_redraw or self.dirty_rects or self.instant_render:
+            return pygame.event.get()
+
+        event = pygame.event.wait(self.idle_timeout())
+        events = pygame.event.get()
+        if event.type != pygame.NOEVENT:
+            events.insert(0, event)
+        return events
 
+    def cursor_image(self):
+        """
+            Brush cursor surface, cached until the brush size or cursor color change.
+        :return: The cursor surface.
+        """
+
+        cursor_size = self.brush_size[1] * 2
+        if self.cursor_surface is None or self.cursor_surface.get_width() != cursor_size or self.cursor_surface_color != self.cursor_color:
+            self.cursor_surface = pygame.Surface((cursor_size, cursor_size), pygame.SRCALPHA)
+            self.cursor_surface_color = self.cursor_color
+            pygame.draw.circle(self.cursor_surface, self.cursor_color, (cursor_size // 2, cursor_size // 2), cursor_size // 2)
+
+        return self.cursor_surface
+
+    def draw_frame(self):
+        """
+            Refresh the changed areas of the screen: canvas changes, brush cursor and OSD.
+        :return: ``True`` if the screen was updated.
+        """
+
+        mouse_pos = pygame.mouse.get_pos()
+        cursor = (mouse_pos, self.brush_size[1]) if mouse_pos[0] >= self.state.render["width"] else None
+        overlay_state = (cursor, self.osd_state())
+
+        with self.dirty_lock:
+            full_redraw, self.full_redraw = self.full_redraw, False
+            dirty_rects, self.dirty_rects = self.dirty_rects, []
+
+        if not (full_redraw or dirty_rects or self.need_redraw or overlay_state != self.overlay_state):
+            return False
+
+        # Restore the changed canvas areas, and the areas below the previous cursor and OSD
+        update_rects = dirty_rects + self.overlay_rects
+        with self.canvas_lock:
+            if full_redraw:
+                self.screen.blit(self.canvas, (0, 0))
+            else:
+                for rect in update_rects:
+                    self.screen.blit(self.canvas, rect, rect)
+
+        # Draw the brush cursor and the OSD over the canvas
+        overlay_rects = []
+        if cursor is not None:
+            cursor_surface = self.cursor_image()
+            overlay_rects.append(self.screen.blit(cursor_surface, (mouse_pos[0] - cursor_surface.get_width() // 2, mouse_pos[1] - cursor_surface.get_height() // 2)))
+        if self.mouse_visible != (cursor is None):
+            self.mouse_visible = cursor is None
+            pygame.mouse.set_visible(self.mouse_visible)
+        overlay_rects.extend(self.draw_osd())
+
+        # Update the display
+        if full_redraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(update_rects + overlay_rects)
+        if self.caption != self.display_caption:
+            self.caption = self.display_caption
+            pygame.display.set_caption(self.caption)
+
+        self.overlay_rects = overlay_rects
+        self.overlay_state = (cursor, self.osd_state())
+        self.need_redraw = False
+        return True
+
+    def main(self):
         # Set up the main loop
         self.running = True
         self.need_redraw = True
 
+        self.scheduler.start()
+        self.progress_monitor.start()
+        self.webui_config_monitor.start()
+
+        # Initial img2img call, then watch the source file
+        if self.state.img2img:
+            t = threading.Thread(target=self.img2img_watch, daemon=True)
+            t.start()
+
+        if self.replay:
+            self.replaying = True
+            t = threading.Thread(target=self.replay_strokes, name="StrokeReplay", daemon=True)
+            t.start()
+
         while self.running:
             self.rendering = False
 
-            # Handle events
-            for event in pygame.event.get():
+            # Handle events, waiting for them when idle
+            for event in self.wait_events():
+                if event.type not in (pygame.MOUSEMOTION, pygame.FINGERMOTION):
+                    # draw the coalesced brush motion before handling the other events
+                    self.flush_brush()
+
                 if event.type == pygame.QUIT:
                     self.running = False
 
+                elif event.type == self.wakeup_event:
+                    # redraw requested by another thread
+                    self.wakeup_posted = False
+
                 elif event.type == pygame.MOUSEBUTTONDOWN or event.type == pygame.FINGERDOWN:
                     self.button_down = True
 
@@ -923,12 +1684,12 @@ class PygameView:
                         if not self.zone_pos or self.zone_pos[-1] != valid_brush_pos:
                             self.zone_pos.append(valid_brush_pos)
                         if len(self.zone_pos) > 1:
-                            pygame.draw.polygon(self.canvas, self.brush_colors['z'], (self.zone_pos[-2], self.zone_pos[-1]), self.brush_size['z'])
+                            self.draw_polygon(self.brush_colors['z'], (self.zone_pos[-2], self.zone_pos[-1]), self.brush_size['z'])
                     elif self.save_zone_down:
                         if not self.zone_pos or self.zone_pos[-1] != valid_brush_pos:
                             self.zone_pos.append(valid_brush_pos)
                         if len(self.zone_pos) > 1:
-                            pygame.draw.polygon(self.canvas, self.brush_colors['s'], (self.zone_pos[-2], self.zone_pos[-1]), self.brush_size['s'])
+                            self.draw_polygon(self.brush_colors['s'], (self.zone_pos[-2], self.zone_pos[-1]), self.brush_size['s'])
                     else:
                         self.need_redraw = True
                         self.last_draw_time = time.time()
@@ -953,7 +1714,7 @@ class PygameView:
                             if self.shift_pos is None:
                                 self.shift_pos = self.brush_pos[brush_key]
                             else:
-                                pygame.draw.polygon(self.canvas, self.brush_colors[brush_key], [self.shift_pos, self.brush_pos[brush_key]], self.brush_size[brush_key] * 2)
+                                self.draw_polygon(self.brush_colors[brush_key], [self.shift_pos, self.brush_pos[brush_key]], self.brush_size[brush_key] * 2)
                                 self.shift_pos = self.brush_pos[brush_key]
 
                 elif event.type == pygame.MOUSEBUTTONUP or event.type == pygame.FINGERUP:
@@ -982,10 +1743,12 @@ class PygameView:
                                 brush_key = 'e'
 
                             if self.brush_size[brush_key] >= 4 and getattr(event, 'pos', None) is not None:
-                                pygame.draw.circle(self.canvas, self.brush_colors[brush_key], event.pos, self.brush_size[brush_key])
+                                self.draw_circle(self.brush_colors[brush_key], event.pos, self.brush_size[brush_key])
 
                             self.brush_pos[brush_key] = None
-                            self.prev_pos = None
+                            self.brush.reset()
+                            if self.stroke_log is not None:
+                                self.stroke_log.brush_end()
                             self.brush_color = self.brush_colors[brush_key]
 
                     self.image_click = False  # reset image click detection
@@ -1002,21 +1765,20 @@ class PygameView:
                             if not self.zone_pos or self.zone_pos[-1] != valid_brush_pos:
                                 self.zone_pos.append(valid_brush_pos)
                             if len(self.zone_pos) > 1:
-                                pygame.draw.polygon(self.canvas, self.brush_colors['z'], self.zone_pos[-2:], self.brush_size['z'])
+                                self.draw_polygon(self.brush_colors['z'], self.zone_pos[-2:], self.brush_size['z'])
                     elif self.save_zone_down:
                         self.need_redraw = True
                         if self.button_down:
                             if not self.zone_pos or self.zone_pos[-1] != valid_brush_pos:
                                 self.zone_pos.append(valid_brush_pos)
                             if len(self.zone_pos) > 1:
-                                pygame.draw.polygon(self.canvas, self.brush_colors['s'], self.zone_pos[-2:], self.brush_size['s'])
+                                self.draw_polygon(self.brush_colors['s'], self.zone_pos[-2:], self.brush_size['s'])
                     elif not self.image_click:
                         self.need_redraw = True
-                        for button, pos in self.brush_pos.items():
-                            if pos is not None and button in self.brush_colors:
-                                self.last_draw_time = time.time()
-                                # do the brush stroke
-                                self.brush_stroke(event, button, pos)
+                        if any(pos is not None and button in self.brush_colors for button, pos in self.brush_pos.items()):
+                            self.last_draw_time = time.time()
+                            # brush stroke, drawn with the other motion events of the frame
+                            self.brush.add(event.pos)
 
                 elif event.type == pygame.KEYDOWN:
                     # DBG key & modifiers
@@ -1101,11 +1863,12 @@ class PygameView:
                         else:
                             self.osd(text=f"HR scale: {self.state.render['hr_scale']}")
 
-                        update_size(self.state, hr_scale=self.state.render["hr_scale"])
+                        self.request_resize(hr_scale=self.state.render["hr_scale"])
 
                     elif event.key in (pygame.K_KP_ENTER, pygame.K_RETURN):
                         self.rendering = True
                         self.instant_render = True
+                        self.force_render = True
                         self.osd(text=f"Rendering")
 
                     elif event.key == pygame.K_q:
@@ -1120,7 +1883,7 @@ class PygameView:
                             self.osd(text=f"Quick render: off")
                             self.state.render["hr_scale"] = self.state.render["hr_scale_prev"]
 
-                        update_size(self.state, hr_scale=self.state.render["hr_scale"])
+                        self.request_resize(hr_scale=self.state.render["hr_scale"])
 
                     elif event.key == pygame.K_a:
                         self.state.autosave["images"] = not self.state.autosave["images"]
@@ -1202,7 +1965,7 @@ class PygameView:
                     elif event.key == pygame.K_BACKSPACE:
                         self.rendering = True
                         self.instant_render = True
-                        pygame.draw.rect(self.canvas, (255, 255, 255), (self.state.render["width"], 0, self.state.render["width"], self.state.render["height"]))
+                        self.fill_sketch((255, 255, 255))
 
                     elif event.key == pygame.K_s:
                         if self.ctrl_down:
@@ -1219,10 +1982,20 @@ class PygameView:
                         self.eraser_down = True
 
                     elif event.key == pygame.K_z:
-                        self.erase_zone_down = True
+                        if self.ctrl_down:
+                            if not self.button_down:
+                                self.undo(redo=self.shift_down)
+                        else:
+                            self.erase_zone_down = True
+
+                    elif event.key == pygame.K_y:
+                        if self.ctrl_down and not self.button_down:
+                            self.undo(redo=True)
 
                     elif event.key == pygame.K_t:
-                        if self.shift_down:
+                        if self.ctrl_down:
+                            self.toggle_trace_panel()
+                        elif self.shift_down:
                             if self.render_wait == 2.0:
                                 self.render_wait = 0.0
                                 self.osd(text="Render wait: off")
@@ -1276,9 +2049,7 @@ class PygameView:
                                 self.osd(text=f"Detect {detector.replace('_', ' ')}")
                                 detector = str(detector)
 
-                                t = threading.Thread(target=functools.partial(
-                                    self.controlnet_detect, detector))
-                                t.start()
+                                self.tasks.submit(self.controlnet_detect, detector)
                         elif self.shift_down:
                             self.rendering_key = True
                             denoising_strengths = self.state.render["denoising_strengths"]
@@ -1296,6 +2067,7 @@ class PygameView:
                             pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
                         else:
                             pygame.display.set_mode((self.state.render["width"]*2, self.state.render["height"]))
+                        self.full_redraw = True
 
                     elif event.key in (pygame.K_0, pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4, pygame.K_5, pygame.K_6, pygame.K_7, pygame.K_8, pygame.K_9):
                         for i in range(10):
@@ -1307,6 +2079,9 @@ class PygameView:
 
                     elif event.key in (pygame.K_ESCAPE, pygame.K_x):
                         self.running = False
+                        if self.stroke_log is not None:
+                            self.stroke_log.close()
+                        self.image_store.close()
                         pygame.quit()
                         exit(0)
 
@@ -1336,8 +2111,8 @@ class PygameView:
                                 self.zone_pos.append((self.state.render["width"]*2, self.state.render["height"]))
                                 self.zone_pos.append((self.state.render["width"], self.state.render["height"]))
 
-                            pygame.draw.polygon(self.canvas, self.brush_colors['e'], self.zone_pos, self.brush_size['z'])
-                            pygame.draw.polygon(self.canvas, self.brush_colors['e'], self.zone_pos)
+                            self.draw_polygon(self.brush_colors['e'], self.zone_pos, self.brush_size['z'])
+                            self.draw_polygon(self.brush_colors['e'], self.zone_pos)
 
                         self.zone_pos = []
 
@@ -1349,39 +2124,37 @@ class PygameView:
                         self.need_redraw = True
                         self.osd(always_on=None)
 
-            # Call image render
-            if (self.rendering and not self.pause_render) or self.instant_render:
-                t = threading.Thread(target=self.render)
-                t.start()
-
-            # Draw the canvas and brushes on the screen
-            self.screen.blit(self.canvas, (0, 0))
-
-            # Handle mouse display
-            mouse_pos = pygame.mouse.get_pos()
-            if mouse_pos[0] >= self.state.render["width"]:
-                # Create a new surface with a circle
-                cursor_size = self.brush_size[1]*2
-                cursor_surface = pygame.Surface((cursor_size, cursor_size), pygame.SRCALPHA)
-                pygame.draw.circle(cursor_surface, self.cursor_color, (cursor_size // 2, cursor_size // 2), cursor_size // 2)
-
-                # Blit the cursor surface onto the screen surface at the position of the mouse
-                self.screen.blit(cursor_surface, (mouse_pos[0] - cursor_size // 2, mouse_pos[1] - cursor_size // 2))
-                pygame.mouse.set_visible(False)
-            else:
-                pygame.mouse.set_visible(True)
+            self.apply_replay()
+            self.flush_brush()
+
+            # Save the sketch changes in the undo history, once the stroke or zone is complete
+            if self.history.dirty and not (self.button_down or self.erase_zone_down or self.save_zone_down or self.replaying):
+                if self.sketch_history(self.history.commit) and self.stroke_log is not None:
+                    self.stroke_log.commit()
 
-            # Handle OSD
-            self.osd()
+            if self.stroke_log is not None:
+                self.stroke_log.flush()
 
-            # Update the display
-            if self.need_redraw:
-                pygame.display.flip()
-                pygame.display.set_caption(self.display_caption)
-                self.need_redraw = False
+            # Apply the size changes between renderings
+            self.apply_resize()
+            self.apply_configuration_changes()
+
+            # Call image render, the latest submitted render replaces the pending one
+            if (self.rendering and not self.pause_render) or self.instant_render:
+                self.scheduler.submit(self.render, delay=None if self.instant_render else self.render_delay, args=(self.state.snapshot(),))
+                self.instant_render = False
 
-            # Set max FPS
-            self.clock.tick(120)
+            # Draw the changed areas of the canvas, the brush cursor and the OSD on the screen
+            if self.draw_frame():
+                # Set max FPS
+                self.clock.tick(self.MAX_FPS)
 
         # Clean up Pygame
+        self.scheduler.stop()
+        self.progress_monitor.stop()
+        self.webui_config_monitor.stop()
+        self.tasks.stop()
+        if self.stroke_log is not None:
+            self.stroke_log.close()
+        self.image_store.close()
         pygame.quit()
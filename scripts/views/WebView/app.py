@@ -1,14 +1,16 @@
+import functools
 import json
-import requests
-import threading
+import time
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from scripts.common.state import State
-from scripts.common.cn_requests import Api
+from scripts.common.progress_monitor import ProgressMonitor
+from scripts.common.render_scheduler import RenderScheduler
 from scripts.common.utils import payload_submit
+from scripts.common.webui_config_monitor import WebuiConfigMonitor
 
 
 app = FastAPI()
@@ -26,11 +28,17 @@ app.mount("/static", StaticFiles(directory="scripts/views/WebView/build"), name=
 sd_response = None,
 
 state = State()
-api = Api(state)
-url = state.server.get('url', 'http://127.0.0.1:7860')
+api = state.api
+if state.configuration["config"].get('startup_report', 'false') == 'true':
+    print(state.startup_timer.report())
 
-if not state.configuration["config"]['controlnet_models']:
-    api.fetch_controlnet_models(state)
+scheduler = RenderScheduler(state, api, stale_action=state.configuration["config"].get('render_stale_action', 'none'))
+scheduler.start()
+progress_monitor = ProgressMonitor(state, api)
+progress_monitor.start()
+webui_config_monitor = WebuiConfigMonitor(state, api, interval=state.configuration["config"].get('webui_config_interval', 30))
+webui_config_monitor.start()
+latency_metric = state.metrics.histogram('render_latency_seconds', "Time from the request of a rendering to its display, debounce included.", ('view',))
 
 
 def send_request(data):
@@ -43,7 +51,22 @@ def send_request(data):
         info["with_tiling"] = data["config"]["tiling"]
         response["info"] = json.dumps(info)
         sd_response = response
-    state.server["busy"] = False
+        return True
+    return False
+
+
+def paint_image(data, submit_time):
+    payload_submit(state, data["config"]
+                   ["controlnet_units"][0]["input_image"])
+    state["main_json_data"]["prompt"] = data["config"]["prompt"]
+    state["main_json_data"]["negative_prompt"] = data["config"]["negative_prompt"]
+    state["main_json_data"]["seed"] = data["config"]["seed"]
+    state["main_json_data"]["width"] = data["config"]["width"]
+    state["main_json_data"]["height"] = data["config"]["height"]
+    state["main_json_data"]["batch_size"] = data["config"]["batch_size"]
+    state["main_json_data"]["tiling"] = data["config"]["tiling"]
+    if send_request(data):
+        latency_metric.observe(time.perf_counter() - submit_time, view='web')
 
 
 @app.get('/config')
@@ -87,27 +110,18 @@ async def root():
 
 @app.get('/modules')
 async def root():
-    response = requests.get(url=f'{url}/controlnet/module_list')
+    response = api.request('controlnet/module_list')
     if response.ok:
         return response.json()
 
 
 @app.post('/paint_image')
 async def root(data: Request):
-    if not state.server["busy"]:
-        state.server["busy"] = True
-        data = await data.json()
-        payload_submit(state, data["config"]
-                       ["controlnet_units"][0]["input_image"])
-        state["main_json_data"]["prompt"] = data["config"]["prompt"]
-        state["main_json_data"]["negative_prompt"] = data["config"]["negative_prompt"]
-        state["main_json_data"]["seed"] = data["config"]["seed"]
-        state["main_json_data"]["width"] = data["config"]["width"]
-        state["main_json_data"]["height"] = data["config"]["height"]
-        state["main_json_data"]["batch_size"] = data["config"]["batch_size"]
-        state["main_json_data"]["tiling"] = data["config"]["tiling"]
-        t = threading.Thread(target=send_request, args=[data])
-        t.start()
+    data = await data.json()
+    # the latest painting replaces the pending one
+    state.server["busy"] = True
+    scheduler.submit(functools.partial(paint_image, data, time.perf_counter()))
+    progress_monitor.notify()
 
 
 @app.get('/server_status')
@@ -115,8 +129,8 @@ async def root():
     if not state.server["busy"]:
         return
 
-    progress_json = api.progress_request()
-    progress = progress_json.get('progress', None)
+    # shared progress, polled once per interval whatever the number of clients
+    progress = progress_monitor.progress
     if progress == 0.0:
         return "NOT READY"
     return progress
@@ -126,3 +140,8 @@ async def root():
 async def root():
     if sd_response:
         return sd_response
+
+
+@app.get('/metrics')
+async def root():
+    return Response(content=state.metrics.expose(), media_type=state.metrics.CONTENT_TYPE)